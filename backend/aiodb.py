@@ -0,0 +1,98 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import db
+import shards
+
+# Async front end to the connection pool for the ASGI server (asgi.py).
+#
+# sqlite3 only has a blocking API, so every database call is shipped to a
+# small fixed thread pool and awaited from the event loop. Coroutines waiting
+# on a client cost nothing here; only code that is actually talking to SQLite
+# holds one of these threads. The pool is sized to the connection pool so a
+# worker never sits waiting for a connection.
+#
+# Those workers also run whole Flask requests for asgi.call_flask, and a
+# Flask request can sit waiting on a hold or the group commit writer, so they
+# can all be busy at once. The native read handlers (read_for_event) get their
+# own small executor, no bigger than the read pool, so availability reads keep
+# going when the main one is full.
+
+DEFAULT_WORKERS = db.DEFAULT_POOL_SIZE
+DEFAULT_READ_WORKERS = 4
+
+executor = ThreadPoolExecutor(max_workers=DEFAULT_WORKERS, thread_name_prefix='db-worker')
+read_executor = ThreadPoolExecutor(max_workers=DEFAULT_READ_WORKERS, thread_name_prefix='db-reader')
+
+
+async def run_sync(fn, *args):
+    """Run any blocking fn(*args) on a database worker thread."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, fn, *args)
+
+
+async def _run_read(fn, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(read_executor, fn, *args)
+
+
+def _with_connection(fn, args):
+    with db.pool.connection() as conn:
+        return fn(conn, *args)
+
+
+async def run(fn, *args):
+    """Await fn(conn, *args) with a pooled connection, e.g. run(reservations.reserve_seat, ...)."""
+    return await run_sync(_with_connection, fn, args)
+
+
+def _with_event_connection(event_id, read_only, fn, args):
+    router = shards.router
+    pool = router.read_pool_for(event_id) if read_only else router.pool_for(event_id)
+    with pool.connection() as conn:
+        return fn(conn, *args)
+
+
+async def run_for_event(event_id, fn, *args):
+    """Like run(), on the database (shard) holding event_id's tickets."""
+    return await run_sync(_with_event_connection, event_id, False, fn, args)
+
+
+async def read_for_event(event_id, fn, *args):
+    """Like run_for_event() with a read-only connection, on the read executor."""
+    return await _run_read(_with_event_connection, event_id, True, fn, args)
+
+
+async def fetchall(query, params=()):
+    return await run(lambda conn: conn.execute(query, params).fetchall())
+
+
+async def fetchone(query, params=()):
+    return await run(lambda conn: conn.execute(query, params).fetchone())
+
+
+async def execute(query, params=()):
+    """Run a single write and commit it. Returns the number of rows changed."""
+    def work(conn):
+        cur = conn.execute(query, params)
+        conn.commit()
+        return cur.rowcount
+    return await run(work)
+
+
+def init_app(app):
+    global executor, read_executor
+    workers = app.config.get('ASGI_DB_WORKERS', db.pool.max_size)
+    if workers != executor._max_workers:
+        executor.shutdown(wait=False)
+        executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='db-worker')
+    # More readers than read connections would just queue inside the pool
+    read_workers = min(app.config.get('ASGI_READ_WORKERS', DEFAULT_READ_WORKERS), db.read_pool.max_size)
+    if read_workers != read_executor._max_workers:
+        read_executor.shutdown(wait=False)
+        read_executor = ThreadPoolExecutor(max_workers=read_workers, thread_name_prefix='db-reader')
+
+
+def shutdown():
+    executor.shutdown(wait=False)
+    read_executor.shutdown(wait=False)
@@ -1,7 +1,6 @@
 from flask import Flask, jsonify, make_response, request # Importing the Flask library and some helper functions
 import sqlite3 # Library for talking to our database
 from datetime import datetime # We'll be working with dates 
-from werkzeug.security import generate_password_hash, check_password_hash
 from flask_cors import CORS
 
 from flask import Flask
@@ -14,50 +13,93 @@ from flask_jwt_extended import get_jwt
 from flask_jwt_extended import jwt_required
 from flask_jwt_extended import JWTManager
 from datetime import timedelta
-import uuid
+import itertools
+import os
+
+import auth
+import carts
+import catalog
+import db
+import event_import
+import expiry
+import group_commit
+import exports
+import gate
+import inventory
+import metrics
+import migrations
+import payments
+import pricing
+import reservations
+import response_cache
+import sales
+import seat_cache
+import seat_finder
+import seat_stream
+import shards
+import snapshots
+import ticket_codes
+import venues
+import waiting_room
+from db import get_db_connection
 
 app = Flask(__name__) # Creating a new Flask app. This will help us create API endpoints hiding the complexity of writing network code!
-CORS(app)  # Enable CORS for all routes
+CORS(app, expose_headers=['X-Seat-Stream-Version'])  # Enable CORS for all routes, the frontend reads the stream version
+app.config['DB_PATH'] = os.environ.get('TESSERA_DB_PATH', '../database/tessera.db')
 app.config['JWT_VERIFY_SUB'] = False
+app.config['GROUP_COMMIT'] = os.environ.get('TESSERA_GROUP_COMMIT') == '1'  # see group_commit.py
+app.config['SHARDING'] = os.environ.get('TESSERA_SHARDING') == '1'  # see shards.py
+app.config['SHARD_DIR'] = os.environ.get('TESSERA_SHARD_DIR')
+app.config['READ_SNAPSHOT'] = os.environ.get('TESSERA_READ_SNAPSHOT') == '1'  # see snapshots.py
+app.config['PAYMENTS_TEST_MODE'] = os.environ.get('TESSERA_PAYMENTS_TEST_MODE') == '1'  # see payments.py
+app.config['PAYMENTS_AUTO_CONFIRM'] = os.environ.get('TESSERA_PAYMENTS_AUTO_CONFIRM') == '1'
 
 # Setup the Flask-JWT-Extended extension
 app.config["JWT_SECRET_KEY"] = "super-secret"  # Change this!
 jwt = JWTManager(app)
 
-# This function returns a connection to the database which can be used to send SQL commands to the database
-def get_db_connection():
-  conn = sqlite3.connect('../database/tessera.db')
-  conn.row_factory = sqlite3.Row
-  return conn
+# Database connections come from a shared pool (see db.py). get_db_connection() hands back
+# the connection for the current request and it is returned to the pool when the request ends.
+db.init_app(app)
+migrations.init_app(app)
+shards.init_app(app)
+snapshots.init_app(app)
+auth.init_app(app)
+expiry.init_app(app)
+seat_cache.init_app(app)
+seat_stream.init_app(app)
+catalog.init_app(app)
+metrics.init_app(app)
+waiting_room.init_app(app)
+group_commit.init_app(app)
+payments.init_app(app)
+response_cache.init_app(app)
+gate.init_app(app)
 
 # When asked, add code in this area
-def validate_user_credentials(username, password):
-    try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-
-        # Attempt to retrieve the user from the db
-        cursor.execute('SELECT password_hash FROM Users WHERE username = ?', (username,))
-
-        row = cursor.fetchone()
-        conn.close() 
-        if not row:
-            return False
-
-        password_hash = row[0]
-
-        # If no such username exists in our system or the password is incorrect we will return 401 Error code
-        if not check_password_hash(password_hash, password):
-            return False
-
-        return True
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+def auth_error_response(e):
+    # Shared responses for the auth service's rate limiting and back pressure
+    if isinstance(e, auth.TooManyAttempts):
+        response = jsonify({'error': str(e)})
+        response.headers['Retry-After'] = str(e.retry_after)
+        return response, 429
+    response = jsonify({'error': str(e)})
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response, 503
+
+def queue_error_response(e):
+    # Callers still in the waiting room are told where they are and when to come back
+    if isinstance(e, waiting_room.NotAdmitted):
+        response = jsonify({'error': str(e), 'position': e.position, 'eta_seconds': e.eta_seconds})
+        response.headers['Retry-After'] = str(max(1, e.eta_seconds))
+        return response, 429
+    return jsonify({'error': str(e)}), 403
 
 
 @app.route('/events', methods=['GET'])
+@response_cache.cached('events')
 def get_events():
-    conn = get_db_connection()
+    conn = snapshots.snapshot.get_connection()
     cursor = conn.cursor()
 
     # Query params
@@ -65,10 +107,16 @@ def get_events():
     location = request.args.get('location')
     search = request.args.get('search')
 
+    # Passing ?cursor= (empty for the first page) switches to keyset pagination,
+    # otherwise we keep the old page numbers for the events page.
+    page_cursor = request.args.get('cursor')
     page = int(request.args.get('page', 1))
     limit = int(request.args.get('limit', 6))
     offset = (page - 1) * limit
 
+    # How to work out the total: "cached" (default), "exact" or "none"
+    total_mode = request.args.get('total', 'cached')
+
     base_query = "FROM Events"
     conditions = []
     params = []
@@ -83,44 +131,78 @@ def get_events():
         params.append(location)
 
     if search:
-        conditions.append(
-            "(name LIKE ? OR location LIKE ?)"
-        )
-        search_term = f"%{search}%"
-        params.extend([search_term, search_term])
+        match = catalog.search_query(search)
+        if match is None:
+            conditions.append("0")
+        else:
+            conditions.append("event_id IN (SELECT rowid FROM Events_fts WHERE Events_fts MATCH ?)")
+            params.append(match)
 
-    if conditions:
-        base_query += " WHERE " + " AND ".join(conditions)
+    where = " WHERE " + " AND ".join(conditions) if conditions else ""
 
     # Total count (for pagination)
-    count_query = f"SELECT COUNT(*) {base_query}"
-    cursor.execute(count_query, params)
-    total_events = cursor.fetchone()[0]
-
-    # Paginated query
+    total_events = None
+    if total_mode != 'none':
+        count_key = (after_date, location, search)
+        if total_mode == 'cached':
+            total_events = catalog.counts.get(count_key)
+        if total_events is None:
+            cursor.execute(f"SELECT COUNT(*) {base_query}{where}", params)
+            total_events = cursor.fetchone()[0]
+            catalog.counts.put(count_key, total_events)
+
+    page_conditions = list(conditions)
+    page_params = list(params)
+    if page_cursor:
+        try:
+            cursor_date, cursor_id = catalog.decode_cursor(page_cursor)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        page_conditions.append("(date, event_id) > (?, ?)")
+        page_params.extend([cursor_date, cursor_id])
+
+    page_where = " WHERE " + " AND ".join(page_conditions) if page_conditions else ""
+
+    # Fetch one extra row to know whether there is a next page
     events_query = f"""
         SELECT *
-        {base_query}
-        ORDER BY date ASC
-        LIMIT ? OFFSET ?
+        {base_query}{page_where}
+        ORDER BY date ASC, event_id ASC
+        LIMIT ?
     """
+    if page_cursor is None:
+        events_query += " OFFSET ?"
+        page_params.extend([limit + 1, offset])
+    else:
+        page_params.append(limit + 1)
 
-    cursor.execute(events_query, params + [limit, offset])
+    cursor.execute(events_query, page_params)
     events = cursor.fetchall()
 
     conn.close()
 
-    return jsonify({
+    next_cursor = None
+    if len(events) > limit:
+        events = events[:limit]
+        next_cursor = catalog.encode_cursor(events[-1]['date'], events[-1]['event_id'])
+
+    result = {
         "events": [dict(event) for event in events],
-        "page": page,
         "limit": limit,
+        "nextCursor": next_cursor,
         "total": total_events,
-        "totalPages": (total_events + limit - 1) // limit
-    }), 200
+    }
+    if page_cursor is None:
+        result["page"] = page
+    if total_events is not None:
+        result["totalPages"] = (total_events + limit - 1) // limit
+
+    return jsonify(result), 200
 
 @app.route('/events/<int:event_id>', methods=['GET'])
+@response_cache.cached('event:{event_id}')
 def get_event(event_id):
-    conn = get_db_connection()
+    conn = snapshots.snapshot.get_connection()
     cursor = conn.cursor()
 
     cursor.execute('SELECT * FROM Events WHERE event_id = ?', (event_id,))
@@ -147,22 +229,19 @@ def create_user():
     if not email or not username or not password or not first_name or not last_name:
         return jsonify({'error': 'All fields (email, username, password, first_name, and last_name) are required.'}), 400
 
-    # Hash the password
-    hashed_password = generate_password_hash(password)
-
     try:
+        # Hash the password on the hashing pool
+        hashed_password = auth.hasher.hash(password)
+
         conn = get_db_connection()
         cursor = conn.cursor()
         
         # Attempt to insert the new user into the Users table
         cursor.execute('INSERT INTO Users (email, first_name, last_name, username, password_hash) VALUES (?, ?, ?, ?, ?)',
                        (email, first_name, last_name, username, hashed_password))
+        new_user_id = cursor.lastrowid
         conn.commit()  # Commit the changes to the database
 
-        # Retrieve the user_id of the newly created user to confirm creation
-        cursor.execute('SELECT user_id FROM Users WHERE username = ?', (username,))
-        new_user_id = cursor.fetchone()[0]
-
         conn.close()
 
         additional_claims = {
@@ -184,6 +263,8 @@ def create_user():
 
     except sqlite3.IntegrityError:
         return jsonify({'error': 'Username or email already exists.'}), 409
+    except auth.HashingBusy as e:
+        return auth_error_response(e)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -201,29 +282,14 @@ def check_login():
         return jsonify({'error': 'All fields are required'}), 400
 
     try:
-        if validate_user_credentials(username, password):
-            conn = get_db_connection()
-            cursor = conn.cursor()
-
-            cursor.execute(
-                "SELECT user_id, role, first_name, last_name, email, avatar FROM Users WHERE username = ?",
-                (username,)
-            )
-            user_id, role, first_name, last_name, email, avatar = cursor.fetchone()
-            conn.close()
-
-            additional_claims = {
-                "username": username,
-                "role": role,
-                "email": email,
-                "first_name": first_name,
-                "last_name": last_name,
-                "avatar": avatar
-            }
+        # One query for the user, the hash check runs on the hashing pool
+        conn = get_db_connection()
+        user = auth.authenticate(conn, password, username=username)
 
+        if user:
             access_token = create_access_token(
-                identity=str(user_id),
-                additional_claims=additional_claims,
+                identity=str(user['user_id']),
+                additional_claims=auth.claims_for(user),
                 expires_delta=timedelta(days=1)
             )
 
@@ -231,6 +297,8 @@ def check_login():
         else:
             return jsonify({'error': 'Incorrect login information'}), 401
 
+    except (auth.TooManyAttempts, auth.HashingBusy) as e:
+        return auth_error_response(e)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -248,21 +316,21 @@ def change_username():
 
     try: 
         conn = get_db_connection()
-        cursor = conn.cursor()
-
-        cursor.execute("SELECT username FROM Users WHERE email = ?", (email,))
-        username = cursor.fetchone()[0]
 
-        if username == None:
-            conn.close()
+        if auth.fetch_user(conn, email=email) is None:
             return jsonify({'error': 'There are no users associated with that email'}), 400
-        
-        if validate_user_credentials(username, password):
-            cursor.execute("UPDATE Users SET username = ? WHERE email = ?", (new_username, email))
+
+        if auth.authenticate(conn, password, email=email):
+            conn.execute("UPDATE Users SET username = ? WHERE email = ?", (new_username, email))
             conn.commit()  # Commit the changes to the database
-            conn.close()
             return jsonify({'message': 'Username successfully changed'}), 200
+        else:
+            return jsonify({'error': 'Invalid user credentials'}), 400
 
+    except sqlite3.IntegrityError:
+        return jsonify({'error': 'Username already exists.'}), 409
+    except (auth.TooManyAttempts, auth.HashingBusy) as e:
+        return auth_error_response(e)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -279,19 +347,20 @@ def change_email():
         return jsonify({'error': 'Must provide an username, password, and new email'}), 400
 
     try: 
-        
-        if validate_user_credentials(username, password):
-            conn = get_db_connection()
-            cursor = conn.cursor()
+        conn = get_db_connection()
 
-            cursor.execute("UPDATE Users SET email = ? WHERE username = ?", (new_email, username))
+        if auth.authenticate(conn, password, username=username):
+            conn.execute("UPDATE Users SET email = ? WHERE username = ?", (new_email, username))
             conn.commit()  # Commit the changes to the database
-            conn.close()
 
             return jsonify({'message': 'Email successfully changed'}), 200
         else:
             return jsonify({'error': 'Invalid user credentials'}), 400
 
+    except sqlite3.IntegrityError:
+        return jsonify({'error': 'Email already exists.'}), 409
+    except (auth.TooManyAttempts, auth.HashingBusy) as e:
+        return auth_error_response(e)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -308,20 +377,20 @@ def change_password():
         return jsonify({'error': 'Must provide an old password, new password and username'}), 400
 
     try: 
-        if validate_user_credentials(username, password):
-            conn = get_db_connection()
-            cursor = conn.cursor()
+        conn = get_db_connection()
 
-            new_password_hash = generate_password_hash(new_password)
+        if auth.authenticate(conn, old_password, username=username):
+            new_password_hash = auth.hasher.hash(new_password)
 
-            cursor.execute("UPDATE Users SET password = ? WHERE username = ?", (new_password_hash, username))
+            conn.execute("UPDATE Users SET password_hash = ? WHERE username = ?", (new_password_hash, username))
             conn.commit()  # Commit the changes to the database
-            conn.close()
 
             return jsonify({'message': 'Password successfully changed'}), 200
         else:
             return jsonify({'error': 'Invalid user credentials'}), 400
 
+    except (auth.TooManyAttempts, auth.HashingBusy) as e:
+        return auth_error_response(e)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -332,18 +401,21 @@ def delete_user():
     password = request.json.get('password')
     username = request.json.get('username')
 
+    if not username or not password:
+        return jsonify({'error': 'Must provide a username and password'}), 400
+
     try: 
-        if validate_user_credentials(username, password):
-            conn = get_db_connection()
-            cursor = conn.cursor()
+        conn = get_db_connection()
 
-            cursor.execute("DELETE FROM Users WHERE username = ?", (username,))
+        if auth.authenticate(conn, password, username=username):
+            conn.execute("DELETE FROM Users WHERE username = ?", (username,))
             conn.commit()
-            conn.close()
             return jsonify({'message': 'User successfully deleted'}), 200
         else:
             return jsonify({'error': 'Invalid user credentials'}), 400
 
+    except (auth.TooManyAttempts, auth.HashingBusy) as e:
+        return auth_error_response(e)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
         
@@ -356,16 +428,13 @@ def get_all_emails():
         if claims['role'] != 'admin':
             return jsonify({'error': 'Admin access required'}), 403
 
-        conn = get_db_connection()
-        cursor = conn.cursor()
-
-        cursor.execute('SELECT email FROM Users')
+        # Streamed in batches: ?format=json (default, a plain list), ndjson or csv
+        fmt = request.args.get('format', 'json')
+        if fmt not in exports.FORMATS:
+            return jsonify({'error': f'format must be one of {", ".join(exports.FORMATS)}'}), 400
 
-        emails = cursor.fetchall()
-        conn.close()
-        
-        emails_list = [email[0] for email in emails]
-        return jsonify(emails_list)
+        body = exports.stream('SELECT email FROM Users ORDER BY user_id', [], fmt, single_column=True)
+        return app.response_class(body, mimetype=exports.MIMETYPES[fmt])
 
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -397,13 +466,49 @@ def create_event():
         event_time = datetime.strptime(time, "%H:%M").time()
 
         cursor.execute('INSERT INTO Events (name, description, date, time, location, url) VALUES (?, ?, ?, ?, ?, ?)',
-                       (name, description, event_date, event_time, location, url))
+                       (name, description, event_date.isoformat(), event_time.isoformat(), location, url))
+        catalog.index_event(cursor, cursor.lastrowid)  # keep the search index in step
+        shards.router.assign(cursor, cursor.lastrowid)
         conn.commit()  # Commit the changes to the database
+        snapshots.snapshot.note_write()
+        catalog.counts.clear()
+        # Listings change, but no existing event's own page does. Anything that
+        # edits an event should also invalidate f'event:{event_id}'.
+        response_cache.cache.invalidate('events')
         return jsonify({'message': 'Event successfully added'}), 200
 
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/events/import', methods=['POST'])
+@jwt_required()
+def import_events():
+    # Many events in one upload: the body (or a multipart "file") is CSV with a header
+    # row or NDJSON, see event_import.py. Bad records are skipped and reported by line.
+    claims = get_jwt()
+    if claims['role'] != 'admin':
+        return jsonify({'error': 'Admin access required'}), 403
+
+    upload = request.files.get('file')
+    try:
+        fmt = event_import.detect_format(request.args.get('format'),
+                                         upload.mimetype if upload else request.mimetype)
+        stream = upload.stream if upload else request.stream
+        report = event_import.import_events(get_db_connection(), event_import.read_records(stream, fmt))
+        return jsonify(report), 200
+
+    except event_import.ImportFormatError as e:
+        return jsonify({'error': str(e)}), 400
+    except reservations.WriteContention as e:
+        return jsonify({'error': str(e)}), 503
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    finally:
+        # Whatever chunks got committed are in the listings now
+        snapshots.snapshot.note_write()
+        catalog.counts.clear()
+        response_cache.cache.invalidate('events')
+
 @app.route('/create_ticket', methods=['POST'])
 @jwt_required()
 def create_ticket():
@@ -420,13 +525,13 @@ def create_ticket():
         return jsonify({'error': 'Must provide an event_id, price, and quantity'}), 400
 
     try:
-        conn = get_db_connection()
+        conn = shards.get_connection(event_id)
         cursor = conn.cursor()
 
-        for _ in range(quantity):
-            cursor.execute('INSERT INTO Tickets (event_id, price, status) VALUES (?, ?, ?)',
-                           (event_id, price, 'available'))
+        cursor.executemany('INSERT INTO Tickets (event_id, price, status) VALUES (?, ?, ?)',
+                           itertools.repeat((event_id, price, ticket_codes.AVAILABLE), quantity))
         conn.commit()
+        seat_cache.cache.invalidate(event_id)
         return jsonify({'message': 'Ticket successfully created'}), 200
 
     except Exception as e:
@@ -437,32 +542,31 @@ def create_ticket():
 def buy_ticket():
     user_id = get_jwt_identity()
 
-    # Extract ticket details
+    # Extract ticket details. row_name and seat_number are optional, without them
+    # any available ticket for the event is sold.
     event_id = request.json.get('event_id')
+    row_name = request.json.get('row_name')
+    seat_number = request.json.get('seat_number')
 
     if not event_id:
         return jsonify({'error': 'Must provide an event_id'}), 400
 
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-
-        # Find an available ticket for the specified event
-        cursor.execute('SELECT ticket_id FROM Tickets WHERE event_id = ? AND status = ? LIMIT 1',
-                       (event_id, 'available'))
-        ticket = cursor.fetchone()
+        waiting_room.room.check(request.headers.get(waiting_room.TOKEN_HEADER), event_id, user_id)
+    except waiting_room.QueueError as e:
+        return queue_error_response(e)
 
-        if not ticket:
-            return jsonify({'error': 'No available tickets for this event'}), 404
-
-        ticket_id = ticket['ticket_id']
-
-        # Update the ticket status to 'sold' and associate it with the user
-        cursor.execute('UPDATE Tickets SET status = ?, user_id = ? WHERE ticket_id = ?',
-                       ('sold', user_id, ticket_id))
-        conn.commit()
+    try:
+        conn = shards.get_connection(event_id)
+        ticket_id = reservations.buy_seat(conn, event_id, user_id, row_name, seat_number)
         return jsonify({'message': 'Ticket successfully purchased', 'ticket_id': ticket_id}), 200
 
+    except reservations.SeatNotFound as e:
+        return jsonify({'error': str(e)}), 404
+    except reservations.SeatConflict as e:
+        return jsonify({'error': str(e)}), 409
+    except reservations.WriteContention as e:
+        return jsonify({'error': str(e)}), 503
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -485,48 +589,96 @@ def check_auth():
 
 
 @app.route('/get_all_tickets', methods=['GET'])
+@jwt_required()
 def get_all_tickets():
-    conn = get_db_connection()
-    cur = conn.cursor()
+    # Admins only: the rows include barcodes, and a sold barcode gets you in at the gate
+    claims = get_jwt()
+    if claims['role'] != 'admin':
+        return jsonify({'error': 'Admin access required'}), 403
 
-    cur.execute("SELECT * FROM Tickets")
-    tickets = cur.fetchall()
+    # Optional filters: ?event_id=, ?status=, ?user_id=
+    conditions, params = exports.ticket_filters(request.args)
+
+    # Tickets are spread over the shards, an event's tickets all sit in one
+    event_id = request.args.get('event_id', type=int)
+    shard_ids = [shards.router.shard_for(event_id)] if event_id is not None else shards.router.shard_ids()
+
+    # ?limit= returns one page at a time, continue with ?after=<next_after>
+    limit = request.args.get('limit', type=int)
+    if limit is not None:
+        after = request.args.get('after', type=int)
+        # Shards whose id range ends before the cursor have nothing left to give
+        if after is not None:
+            shard_ids = [shard_id for shard_id in shard_ids if shard_id >= shards.shard_of(after)]
+        conns = (shards.get_shard_connection(shard_id, read_only=True) for shard_id in shard_ids)
+        tickets, next_after = exports.page_many(conns, 'Tickets', 'ticket_id', conditions, params,
+                                                after, limit, columns=ticket_codes.TICKET_COLUMNS)
+        return jsonify({"tickets": tickets, "next_after": next_after}), 200
+
+    # Otherwise the whole table is streamed in batches: ?format=json (default), ndjson or csv
+    fmt = request.args.get('format', 'json')
+    if fmt not in exports.FORMATS:
+        return jsonify({'error': f'format must be one of {", ".join(exports.FORMATS)}'}), 400
+
+    where = " WHERE " + " AND ".join(conditions) if conditions else ""
+    body = exports.stream(f"SELECT {ticket_codes.TICKET_COLUMNS} FROM Tickets{where} ORDER BY ticket_id",
+                          params, fmt, wrap_key="tickets",
+                          pools=(shards.router.read_pool(shard_id) for shard_id in shard_ids))
+    return app.response_class(body, status=200, mimetype=exports.MIMETYPES[fmt])
+
+@app.route('/events/<int:event_id>/inventory', methods=['POST'])
+@jwt_required()
+def create_inventory(event_id):
+    claims = get_jwt()
+    if claims['role'] != 'admin':
+        return jsonify({'error': 'Admin access required'}), 403
 
-    conn.close()
+    # The body is a venue layout (see inventory.py for the format) or
+    # {"template": "<name>"} to use a saved venue template
+    layout = request.get_json(silent=True)
+    if not layout:
+        return jsonify({'error': 'Must provide a venue layout'}), 400
 
-    return jsonify({"tickets": [dict(ticket) for ticket in tickets]}), 200
+    try:
+        if 'template' in layout:
+            layout = venues.get_template(get_db_connection(), layout['template'])
+        summary = inventory.generate(shards.get_connection(event_id), event_id, layout)
+        seat_cache.cache.invalidate(event_id)
+        return jsonify(summary), 201
+
+    except inventory.LayoutError as e:
+        return jsonify({'error': str(e)}), 400
+    except venues.TemplateNotFound as e:
+        return jsonify({'error': str(e)}), 404
+    except reservations.WriteContention as e:
+        return jsonify({'error': str(e)}), 503
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
 
 @app.route("/events/add-tickets", methods=["POST"])
 def add_tickets():
     conn = get_db_connection()
-    cur = conn.cursor()
 
     try:
         conn.execute("PRAGMA foreign_keys = OFF")
 
-        ROWS = ["A", "B", "C", "D", "E"]
-        SEATS_PER_ROW = 5
+        # Demo inventory: rows A-E, seats 11-15 for events 1 through 12
+        layout = {"sections": [{"rows": [{"name": row, "seats": [11, 15]} for row in "ABCDE"]}]}
 
+        created = 0
+        attempted = 0
         for event_id in range(1, 13):
-            tickets = []
-            for row in ROWS:
-                for seat in range(11, 16):
-                    barcode = str(uuid.uuid4())  # unique barcode
-                    tickets.append((event_id, row, seat, "AVAILABLE", barcode))
-
-                # Insert tickets; ignore if already exist
-                cur.executemany("""
-                    INSERT OR IGNORE INTO Tickets
-                    (event_id, row_name, seat_number, status, barcode)
-                    VALUES (?, ?, ?, ?, ?)
-                """, tickets)
+            summary = inventory.generate(shards.get_connection(event_id), event_id, layout)
+            created += summary["tickets_created"]
+            attempted += summary["seats_in_layout"]
 
-        conn.commit()
         conn.close()
+        seat_cache.cache.invalidate()
 
         return jsonify({
             "message": "Tickets added successfully",
-            "total_tickets_attempted": len(tickets)
+            "total_tickets_attempted": attempted,
+            "total_tickets_created": created
         }), 201
     except Exception as e:
         conn.close()
@@ -535,25 +687,20 @@ def add_tickets():
 @app.route('/add_ticket_prices', methods=['POST'])
 def add_ticket_prices():
     conn = get_db_connection()
-    cur = conn.cursor()
 
     try:
-        # Define ticket prices for each event
+        # Demo prices (in dollars) for each event, applied to every row of the event
         ticket_prices = [
             (1, 100), (2, 150), (3, 200), (4, 250), (5, 300),
             (6, 350), (7, 400), (8, 450), (9, 500), (10, 550),
             (11, 600), (12, 650)
         ]
 
-        # Insert ticket prices into the database
-        cur.executemany("""
-            INSERT OR IGNORE INTO TicketPrices
-            (event_id, price)
-            VALUES (?, ?)
-        """, ticket_prices)
+        for event_id, price in ticket_prices:
+            pricing.reprice_event(shards.get_connection(event_id), event_id, {"default": {"base_cents": price * 100, "curve": "flat"}})
 
-        conn.commit()
         conn.close()
+        seat_cache.cache.invalidate()
 
         return jsonify({
             "message": "Ticket prices added successfully"
@@ -564,164 +711,539 @@ def add_ticket_prices():
 
 @app.route('/set_prices/<int:event_id>/<int:max_price_dollars>', methods=['POST'])
 def set_prices(event_id, max_price_dollars):
-    max_price_cents = max_price_dollars * 100
-    conn = get_db_connection()
-    cur = conn.cursor()
+    conn = shards.get_connection(event_id)
 
-    ROWS = ['A', 'B', 'C', 'D', 'E']
-    PRICE_DECREMENT_CENTS = 1000  # $10.00 decrement per row
+    # Front row gets the max price, every row behind it is $10.00 cheaper
+    rules = {"default": {"base_cents": max_price_dollars * 100, "curve": "linear", "step_cents": 1000}}
 
-    for i, row in enumerate(ROWS):
-        price_cents = max_price_cents - (i * PRICE_DECREMENT_CENTS)
-        if price_cents < 0:
-            price_cents = 0  # don't go negative
+    # Events without tickets yet get the original A-E rows
+    rows = pricing.event_rows(conn, event_id) or [(row_name, None) for row_name in 'ABCDE']
+    prices = pricing.reprice_event(conn, event_id, rules, rows)
+
+    conn.close()
+    seat_cache.cache.invalidate(event_id)
+    return jsonify({"message": "Prices set successfully", "rows_priced": len(prices)}), 200
+
+@app.route('/events/<int:event_id>/prices', methods=['POST'])
+@jwt_required()
+def reprice_event(event_id):
+    claims = get_jwt()
+    if claims['role'] != 'admin':
+        return jsonify({'error': 'Admin access required'}), 403
 
-        cur.execute("""
-            INSERT INTO Ticket_Prices (event_id, row_name, price_cents)
-            VALUES (?, ?, ?)
-        """, (event_id, row, price_cents))
+    # The body is a set of pricing rules, see pricing.py for the format
+    rules = request.get_json(silent=True)
+    if not rules:
+        return jsonify({'error': 'Must provide pricing rules'}), 400
 
-        print(f"Set price for Event {event_id} Row {row}: ${price_cents/100:.2f}")
+    try:
+        conn = shards.get_connection(event_id)
+        prices = pricing.reprice_event(conn, event_id, rules)
+        seat_cache.cache.invalidate(event_id)
+        return jsonify({'event_id': event_id, 'prices': prices}), 200
+
+    except pricing.PricingError as e:
+        return jsonify({'error': str(e)}), 400
+    except reservations.WriteContention as e:
+        return jsonify({'error': str(e)}), 503
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
 
-    conn.commit()
-    conn.close()
-    return jsonify({"message": "Prices set successfully"}), 200
+@app.route('/venues/templates', methods=['POST'])
+@jwt_required()
+def create_venue_template():
+    claims = get_jwt()
+    if claims['role'] != 'admin':
+        return jsonify({'error': 'Admin access required'}), 403
+
+    name = request.json.get('name')
+    layout = request.json.get('layout')
 
+    if not (name and layout):
+        return jsonify({'error': 'Must provide a name and a layout'}), 400
 
-from datetime import datetime, timedelta, timezone
+    try:
+        conn = get_db_connection()
+        seats = venues.save_template(conn, name, layout)
+        return jsonify({'message': 'Venue template saved', 'name': name, 'seats': seats}), 200
 
-@app.route('/get_ticket_availability/<int:event_id>', methods=['GET'])
+    except inventory.LayoutError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/venues/templates', methods=['GET'])
 @jwt_required()
-def get_ticket_availability(event_id):
+def get_venue_templates():
+    claims = get_jwt()
+    if claims['role'] != 'admin':
+        return jsonify({'error': 'Admin access required'}), 403
+
     conn = get_db_connection()
-    cur = conn.cursor()
-    
-    # Use UTC time to match SQLite's CURRENT_TIMESTAMP
-    current_time_utc = datetime.now(timezone.utc)
-    one_minute_ago_utc = current_time_utc - timedelta(minutes=1)
-    
-    print(f"[{current_time_utc}] Cleaning up expired reservations for event {event_id}")
-    print(f"Looking for reservations older than: {one_minute_ago_utc}")
-    
-    # Check what expired reservations exist (for debugging)
-    cur.execute("""
-        SELECT event_id, row_name, seat_number, reservation_time, status,
-               datetime('now') as sqlite_current_time
-        FROM Tickets
-        WHERE status = 'RESERVED'
-        AND reservation_time IS NOT NULL
-        AND event_id = ?
-    """, (event_id,))
-    
-    reserved_tickets = cur.fetchall()
-    print(f"Found {len(reserved_tickets)} reserved tickets for this event:")
-    for ticket in reserved_tickets:
-        print(f"  - Row {ticket['row_name']}, Seat {ticket['seat_number']}")
-        print(f"    Reserved at: {ticket['reservation_time']}")
-        print(f"    SQLite now: {ticket['sqlite_current_time']}")
-    
-    # Unreserve expired ones - let SQLite handle the datetime comparison
-    cur.execute("""
-        UPDATE Tickets
-        SET status = 'AVAILABLE',
-            user_id = NULL,
-            reservation_time = NULL
-        WHERE status = 'RESERVED'
-        AND reservation_time IS NOT NULL
-        AND datetime(reservation_time) < datetime('now', '-1 minute')
-        AND event_id = ?
-    """, (event_id,))
-    
-    rows_updated = cur.rowcount
-    if rows_updated > 0:
-        print(f"✓ Unreserved {rows_updated} expired tickets")
-    else:
-        print(f"No expired tickets to unreserve")
-    
-    conn.commit()
-    
-    # Then fetch the availability
-    cur.execute("""
-        SELECT t.row_name, t.seat_number, t.status, tp.price_cents
-        FROM Tickets t
-        JOIN Ticket_Prices tp ON t.event_id = tp.event_id AND t.row_name = tp.row_name
-        WHERE t.event_id = ?
-    """, (event_id,))
-
-    event_seats = cur.fetchall()
-    conn.close()
+    return jsonify({'templates': venues.list_templates(conn)}), 200
 
-    # Build nested dictionary
-    availability_dict = {}
-    for seat in event_seats:
-        row = seat['row_name']
-        seat_num = seat['seat_number']
-        status = seat['status']
-        price_cents = seat['price_cents']
-        price_dollars = price_cents / 100.0
+@app.route('/events/<int:event_id>/hold_ttl', methods=['PUT'])
+@jwt_required()
+def set_hold_ttl(event_id):
+    claims = get_jwt()
+    if claims['role'] != 'admin':
+        return jsonify({'error': 'Admin access required'}), 403
 
-        if row not in availability_dict:
-            availability_dict[row] = {}
+    ttl_seconds = request.json.get('ttl_seconds')
+    if not isinstance(ttl_seconds, int) or ttl_seconds <= 0:
+        return jsonify({'error': 'ttl_seconds must be a positive integer'}), 400
 
-        availability_dict[row][seat_num] = {
-            'status': status,
-            'price': price_dollars
-        }
+    try:
+        conn = get_db_connection()
+        expiry.sweeper.set_ttl(conn, event_id, ttl_seconds)
+        return jsonify({'message': 'Hold time updated', 'ttl_seconds': ttl_seconds}), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
 
-    return jsonify(availability_dict), 200
+@app.route('/events/<int:event_id>/queue', methods=['PUT'])
+@jwt_required()
+def configure_queue(event_id):
+    claims = get_jwt()
+    if claims['role'] != 'admin':
+        return jsonify({'error': 'Admin access required'}), 403
 
-@app.route('/reserve_seat/<int:event_id>/<string:row_name>/<int:seat_number>/<int:user_id>', methods=['PUT'])
+    # {"enabled": true, "rate": 50, "burst": 50, "admission_ttl": 600}, anything left out uses the defaults
+    data = request.json
+    try:
+        settings = waiting_room.room.configure(event_id, enabled=data.get('enabled', True), rate=data.get('rate'),
+                                               burst=data.get('burst'), admission_ttl=data.get('admission_ttl'))
+    except (waiting_room.QueueError, TypeError, ValueError) as e:
+        return jsonify({'error': str(e)}), 400
+
+    if settings is None:
+        return jsonify({'message': 'Waiting room disabled'}), 200
+    return jsonify({'message': 'Waiting room enabled', 'rate': settings['rate'], 'burst': settings['burst'],
+                    'admission_ttl': settings['admission_ttl']}), 200
+
+@app.route('/events/<int:event_id>/queue', methods=['POST'])
 @jwt_required()
-def reserve_seat(event_id, row_name, seat_number, user_id):
-    conn = get_db_connection()
-    cur = conn.cursor()
+def join_queue(event_id):
+    # Returns the queue token to send as X-Queue-Token, plus position and ETA
+    if not waiting_room.room.enabled(event_id):
+        return jsonify({'error': 'This event has no waiting room'}), 404
+    try:
+        return jsonify(waiting_room.room.join(event_id, get_jwt_identity())), 200
+    except waiting_room.QueueError as e:
+        return jsonify({'error': str(e)}), 404
 
+@app.route('/events/<int:event_id>/queue', methods=['GET'])
+@jwt_required()
+def get_queue_status(event_id):
+    # Poll with the token from join_queue until status is "admitted"
+    token = request.headers.get(waiting_room.TOKEN_HEADER) or request.args.get('token')
     try:
-        cur.execute("""
-            UPDATE Tickets
-            SET status = 'RESERVED',
-            reservation_time = CURRENT_TIMESTAMP
-            WHERE event_id = ? AND row_name = ? AND seat_number = ?
-        """, (event_id, row_name, seat_number))
+        return jsonify(waiting_room.room.status(token, event_id, get_jwt_identity())), 200
+    except waiting_room.QueueError as e:
+        return jsonify({'error': str(e)}), 403
 
-        if cur.rowcount == 0:
-            conn.close()
-            return jsonify({"error": "Seat not found or already reserved"}), 404
+@app.route('/get_ticket_availability/<int:event_id>', methods=['GET'])
+@jwt_required()
+def get_ticket_availability(event_id):
+    # Read only. Expired holds are released by the background sweeper in expiry.py
+    # and the seat map itself is served from seat_cache.py, loaded through a read-only connection
+    # The stream version is read first, so the map is at least that new and a
+    # client resuming from it can only see a change twice, never miss one
+    stream_version = seat_stream.hub.version(event_id)
+    conn = shards.get_read_connection(event_id)
+    seat_map = seat_cache.cache.get(conn, event_id)
+    etag, body = seat_cache.cache.render(seat_map, app.json.dumps)
+
+    # The client already has this version of the map
+    if request.if_none_match.contains(etag):
+        response = make_response('', 304)
+    else:
+        response = app.response_class(body, status=200, mimetype='application/json')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    # Clients that also listen to /seat_stream can resume deltas from here
+    response.headers['X-Seat-Stream-Version'] = str(stream_version)
+    return response
+
+@app.route('/events/<int:event_id>/best_available', methods=['GET'])
+@jwt_required()
+def get_best_available(event_id):
+    # ?quantity=4&prefer=price|proximity&limit=3&max_price_cents=5000
+    # Hold the returned seats with POST /holds; someone may still beat you to them.
+    quantity = request.args.get('quantity', 1, type=int)
+    prefer = request.args.get('prefer', 'price')
+    limit = request.args.get('limit', 1, type=int)
+    max_price_cents = request.args.get('max_price_cents', type=int)
+    if not 1 <= quantity <= seat_finder.MAX_QUANTITY:
+        return jsonify({'error': f'quantity must be between 1 and {seat_finder.MAX_QUANTITY}'}), 400
+    if prefer not in seat_finder.PREFERENCES:
+        return jsonify({'error': f"prefer must be one of {', '.join(seat_finder.PREFERENCES)}"}), 400
+    limit = max(1, min(limit, seat_finder.MAX_BLOCKS))
+
+    conn = shards.get_read_connection(event_id)
+    seat_map = seat_cache.cache.get(conn, event_id)
+    blocks = seat_cache.cache.query(seat_map, seat_finder.find_blocks, quantity, prefer, limit, max_price_cents)
+    return jsonify({'event_id': event_id, 'quantity': quantity, 'blocks': blocks}), 200
+
+@app.route('/events/<int:event_id>/seat_stream', methods=['GET'])
+@jwt_required(locations=['headers', 'query_string'])  # EventSource can't send headers, so ?jwt=<token> is allowed here
+def get_seat_stream(event_id):
+    # Server-Sent Events with one message per seat status change. Pass ?since=<version>
+    # to resume without gaps. EventSource reconnects to the same URL, so the
+    # Last-Event-ID it sends (the last event it got) wins over ?since=.
+    since = request.headers.get('Last-Event-ID', type=int)
+    if since is None:
+        since = request.args.get('since', type=int)
+
+    response = app.response_class(seat_stream.hub.subscribe(event_id, since), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
 
-        conn.commit()
-        conn.close()
+@app.route('/reserve_seat/<int:event_id>/<string:row_name>/<int:seat_number>/<int:user_id>', methods=['PUT'])
+@jwt_required()
+def reserve_seat(event_id, row_name, seat_number, user_id):
+    # The seat is always held for the logged in user
+    if str(user_id) != str(get_jwt_identity()):
+        return jsonify({"error": "Cannot reserve seats for another user"}), 403
 
+    # Hot events only let in callers the waiting room has admitted
+    try:
+        waiting_room.room.check(request.headers.get(waiting_room.TOKEN_HEADER), event_id, user_id)
+    except waiting_room.QueueError as e:
+        return queue_error_response(e)
+
+    try:
+        conn = shards.get_connection(event_id)
+        reservations.reserve_seat(conn, event_id, row_name, seat_number, user_id)
         return jsonify({"message": "Seat reserved successfully"}), 200
+
+    except reservations.SeatNotFound as e:
+        return jsonify({"error": str(e)}), 404
+    except reservations.SeatConflict as e:
+        return jsonify({"error": str(e)}), 409
+    except reservations.WriteContention as e:
+        return jsonify({"error": str(e)}), 503
     except Exception as e:
-        conn.close()
         return jsonify({"error": str(e)}), 500
 
 @app.route('/unreserve_seat/<int:event_id>/<string:row_name>/<int:seat_number>/<int:user_id>', methods=['PUT'])
 @jwt_required()
-def unreserve_seat(event_id, row_name, seat_number):
-    conn = get_db_connection()
-    cur = conn.cursor()
+def unreserve_seat(event_id, row_name, seat_number, user_id):
+    if str(user_id) != str(get_jwt_identity()):
+        return jsonify({"error": "Cannot unreserve seats for another user"}), 403
 
     try:
-        cur.execute("""
-            UPDATE Tickets
-            SET status = 'AVAILABLE',
-            reservation_time = NULL,
-            user_id = NULL
-            WHERE event_id = ? AND row_name = ? AND seat_number = ?
-        """, (event_id, row_name, seat_number))
+        conn = shards.get_connection(event_id)
+        reservations.release_seat(conn, event_id, row_name, seat_number, user_id)
+        return jsonify({"message": "Seat unreserved successfully"}), 200
 
-        if cur.rowcount == 0:
-            conn.close()
-            return jsonify({"error": "Seat not found or already available"}), 404
+    except reservations.SeatNotFound as e:
+        return jsonify({"error": str(e)}), 404
+    except reservations.SeatConflict as e:
+        return jsonify({"error": str(e)}), 409
+    except reservations.WriteContention as e:
+        return jsonify({"error": str(e)}), 503
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
 
-        conn.commit()
-        conn.close()
+@app.route('/holds', methods=['POST'])
+@jwt_required()
+def create_hold():
+    # {"event_id": 1, "seats": [{"row_name": "A", "seat_number": 1}, ...]}. Every seat is held or none are.
+    user_id = get_jwt_identity()
+    event_id = request.json.get('event_id')
+    if not event_id:
+        return jsonify({'error': 'Must provide an event_id'}), 400
+    try:
+        seats = carts.parse_seats(request.json.get('seats'))
+    except reservations.SeatNotFound as e:
+        return jsonify({'error': str(e)}), 404
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
 
-        return jsonify({"message": "Seat unreserved successfully"}), 200
+    try:
+        waiting_room.room.check(request.headers.get(waiting_room.TOKEN_HEADER), event_id, user_id)
+    except waiting_room.QueueError as e:
+        return queue_error_response(e)
+
+    try:
+        conn = shards.get_connection(event_id)
+        return jsonify(carts.create_hold(conn, event_id, seats, user_id)), 201
+
+    except reservations.SeatNotFound as e:
+        return jsonify({'error': str(e)}), 404
+    except reservations.SeatConflict as e:
+        return jsonify({'error': str(e)}), 409
+    except reservations.WriteContention as e:
+        return jsonify({'error': str(e)}), 503
     except Exception as e:
-        conn.close()
-        return jsonify({"error": str(e)}), 500
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/holds/<int:hold_id>', methods=['GET'])
+@jwt_required()
+def get_hold(hold_id):
+    try:
+        conn = shards.get_shard_connection(shards.shard_of(hold_id))
+        return jsonify(carts.get_hold(conn, hold_id, get_jwt_identity())), 200
+    except carts.HoldNotFound as e:
+        return jsonify({'error': str(e)}), 404
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/holds/<int:hold_id>', methods=['DELETE'])
+@jwt_required()
+def release_hold(hold_id):
+    try:
+        conn = shards.get_shard_connection(shards.shard_of(hold_id))
+        released = carts.release_hold(conn, hold_id, get_jwt_identity())
+        return jsonify({'message': 'Hold released', 'released': released}), 200
+
+    except carts.HoldNotFound as e:
+        return jsonify({'error': str(e)}), 404
+    except reservations.SeatConflict as e:
+        return jsonify({'error': str(e)}), 409
+    except reservations.WriteContention as e:
+        return jsonify({'error': str(e)}), 503
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/holds/<int:hold_id>/checkout', methods=['POST'])
+@jwt_required()
+def checkout_hold(hold_id):
+    # {"payment_intent_id": "..."} for exactly the hold's total_cents
+    try:
+        conn = shards.get_shard_connection(shards.shard_of(hold_id))
+        ticket_ids = carts.checkout(conn, hold_id, get_jwt_identity(), request.json.get('payment_intent_id'))
+        return jsonify({'message': 'Tickets successfully purchased', 'ticket_ids': ticket_ids}), 200
+
+    except carts.HoldNotFound as e:
+        return jsonify({'error': str(e)}), 404
+    except payments.PaymentsUnavailable as e:
+        return jsonify({'error': str(e)}), 503
+    except payments.PaymentError as e:
+        return jsonify({'error': str(e)}), 402
+    except reservations.SeatConflict as e:
+        return jsonify({'error': str(e)}), 409
+    except reservations.WriteContention as e:
+        return jsonify({'error': str(e)}), 503
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/create-payment-intent', methods=['POST'])
+@jwt_required()
+def create_payment_intent():
+    # Called by the checkout form with the order total in cents
+    amount = request.json.get('amount')
+    try:
+        intent = payments.provider.create_intent(amount, metadata={'user_id': str(get_jwt_identity())})
+    except payments.PaymentsUnavailable as e:
+        return jsonify({'error': str(e)}), 503
+    except payments.PaymentError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'clientSecret': intent['client_secret'], 'paymentIntentId': intent['id'],
+                    'amount': intent['amount'], 'status': intent['status']}), 200
+
+@app.route('/payments/<string:intent_id>/confirm', methods=['POST'])
+@jwt_required()
+def confirm_payment(intent_id):
+    # Only for the local stand-in provider, a real one confirms on its own side
+    if not isinstance(payments.provider, payments.LocalPaymentProvider):
+        return jsonify({'error': 'Not available with this payment provider'}), 404
+    try:
+        payments.verify_owner(intent_id, get_jwt_identity())
+        intent = payments.provider.confirm(intent_id)
+    except payments.PaymentError as e:
+        return jsonify({'error': str(e)}), 404
+    return jsonify({'paymentIntentId': intent['id'], 'status': intent['status']}), 200
+
+@app.route('/complete-purchase', methods=['POST'])
+@jwt_required()
+def complete_purchase():
+    # {"paymentIntentId": "...", "seats": [{"event_id": 1, "row_name": "A", "seat_number": 1}, ...]}
+    # All the seats are sold together or not at all.
+    user_id = get_jwt_identity()
+    seats = request.json.get('seats') or []
+    event_ids = {seat.get('event_id') for seat in seats if isinstance(seat, dict)}
+    if len(event_ids) != 1 or None in event_ids:
+        return jsonify({'error': 'All seats must have the same event_id'}), 400
+    event_id = event_ids.pop()
+    try:
+        seats = carts.parse_seats(seats)
+    except reservations.SeatNotFound as e:
+        return jsonify({'error': str(e)}), 404
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    try:
+        waiting_room.room.check(request.headers.get(waiting_room.TOKEN_HEADER), event_id, user_id)
+    except waiting_room.QueueError as e:
+        return queue_error_response(e)
+
+    try:
+        conn = shards.get_connection(event_id)
+        ticket_ids = carts.purchase(conn, event_id, seats, user_id, request.json.get('paymentIntentId'))
+        return jsonify({'message': 'Tickets successfully purchased', 'ticket_ids': ticket_ids}), 200
+
+    except payments.PaymentsUnavailable as e:
+        return jsonify({'error': str(e)}), 503
+    except payments.PaymentError as e:
+        return jsonify({'error': str(e)}), 402
+    except reservations.SeatNotFound as e:
+        return jsonify({'error': str(e)}), 404
+    except reservations.SeatConflict as e:
+        return jsonify({'error': str(e)}), 409
+    except reservations.WriteContention as e:
+        return jsonify({'error': str(e)}), 503
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/events/<int:event_id>/scan', methods=['POST'])
+@jwt_required()
+def scan_ticket(event_id):
+    # Door scanners: {"barcode": "...", "gate": "North"}. Each ticket gets in once.
+    claims = get_jwt()
+    if claims['role'] != 'admin':
+        return jsonify({'error': 'Admin access required'}), 403
+
+    barcode = request.json.get('barcode')
+    if not isinstance(barcode, str) or not barcode:
+        return jsonify({'error': 'Must provide a barcode'}), 400
+
+    try:
+        conn = shards.get_connection(event_id)
+        result = gate.index.scan(conn, event_id, barcode, request.json.get('gate'))
+        status = {gate.ACCEPTED: 200, gate.ALREADY_USED: 409, gate.NOT_SOLD: 409}.get(result['result'], 404)
+        return jsonify(result), status
+
+    except reservations.WriteContention as e:
+        return jsonify({'error': str(e)}), 503
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/events/<int:event_id>/gate_bundle', methods=['GET'])
+@jwt_required()
+def get_gate_bundle(event_id):
+    # Bloom filter of the sold barcodes for scanners that may go offline, see gate.py
+    claims = get_jwt()
+    if claims['role'] != 'admin':
+        return jsonify({'error': 'Admin access required'}), 403
+
+    try:
+        conn = shards.get_connection(event_id)
+        return jsonify(gate.index.bundle(conn, event_id)), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/events/<int:event_id>/scans/sync', methods=['POST'])
+@jwt_required()
+def sync_scans(event_id):
+    # {"scans": [{"barcode": "...", "scanned_at": 1767225600, "gate": "North"}, ...]} from a scanner
+    # that was offline. Scans are applied in scanned_at order; ones beaten by an earlier
+    # check-in come back in "conflicts".
+    claims = get_jwt()
+    if claims['role'] != 'admin':
+        return jsonify({'error': 'Admin access required'}), 403
+
+    scans = request.json.get('scans')
+    if not isinstance(scans, list) or not scans:
+        return jsonify({'error': 'Must provide a list of scans'}), 400
+    try:
+        scans = [(scan['barcode'], gate.parse_scanned_at(scan['scanned_at']), scan.get('gate')) for scan in scans]
+    except (gate.ScanError, KeyError, TypeError, AttributeError) as e:
+        return jsonify({'error': f'Each scan needs a barcode and scanned_at: {e}'}), 400
+
+    try:
+        conn = shards.get_connection(event_id)
+        results, conflicts = gate.index.sync(conn, event_id, scans)
+        accepted = sum(result['result'] == gate.ACCEPTED for result in results)
+        return jsonify({'accepted': accepted, 'results': results, 'conflicts': conflicts}), 200
+
+    except gate.ScanError as e:
+        return jsonify({'error': str(e)}), 400
+    except reservations.WriteContention as e:
+        return jsonify({'error': str(e)}), 503
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    # Prometheus scrape endpoint, see metrics.py
+    gauges = {f'tessera_db_pool_{name}': value for name, value in db.pool.stats().items()}
+    gauges.update({f'tessera_db_read_pool_{name}': value for name, value in db.read_pool.stats().items()})
+    gauges.update({f'tessera_read_snapshot_{name}': value for name, value in snapshots.snapshot.stats.items()})
+    gauges.update({f'tessera_db_write_{name}': value for name, value in reservations.stats().items()})
+    if group_commit.writer is not None:
+        gauges.update({f'tessera_group_commit_{name}': value for name, value in group_commit.stats().items()})
+    gauges.update({f'tessera_shards_{name}': int(value) for name, value in shards.router.stats().items()})
+    return app.response_class(metrics.render(gauges), mimetype='text/plain; version=0.0.4')
+
+@app.route('/events/<int:event_id>/sales', methods=['GET'])
+@jwt_required()
+def get_event_sales(event_id):
+    # Available/reserved/sold, occupancy and revenue for the event and each row, see sales.py
+    claims = get_jwt()
+    if claims['role'] != 'admin':
+        return jsonify({'error': 'Admin access required'}), 403
+
+    try:
+        summary = sales.event_summary(shards.get_read_connection(event_id), event_id)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    if summary is None:
+        # No tickets yet, or no such event
+        event = db.get_read_connection().execute(
+            'SELECT 1 FROM Events WHERE event_id = ?', (event_id,)).fetchone()
+        if event is None:
+            return jsonify({'error': 'Event not found'}), 404
+        summary = sales.empty_summary(event_id)
+    return jsonify(summary), 200
+
+@app.route('/events/<int:event_id>/sales/velocity', methods=['GET'])
+@jwt_required()
+def get_event_sales_velocity(event_id):
+    # ?bucket_seconds=60&buckets=60: holds, sales and revenue per bucket, oldest first
+    claims = get_jwt()
+    if claims['role'] != 'admin':
+        return jsonify({'error': 'Admin access required'}), 403
+
+    bucket_seconds = request.args.get('bucket_seconds', sales.BUCKET_SECONDS, type=int)
+    buckets = request.args.get('buckets', 60, type=int)
+    if bucket_seconds < 1 or not 1 <= buckets <= sales.MAX_BUCKETS:
+        return jsonify({'error': f'bucket_seconds must be positive and buckets between 1 and {sales.MAX_BUCKETS}'}), 400
+
+    try:
+        conn = shards.get_read_connection(event_id)
+        return jsonify(sales.velocity(conn, event_id, bucket_seconds, buckets)), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/sales', methods=['GET'])
+@jwt_required()
+def get_sales():
+    # Totals of every event, across the shards
+    claims = get_jwt()
+    if claims['role'] != 'admin':
+        return jsonify({'error': 'Admin access required'}), 403
+
+    try:
+        conns = (shards.get_shard_connection(shard_id, read_only=True) for shard_id in shards.router.shard_ids())
+        return jsonify({'events': sales.all_events(conns)}), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/db/stats', methods=['GET'])
+def get_db_stats():
+    # Connection pool and write path counters for monitoring
+    stats = db.pool.stats()
+    stats['writes'] = reservations.stats()
+    if group_commit.writer is not None:
+        stats['group_commit'] = group_commit.stats()
+    stats['shards'] = shards.router.stats()
+    stats['read_pool'] = db.read_pool.stats()
+    stats['gate'] = gate.index.stats
+    stats['read_snapshot'] = dict(snapshots.snapshot.stats, enabled=snapshots.snapshot.enabled,
+                                  age_seconds=snapshots.snapshot.age())
+    return jsonify(stats), 200
 
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
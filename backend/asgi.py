@@ -0,0 +1,372 @@
+import asyncio
+import re
+import sys
+import tempfile
+from urllib.parse import parse_qs, parse_qsl
+
+from flask_jwt_extended import decode_token
+from werkzeug.http import parse_etags, quote_etag
+
+import aiodb
+import db
+import expiry
+import response_cache
+import seat_cache
+import seat_stream
+import shards
+import snapshots
+import waiting_room
+from app import app
+
+# ASGI entry point for on-sale traffic:
+#
+#   cd backend && uvicorn asgi:application --host 0.0.0.0 --port 5000
+#
+# app.run() gives every open connection its own thread, so thousands of
+# browsers sitting on /seat_stream (or polling availability) means thousands
+# of threads. Here connections live on one event loop instead:
+#
+# - The routes that mostly wait (seat_stream) or are served from memory
+#   (get_ticket_availability, the waiting room status, cached catalog pages)
+#   have native async handlers below. They only take the happy path;
+#   anything unusual (missing or bad token, errors, cache misses) is handed to
+#   the Flask route so responses stay exactly the same.
+# - Every other route runs the unchanged Flask app on aiodb's worker threads,
+#   so at most ASGI_DB_WORKERS requests are touching SQLite at once and the
+#   rest wait as cheap coroutines.
+#
+# Native handlers don't go through Flask's request hooks, so they don't show
+# up in /metrics.
+
+BUFFER_SIZE = 64 * 1024         # bytes of a Flask response pulled per worker hop
+MAX_MEMORY_BODY = 1024 * 1024   # request bodies bigger than this are spooled to disk
+
+_routes = []
+
+
+def route(pattern, method='GET'):
+    """Register a native handler: async fn(scope, receive, send, **groups) -> True if it answered."""
+    def register(handler):
+        _routes.append((re.compile(pattern + '$'), method, handler))
+        return handler
+    return register
+
+
+# -- helpers for native handlers ---------------------------------------------
+
+def header(scope, name):
+    name = name.encode()
+    for key, value in scope['headers']:
+        if key == name:
+            return value.decode('latin-1')
+    return None
+
+
+def query_arg(scope, name):
+    values = parse_qs(scope['query_string'].decode('latin-1')).get(name)
+    return values[0] if values else None
+
+
+def identity(scope, query_string=False):
+    """JWT identity the way @jwt_required() would find it, or None to let Flask answer."""
+    token = None
+    authorization = header(scope, 'authorization')
+    if authorization:
+        parts = authorization.split()
+        if len(parts) == 2 and parts[0] == 'Bearer':
+            token = parts[1]
+    if token is None and query_string:
+        token = query_arg(scope, app.config.get('JWT_QUERY_STRING_NAME', 'jwt'))
+    if token is None:
+        return None
+    try:
+        with app.app_context():
+            decoded = decode_token(token)
+    except Exception:
+        return None
+    if decoded.get('type') != 'access':
+        return None
+    return decoded.get(app.config.get('JWT_IDENTITY_CLAIM', 'sub'))
+
+
+def cors_headers(scope):
+    # Same as CORS(app) in app.py: echo the origin back
+    origin = header(scope, 'origin')
+    return [(b'access-control-allow-origin', (origin or '*').encode('latin-1')), (b'vary', b'Origin'),
+            (b'access-control-expose-headers', b'X-Seat-Stream-Version')]
+
+
+async def respond(send, scope, status, body=b'', headers=()):
+    headers = list(headers) + cors_headers(scope)
+    if status != 304:
+        headers.append((b'content-length', str(len(body)).encode()))
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def wait_for_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+async def stream(send, receive, chunks):
+    # Send chunks from an async generator until it ends or the client goes away
+    async def pump():
+        async for chunk in chunks:
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+
+    tasks = [asyncio.ensure_future(pump()), asyncio.ensure_future(wait_for_disconnect(receive))]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await chunks.aclose()
+
+
+# -- native routes -----------------------------------------------------------
+
+@route(r'/events/(?P<event_id>\d+)/seat_stream')
+async def get_seat_stream(scope, receive, send, event_id):
+    if identity(scope, query_string=True) is None:
+        return False
+    # Last-Event-ID first, see app.py
+    since = None
+    for value in (header(scope, 'last-event-id'), query_arg(scope, 'since')):
+        try:
+            since = int(value)
+            break
+        except (TypeError, ValueError):
+            pass  # same as request.args.get(type=int)
+
+    await send({'type': 'http.response.start', 'status': 200, 'headers': [
+        (b'content-type', b'text/event-stream; charset=utf-8'),
+        (b'cache-control', b'no-cache'),
+        (b'x-accel-buffering', b'no'),
+    ] + cors_headers(scope)})
+    await stream(send, receive, seat_stream.hub.subscribe_async(int(event_id), since))
+    return True
+
+
+@route(r'/get_ticket_availability/(?P<event_id>\d+)')
+async def get_ticket_availability(scope, receive, send, event_id):
+    if identity(scope) is None:
+        return False
+    event_id = int(event_id)
+    stream_version = seat_stream.hub.version(event_id)  # before the map, see app.py
+    try:
+        # Cache hits never leave the event loop
+        seat_map = seat_cache.cache.peek(event_id) or await aiodb.read_for_event(event_id, seat_cache.cache.get, event_id)
+        etag, body = seat_cache.cache.render(seat_map, app.json.dumps)
+    except Exception:
+        return False
+
+    headers = [
+        (b'etag', quote_etag(etag).encode()),
+        (b'cache-control', b'no-cache'),
+        (b'x-seat-stream-version', str(stream_version).encode()),
+    ]
+    if parse_etags(header(scope, 'if-none-match')).contains(etag):
+        await respond(send, scope, 304, headers=headers)
+    else:
+        body = body.encode() if isinstance(body, str) else body
+        await respond(send, scope, 200, body, headers + [(b'content-type', b'application/json')])
+    return True
+
+
+@route(r'/events/(?P<event_id>\d+)/queue')
+async def get_queue_status(scope, receive, send, event_id):
+    # Everyone in a waiting room polls this, and it never needs the database
+    user_id = identity(scope)
+    if user_id is None:
+        return False
+    token = header(scope, waiting_room.TOKEN_HEADER.lower()) or query_arg(scope, 'token')
+    try:
+        status = waiting_room.room.status(token, int(event_id), user_id)
+    except waiting_room.QueueError:
+        return False
+    await respond(send, scope, 200, app.json.dumps(status, separators=(',', ':')).encode() + b'\n',
+                  [(b'content-type', b'application/json')])
+    return True
+
+
+@route(r'/events(?:/(?P<event_id>\d+))?')
+async def get_cached_events(scope, receive, send, event_id=None):
+    # Catalog pages already in response_cache.py never need a worker thread
+    args = parse_qsl(scope['query_string'].decode('latin-1'), keep_blank_values=True)
+    entry = response_cache.cache.lookup(response_cache.cache_key(scope['path'], args))
+    if entry is None:
+        return False
+    headers = [(name.lower().encode(), value.encode()) for name, value in response_cache.cache.headers(entry).items()]
+    if response_cache.cache.is_fresh(entry, header(scope, 'if-none-match'), header(scope, 'if-modified-since')):
+        await respond(send, scope, 304, headers=headers)
+    else:
+        await respond(send, scope, 200, entry.body, headers + [(b'content-type', entry.mimetype.encode())])
+    return True
+
+
+# -- everything else: the Flask app on a worker thread -----------------------
+
+def _environ(scope, body):
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode().decode('latin-1'),
+        'PATH_INFO': scope['path'].encode().decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+        'wsgi.input_terminated': True,  # the whole body is already buffered
+    }
+    for key, value in scope['headers']:
+        name = key.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_TYPE' or name == 'CONTENT_LENGTH':
+            environ[name] = value
+            continue
+        name = 'HTTP_' + name
+        environ[name] = environ[name] + ',' + value if name in environ else value
+    return environ
+
+
+def _pull(chunks, buffered=b''):
+    # Read ahead up to BUFFER_SIZE so ordinary responses are a single hop.
+    # Returns (body so far, whether there is more)
+    parts = [buffered] if buffered else []
+    size = len(buffered)
+    for chunk in chunks:
+        if chunk:
+            parts.append(chunk)
+            size += len(chunk)
+            if size >= BUFFER_SIZE:
+                return b''.join(parts), True
+    return b''.join(parts), False
+
+
+def _start(environ):
+    # Runs on a worker thread
+    response = {}
+    written = []
+
+    def start_response(status, headers, exc_info=None):
+        if exc_info and response:
+            raise exc_info[1].with_traceback(exc_info[2])
+        response['status'] = int(status.split(' ', 1)[0])
+        response['headers'] = [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                               for name, value in headers]
+        return written.append
+
+    iterable = app.wsgi_app(environ, start_response)
+    try:
+        chunks = iter(iterable)
+        body, more = _pull(chunks)
+    except BaseException:
+        if hasattr(iterable, 'close'):
+            iterable.close()
+        raise
+    return response['status'], response['headers'], b''.join(written) + body, more, iterable, chunks
+
+
+def _close(iterable):
+    if hasattr(iterable, 'close'):
+        iterable.close()
+
+
+async def _read_body(receive):
+    body = tempfile.SpooledTemporaryFile(max_size=MAX_MEMORY_BODY)
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        body.write(message.get('body', b''))
+        if not message.get('more_body'):
+            body.seek(0)
+            return body
+
+
+async def call_flask(scope, receive, send):
+    body = await _read_body(receive)
+    if body is None:
+        return
+
+    try:
+        status, headers, chunk, more, iterable, chunks = await aiodb.run_sync(_start, _environ(scope, body))
+    finally:
+        body.close()
+
+    try:
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': chunk, 'more_body': more})
+        # Streamed responses (exports) keep a worker only while producing each chunk
+        while more:
+            chunk, more = await aiodb.run_sync(_pull, chunks)
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': more})
+    finally:
+        await aiodb.run_sync(_close, iterable)
+
+
+# -- the ASGI application ----------------------------------------------------
+
+def _startup():
+    # Flask starts the hold sweeper on its first request, which may never come
+    # if clients only hit the native routes
+    if app.config.get('RESERVATION_SWEEPER', True):
+        with expiry._start_lock:
+            expiry.sweeper.start()
+    with snapshots._start_lock:
+        snapshots.snapshot.start()
+
+
+def _shutdown():
+    expiry.sweeper.stop()
+    snapshots.snapshot.stop()
+    shards.router.close_all()
+    db.pool.close_all()
+    db.read_pool.close_all()
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            try:
+                await aiodb.run_sync(_startup)
+            except Exception as e:
+                await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+                return
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await aiodb.run_sync(_shutdown)
+            aiodb.shutdown()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] != 'http':
+        return
+
+    for pattern, method, handler in _routes:
+        if scope['method'] == method:
+            match = pattern.match(scope['path'])
+            if match and await handler(scope, receive, send, **match.groupdict()):
+                return
+    await call_flask(scope, receive, send)
+
+
+aiodb.init_app(app)
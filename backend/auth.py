@@ -0,0 +1,207 @@
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+# Password checks for login and the account endpoints.
+#
+# - The user row is fetched once and reused for the claims.
+# - Hashing runs on a small dedicated thread pool so a burst of logins can only
+#   use that many cores; once too many checks are queued we answer "busy"
+#   instead of letting request threads pile up behind them.
+# - Failed attempts are rate limited per username, so brute force traffic
+#   costs us a dictionary lookup instead of a hash.
+# - When the hash method changes, users are rehashed the next time they log in.
+
+DEFAULT_HASH_WORKERS = 4
+DEFAULT_MAX_PENDING = 64
+DEFAULT_HASH_TIMEOUT = 10.0
+DEFAULT_MAX_FAILURES = 5          # failed attempts allowed per username ...
+DEFAULT_FAILURE_WINDOW = 300.0    # ... within this many seconds
+DEFAULT_MAX_TRACKED = 10000       # usernames with recent failures we remember, least recent go first
+DEFAULT_BUSY_RETRY_AFTER = 1      # seconds clients are told to wait when hashing is saturated
+DEFAULT_HASH_METHOD = 'scrypt'    # werkzeug's default, change to move everyone to a new method
+
+USER_COLUMNS = 'user_id, username, email, first_name, last_name, role, avatar, password_hash'
+
+
+class TooManyAttempts(Exception):
+    """Too many failed logins for this username, try again later."""
+
+    def __init__(self, retry_after):
+        super().__init__('Too many failed attempts, try again later')
+        self.retry_after = retry_after
+
+
+class HashingBusy(Exception):
+    """The hashing pool is saturated, or a hash waited longer than the timeout."""
+
+    def __init__(self, message, retry_after=DEFAULT_BUSY_RETRY_AFTER):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class FailureLimiter:
+    """Sliding window of failed attempts per username.
+
+    Usernames are whatever clients send, so memory is bounded. Once a
+    username reaches max_failures it moves to a lockout table until its
+    window passes; that table can only grow by max_failures requests per
+    entry. The others are dropped once their last failure is outside the
+    window, and past max_tracked the least recently failed go first.
+    """
+
+    def __init__(self, max_failures=DEFAULT_MAX_FAILURES, window=DEFAULT_FAILURE_WINDOW,
+                 max_tracked=DEFAULT_MAX_TRACKED):
+        self.max_failures = max_failures
+        self.window = window
+        self.max_tracked = max_tracked
+        self._failures = OrderedDict()  # username -> deque of failure times, least recently failed first
+        self._locked = OrderedDict()    # username -> monotonic time the lockout ends, roughly in that order
+        self._lock = threading.Lock()
+
+    def check(self, username):
+        now = time.monotonic()
+        with self._lock:
+            until = self._locked.get(username)
+            if until is not None:
+                if until > now:
+                    raise TooManyAttempts(int(until - now) + 1)
+                del self._locked[username]
+            failures = self._failures.get(username)
+            if not failures:
+                return
+            while failures and now - failures[0] > self.window:
+                failures.popleft()
+            if not failures:
+                del self._failures[username]
+
+    def record_failure(self, username):
+        now = time.monotonic()
+        with self._lock:
+            failures = self._failures.setdefault(username, deque())
+            failures.append(now)
+            self._failures.move_to_end(username)
+            while failures and now - failures[0] > self.window:
+                failures.popleft()
+            if len(failures) >= self.max_failures:
+                # Locked until the oldest failure in the window runs out
+                del self._failures[username]
+                self._locked.pop(username, None)
+                self._locked[username] = failures[0] + self.window
+
+            # Only the fronts (least recently failed, soonest to unlock) need looking at
+            while self._failures:
+                oldest, failures = next(iter(self._failures.items()))
+                if len(self._failures) <= self.max_tracked and now - failures[-1] <= self.window:
+                    break
+                del self._failures[oldest]
+            while self._locked:
+                oldest, until = next(iter(self._locked.items()))
+                if until > now:
+                    break
+                del self._locked[oldest]
+
+    def __len__(self):
+        with self._lock:
+            return len(self._failures) + len(self._locked)
+
+    def reset(self, username):
+        with self._lock:
+            self._failures.pop(username, None)
+            self._locked.pop(username, None)
+
+
+class Hasher:
+
+    def __init__(self, workers=DEFAULT_HASH_WORKERS, max_pending=DEFAULT_MAX_PENDING,
+                 timeout=DEFAULT_HASH_TIMEOUT, method=DEFAULT_HASH_METHOD):
+        self.method = method
+        self.timeout = timeout
+        self._prefix = None
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='password-hash')
+        self._slots = threading.BoundedSemaphore(max_pending)
+
+    def _run(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            raise HashingBusy('Too many logins in progress, try again shortly')
+        future = self._executor.submit(fn, *args)
+        try:
+            return future.result(self.timeout)
+        except FutureTimeout:
+            future.cancel()  # only helps if it hasn't started yet
+            raise HashingBusy('Password check timed out, try again shortly')
+        finally:
+            self._slots.release()
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method)
+
+    def verify(self, password_hash, password):
+        return self._run(check_password_hash, password_hash, password)
+
+    def needs_rehash(self, password_hash):
+        # werkzeug hashes look like "scrypt:32768:8:1$salt$hash". We learn the
+        # current prefix (method plus its parameters) from one sample hash.
+        if self._prefix is None:
+            self._prefix = self.hash('sample').split('$', 1)[0]
+        return password_hash.split('$', 1)[0] != self._prefix
+
+
+hasher = Hasher()
+limiter = FailureLimiter()
+
+
+def fetch_user(conn, username=None, email=None):
+    if username is not None:
+        cur = conn.execute(f'SELECT {USER_COLUMNS} FROM Users WHERE username = ?', (username,))
+    else:
+        cur = conn.execute(f'SELECT {USER_COLUMNS} FROM Users WHERE email = ?', (email,))
+    return cur.fetchone()
+
+
+def authenticate(conn, password, username=None, email=None):
+    """Return the user row if the password matches, otherwise None.
+
+    Raises TooManyAttempts or HashingBusy without touching the hash.
+    """
+    key = username if username is not None else email
+    limiter.check(key)
+
+    user = fetch_user(conn, username=username, email=email)
+    if user is None or not user['password_hash'] or not hasher.verify(user['password_hash'], password):
+        limiter.record_failure(key)
+        return None
+
+    limiter.reset(key)
+    if hasher.needs_rehash(user['password_hash']):
+        conn.execute('UPDATE Users SET password_hash = ? WHERE user_id = ?',
+                     (hasher.hash(password), user['user_id']))
+        conn.commit()
+    return user
+
+
+def claims_for(user):
+    return {
+        "username": user['username'],
+        "role": user['role'],
+        "email": user['email'],
+        "first_name": user['first_name'],
+        "last_name": user['last_name'],
+        "avatar": user['avatar']
+    }
+
+
+def init_app(app):
+    global hasher
+    hasher = Hasher(
+        workers=app.config.get('AUTH_HASH_WORKERS', DEFAULT_HASH_WORKERS),
+        max_pending=app.config.get('AUTH_MAX_PENDING_HASHES', DEFAULT_MAX_PENDING),
+        timeout=app.config.get('AUTH_HASH_TIMEOUT', DEFAULT_HASH_TIMEOUT),
+        method=app.config.get('AUTH_HASH_METHOD', DEFAULT_HASH_METHOD),
+    )
+    limiter.max_failures = app.config.get('AUTH_MAX_FAILURES', DEFAULT_MAX_FAILURES)
+    limiter.window = app.config.get('AUTH_FAILURE_WINDOW', DEFAULT_FAILURE_WINDOW)
+    limiter.max_tracked = app.config.get('AUTH_MAX_TRACKED_FAILURES', DEFAULT_MAX_TRACKED)
@@ -0,0 +1,104 @@
+# Concurrency stress test for the seat reservation engine.
+#
+# Spins up N threads that all race for the same small set of seats on a
+# throwaway database and checks that no seat was ever handed to two people.
+#
+#   cd backend && python bench/reservation_stress.py --clients 64 --seats 25
+
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import migrations # noqa: E402
+import reservations # noqa: E402
+import ticket_codes # noqa: E402
+from db import ConnectionPool # noqa: E402
+
+def seed(db_path, seats):
+    conn = sqlite3.connect(db_path)
+    migrations.migrate(conn)
+    conn.executemany(
+        "INSERT INTO Tickets (event_id, row_name, seat_number, status) VALUES (1, 'A', ?, ?)",
+        [(n, ticket_codes.AVAILABLE) for n in range(1, seats + 1)])
+    conn.commit()
+    conn.close()
+
+
+def run(clients, seats, rounds):
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, 'stress.db')
+        seed(db_path, seats)
+        pool = ConnectionPool(db_path=db_path, max_size=clients)
+
+        start_line = threading.Barrier(clients)
+        lock = threading.Lock()
+        wins = []        # (ticket_id, user_id) for every successful claim
+        outcomes = Counter()
+
+        def client(user_id):
+            start_line.wait()
+            for _ in range(rounds):
+                for seat in range(1, seats + 1):
+                    with pool.connection() as conn:
+                        try:
+                            # Half the clients reserve specific seats, half buy "any seat"
+                            if user_id % 2:
+                                ticket_id = reservations.reserve_seat(conn, 1, 'A', seat, user_id)
+                            else:
+                                ticket_id = reservations.buy_seat(conn, 1, user_id)
+                            with lock:
+                                wins.append((ticket_id, user_id))
+                                outcomes['won'] += 1
+                        except reservations.SeatConflict:
+                            with lock:
+                                outcomes['conflict'] += 1
+                        except reservations.SeatNotFound:
+                            with lock:
+                                outcomes['sold_out'] += 1
+                        except reservations.WriteContention:
+                            with lock:
+                                outcomes['busy'] += 1
+
+        threads = [threading.Thread(target=client, args=(n,)) for n in range(1, clients + 1)]
+        started = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - started
+
+        claims = Counter(ticket_id for ticket_id, _ in wins)
+        double_sold = {ticket_id: n for ticket_id, n in claims.items() if n > 1}
+
+        with pool.connection() as conn:
+            taken = conn.execute('SELECT COUNT(*) FROM Tickets WHERE status != ?', (ticket_codes.AVAILABLE,)).fetchone()[0]
+        pool.close_all()
+
+        attempts = sum(outcomes.values())
+        print(f'clients={clients} seats={seats} rounds={rounds}')
+        print(f'attempts={attempts} in {elapsed:.3f}s ({attempts / elapsed:.0f} ops/s)')
+        print(f'outcomes={dict(outcomes)}')
+        print(f'seats taken in db={taken}, successful claims={len(wins)}')
+        print(f'pool={pool.stats()}')
+
+        if double_sold or taken != len(wins):
+            print(f'FAIL: double-sold tickets {double_sold}')
+            return 1
+        print('OK: no seat was claimed twice')
+        return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Race many clients for the same seats and check for double sells')
+    parser.add_argument('--clients', type=int, default=32)
+    parser.add_argument('--seats', type=int, default=25)
+    parser.add_argument('--rounds', type=int, default=2)
+    args = parser.parse_args()
+    sys.exit(run(args.clients, args.seats, args.rounds))
@@ -0,0 +1,289 @@
+# Load test for the on-sale hot paths: GET /events, get_ticket_availability,
+# reserve_seat and buy_ticket.
+#
+# Seeds a fresh synthetic database, then drives the app with concurrent
+# clients either in-process (Flask test client) or over a local HTTP server,
+# and reports p50/p95/p99 latency, throughput, SQLITE_BUSY retries, lock wait
+# and a double-sell check.
+#
+#   cd backend && python bench/run.py --mode inprocess --clients 16 --duration 10
+#   cd backend && python bench/run.py --mode http --save-baseline bench/baseline.json
+#   cd backend && python bench/run.py --compare bench/baseline.json
+#   cd backend && python bench/run.py --group-commit --mix reserve=3,buy=1
+
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import Counter, defaultdict
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+
+from bench.seed import row_names, seed # noqa: E402
+
+DEFAULT_MIX = 'events=4,availability=3,reserve=2,buy=1'
+REGRESSION_THRESHOLD = 0.20  # flag anything 20% slower (or 20% less throughput) than the baseline
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        name, weight = part.split('=')
+        mix[name.strip()] = int(weight)
+    return mix
+
+
+class InProcessClient:
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, token=None, body=None):
+        headers = {'Authorization': f'Bearer {token}'} if token else {}
+        response = self.client.open(path, method=method, headers=headers, json=body)
+        return response.status_code, response.get_json(silent=True)
+
+
+class HttpClient:
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+
+    def request(self, method, path, token=None, body=None):
+        data = json.dumps(body).encode() if body is not None else None
+        req = urllib.request.Request(self.base_url + path, data=data, method=method)
+        if token:
+            req.add_header('Authorization', f'Bearer {token}')
+        if data is not None:
+            req.add_header('Content-Type', 'application/json')
+        try:
+            with urllib.request.urlopen(req, timeout=30) as response:
+                payload = response.read()
+                status = response.status
+        except urllib.error.HTTPError as e:
+            payload = e.read()
+            status = e.code
+        try:
+            return status, json.loads(payload) if payload else None
+        except ValueError:
+            return status, None
+
+
+def run(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, 'bench.db')
+        shard_dir = os.path.join(tmp, 'shards') if args.shards else None
+        dataset = seed(db_path, args.events, args.rows, args.seats, args.users, shard_dir=shard_dir)
+
+        # The app reads its database path (and group commit and sharding switches) at import time
+        os.environ['TESSERA_DB_PATH'] = db_path
+        if args.group_commit:
+            os.environ['TESSERA_GROUP_COMMIT'] = '1'
+        if args.shards:
+            os.environ['TESSERA_SHARDING'] = '1'
+            os.environ['TESSERA_SHARD_DIR'] = shard_dir
+        from app import app
+        import reservations
+        import db
+        import shards
+        import ticket_codes
+        from flask_jwt_extended import create_access_token
+
+        with app.app_context():
+            tokens = {user_id: create_access_token(identity=str(user_id),
+                                                   additional_claims={'role': 'user', 'username': f'user{user_id}'})
+                      for user_id in range(1, args.users + 1)}
+
+        server = None
+        if args.mode == 'http':
+            from werkzeug.serving import make_server
+            server = make_server('127.0.0.1', 0, app, threaded=True)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            base_url = f'http://127.0.0.1:{server.server_port}'
+
+        mix = parse_mix(args.mix)
+        ops = [name for name, weight in mix.items() for _ in range(weight)]
+        rows = row_names(args.rows)
+        hot_events = list(range(1, min(args.hot_events, args.events) + 1))
+
+        latencies = defaultdict(list)
+        statuses = defaultdict(Counter)
+        sold = []
+        lock = threading.Lock()
+        stop_at = [None]
+        start_line = threading.Barrier(args.clients + 1)
+
+        def client_loop(client_number):
+            client = InProcessClient(app) if server is None else HttpClient(base_url)
+            rng = random.Random(client_number)
+            start_line.wait()
+            while time.perf_counter() < stop_at[0]:
+                op = rng.choice(ops)
+                user_id = rng.randint(1, args.users)
+                token = tokens[user_id]
+                event_id = rng.choice(hot_events)
+
+                if op == 'events':
+                    path = f'/events?page={rng.randint(1, 3)}&limit=6'
+                    method, body, token = 'GET', None, None
+                elif op == 'availability':
+                    path = f'/get_ticket_availability/{event_id}'
+                    method, body = 'GET', None
+                elif op == 'reserve':
+                    path = f'/reserve_seat/{event_id}/{rng.choice(rows)}/{rng.randint(1, args.seats)}/{user_id}'
+                    method, body = 'PUT', None
+                else:
+                    path = '/buy_ticket'
+                    method, body = 'POST', {'event_id': event_id}
+
+                started = time.perf_counter()
+                status, payload = client.request(method, path, token, body)
+                elapsed = (time.perf_counter() - started) * 1000
+
+                with lock:
+                    latencies[op].append(elapsed)
+                    statuses[op][status] += 1
+                    if op == 'buy' and status == 200:
+                        sold.append(payload['ticket_id'])
+
+        threads = [threading.Thread(target=client_loop, args=(n,)) for n in range(args.clients)]
+        for t in threads:
+            t.start()
+        stop_at[0] = time.perf_counter() + args.duration
+        start_line.wait()
+        began = time.perf_counter()
+        for t in threads:
+            t.join()
+        wall = time.perf_counter() - began
+
+        if server is not None:
+            server.shutdown()
+
+        # Every successful purchase must be a different ticket, and the database
+        # must agree with what the clients were told
+        sold_in_db = 0
+        for pool in shards.router.pools():
+            with pool.connection() as conn:
+                sold_in_db += conn.execute('SELECT COUNT(*) FROM Tickets WHERE status = ?',
+                                           (ticket_codes.SOLD,)).fetchone()[0]
+        duplicates = [ticket_id for ticket_id, n in Counter(sold).items() if n > 1]
+        shards.router.close_all()
+        db.pool.close_all()
+
+        report = {
+            'mode': args.mode,
+            'group_commit': args.group_commit,
+            'shards': args.shards,
+            'clients': args.clients,
+            'duration_s': round(wall, 3),
+            'dataset': dataset,
+            'mix': mix,
+            'operations': {},
+            'write_path': reservations.stats(),
+            'pool': db.pool.stats(),
+            'double_sell': {
+                'purchases_reported': len(sold),
+                'sold_in_db': sold_in_db,
+                'duplicate_ticket_ids': duplicates,
+                'ok': not duplicates and sold_in_db == len(sold),
+            },
+        }
+        total = 0
+        for op, values in sorted(latencies.items()):
+            values.sort()
+            total += len(values)
+            report['operations'][op] = {
+                'requests': len(values),
+                'throughput_rps': round(len(values) / wall, 1),
+                'p50_ms': round(percentile(values, 50), 3),
+                'p95_ms': round(percentile(values, 95), 3),
+                'p99_ms': round(percentile(values, 99), 3),
+                'statuses': {str(code): n for code, n in sorted(statuses[op].items())},
+            }
+        report['throughput_rps'] = round(total / wall, 1)
+        return report
+
+
+def print_report(report):
+    print(f"mode={report['mode']} clients={report['clients']} duration={report['duration_s']}s "
+          f"throughput={report['throughput_rps']} req/s")
+    print(f"{'operation':<14}{'requests':>10}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}  statuses")
+    for op, stats in report['operations'].items():
+        print(f"{op:<14}{stats['requests']:>10}{stats['throughput_rps']:>10}{stats['p50_ms']:>10}"
+              f"{stats['p95_ms']:>10}{stats['p99_ms']:>10}  {stats['statuses']}")
+    print(f"write path: {report['write_path']}")
+    print(f"pool: waits={report['pool']['waits']} wait_time_ms={report['pool']['wait_time_ms']} "
+          f"created={report['pool']['created']}")
+    check = report['double_sell']
+    print(f"double-sell check: {'OK' if check['ok'] else 'FAIL'} "
+          f"(reported {check['purchases_reported']}, sold in db {check['sold_in_db']}, "
+          f"duplicates {check['duplicate_ticket_ids']})")
+
+
+def compare(report, baseline):
+    """Print the change against a saved baseline. Returns True if nothing regressed."""
+    ok = True
+    print(f"\ncompared with baseline (threshold {REGRESSION_THRESHOLD:.0%}):")
+    for op, stats in report['operations'].items():
+        before = baseline['operations'].get(op)
+        if not before:
+            continue
+        for key in ('p50_ms', 'p95_ms', 'p99_ms', 'throughput_rps'):
+            old, new = before[key], stats[key]
+            if not old:
+                continue
+            change = (new - old) / old
+            worse = change < -REGRESSION_THRESHOLD if key == 'throughput_rps' else change > REGRESSION_THRESHOLD
+            ok = ok and not worse
+            print(f"  {op:<14}{key:<16}{old:>10} -> {new:<10} {change:+.1%}{'  REGRESSION' if worse else ''}")
+    return ok
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the on-sale hot paths')
+    parser.add_argument('--mode', choices=('inprocess', 'http'), default='inprocess')
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--events', type=int, default=20)
+    parser.add_argument('--hot-events', type=int, default=2, help='how many events the traffic is spread over')
+    parser.add_argument('--rows', type=int, default=10)
+    parser.add_argument('--seats', type=int, default=20)
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--group-commit', action='store_true', help='batch seat writes, see group_commit.py')
+    parser.add_argument('--shards', action='store_true', help='one database file per event, see shards.py')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help=f'operation weights, default {DEFAULT_MIX}')
+    parser.add_argument('--save-baseline', metavar='PATH')
+    parser.add_argument('--compare', metavar='PATH')
+    parser.add_argument('--json', action='store_true', help='print the raw report as JSON')
+    args = parser.parse_args()
+
+    report = run(args)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+    exit_code = 0 if report['double_sell']['ok'] else 1
+    if args.compare:
+        with open(args.compare) as f:
+            if not compare(report, json.load(f)):
+                exit_code = 1
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'\nbaseline saved to {args.save_baseline}')
+    sys.exit(exit_code)
@@ -0,0 +1,109 @@
+# Builds a synthetic Tessera database for benchmarks.
+#
+#   cd backend && python bench/seed.py /tmp/bench.db --events 50 --rows 20 --seats 30 --users 2000
+#
+# With --shard-dir every event's seats go into a shard of their own there (see shards.py).
+
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import time
+import uuid
+
+from werkzeug.security import generate_password_hash
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import migrations # noqa: E402
+import shards # noqa: E402
+import ticket_codes # noqa: E402
+
+CITIES = ['New York', 'Los Angeles', 'Chicago', 'Houston', 'Phoenix', 'Seattle', 'Denver', 'Boston']
+ACTS = ['Orchestra', 'Jazz Night', 'Rock Tour', 'Comedy Hour', 'Opera', 'Hip Hop Live', 'Folk Fest', 'DJ Set']
+
+# Every synthetic user gets the same password so load tests can log in
+PASSWORD = 'benchmark'
+
+
+def row_names(count):
+    # A..Z, then AA, AB, ...
+    names = []
+    for i in range(count):
+        name = ''
+        i += 1
+        while i:
+            i, rem = divmod(i - 1, 26)
+            name = chr(65 + rem) + name
+        names.append(name)
+    return names
+
+
+def seed(db_path, events=20, rows=10, seats=20, users=500, seed_value=1, shard_dir=None):
+    rng = random.Random(seed_value)
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    if shard_dir is not None:
+        os.makedirs(shard_dir, exist_ok=True)
+
+    conn = sqlite3.connect(db_path)
+    migrations.migrate(conn)
+
+    # Hashing is the slow part, so every user shares one hash
+    password_hash = generate_password_hash(PASSWORD)
+    conn.executemany(
+        'INSERT INTO Users (email, first_name, last_name, username, password_hash, role) VALUES (?, ?, ?, ?, ?, ?)',
+        [(f'user{n}@example.com', 'Bench', f'User{n}', f'user{n}', password_hash, 'admin' if n == 1 else 'user')
+         for n in range(1, users + 1)])
+
+    conn.executemany(
+        'INSERT INTO Events (name, description, date, time, location, url) VALUES (?, ?, ?, ?, ?, ?)',
+        [(f'{rng.choice(ACTS)} {n}', f'Synthetic event number {n}',
+          f'2030-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}', '19:30',
+          rng.choice(CITIES), f'https://example.com/events/{n}')
+         for n in range(1, events + 1)])
+
+    names = row_names(rows)
+    for event_id in range(1, events + 1):
+        seat_conn = conn
+        if shard_dir is not None:
+            # Same layout as shards.ShardRouter.assign with one event per shard
+            conn.execute('INSERT INTO Event_Shards (event_id, shard_id) VALUES (?, ?)', (event_id, event_id))
+            path = shards.shard_path(shard_dir, event_id)
+            if os.path.exists(path):
+                os.remove(path)
+            seat_conn = sqlite3.connect(path)
+            shards.prepare(seat_conn, event_id)
+        seat_conn.executemany(
+            'INSERT INTO Tickets (event_id, row_name, seat_number, status, barcode) VALUES (?, ?, ?, ?, ?)',
+            [(event_id, row, seat, ticket_codes.AVAILABLE, str(uuid.uuid4()))
+             for row in names for seat in range(1, seats + 1)])
+        seat_conn.executemany(
+            'INSERT INTO Ticket_Prices (event_id, row_name, price_cents) VALUES (?, ?, ?)',
+            [(event_id, row, max(2000, 15000 - i * 1000)) for i, row in enumerate(names)])
+        if seat_conn is not conn:
+            seat_conn.commit()
+            seat_conn.close()
+
+    conn.commit()
+    conn.close()
+    return {'events': events, 'rows': rows, 'seats_per_row': seats, 'users': users,
+            'tickets': events * rows * seats}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Create a synthetic Tessera database')
+    parser.add_argument('db_path')
+    parser.add_argument('--events', type=int, default=20)
+    parser.add_argument('--rows', type=int, default=10)
+    parser.add_argument('--seats', type=int, default=20)
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--shard-dir', help='put each event in its own shard file here')
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    summary = seed(args.db_path, args.events, args.rows, args.seats, args.users, args.seed, args.shard_dir)
+    print(f'{summary} in {time.perf_counter() - started:.2f}s')
+    sys.exit(0)
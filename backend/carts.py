@@ -0,0 +1,229 @@
+import sqlite3 # Library for talking to our database
+import time
+from contextlib import contextmanager
+
+import db
+import expiry
+import payments
+import reservations
+import shards
+import ticket_codes
+from ticket_codes import AVAILABLE, RESERVED, SOLD
+
+# Multi-seat holds ("carts") and checkout.
+#
+# A hold claims all of its seats in one transaction or none of them, so a
+# group of six either gets six seats together or a clear error. The seats are
+# ordinary RESERVED tickets stamped with the same reservation_time, so they
+# share one expiry and the background sweeper releases them together. The
+# hold remembers that timestamp so a seat that expired and was grabbed again
+# is never mistaken for part of it.
+#
+# Checkout sells every seat in the hold, records the payment and closes the
+# hold in a single transaction. A payment id can only ever be used once.
+#
+# Holds live next to their tickets, so with sharding (shards.py) the caller
+# passes a connection to the event's shard, or to shard_of(hold_id) for an
+# existing hold.
+
+MAX_HOLD_SEATS = 20
+
+
+class HoldNotFound(Exception):
+    """No such hold for this user."""
+
+
+class HoldExpired(reservations.SeatConflict):
+    """The hold ran out (or was released) before checkout."""
+
+
+class SeatNotForSale(reservations.SeatConflict):
+    """A seat's row has no price yet, so it can't be bought."""
+
+
+def parse_seats(seats):
+    """[{"row_name": "A", "seat_number": 1}, ...] -> [("A", 1), ...] without duplicates."""
+    if not isinstance(seats, list) or not seats:
+        raise ValueError('seats must be a non-empty list')
+    if len(seats) > MAX_HOLD_SEATS:
+        raise ValueError(f'At most {MAX_HOLD_SEATS} seats per order')
+    parsed = []
+    for seat in seats:
+        try:
+            key = (str(seat['row_name']), int(seat['seat_number']))
+        except (KeyError, TypeError, ValueError):
+            raise ValueError('Each seat needs a row_name and seat_number')
+        if not ticket_codes.valid_seat_number(key[1]):
+            raise reservations.SeatNotFound(f'Seats not found: {key[0]}-{key[1]}')
+        if key not in parsed:
+            parsed.append(key)
+    return parsed
+
+
+def _hold_row(cur, hold_id, user_id):
+    cur.execute('SELECT * FROM Holds WHERE hold_id = ? AND user_id = ?', (hold_id, user_id))
+    hold = cur.fetchone()
+    if hold is None:
+        raise HoldNotFound('Hold not found')
+    return hold
+
+
+def _status(hold, now=None):
+    now = time.time() if now is None else now
+    if hold['status'] == 'ACTIVE' and now >= hold['expires_at']:
+        return 'EXPIRED'
+    return hold['status']
+
+
+def create_hold(conn, event_id, seats, user_id):
+    """Hold all of seats for user_id. Returns the hold as a dict."""
+    def work(cur):
+        claimed = reservations.claim_seats(cur, event_id, seats, user_id)
+        reserved_at = claimed[0]['reservation_time']
+        expires_at = expiry.parse_reservation_time(reserved_at) + expiry.sweeper.ttl_for(event_id)
+        cur.execute("""
+            INSERT INTO Holds (event_id, user_id, reserved_at, expires_at) VALUES (?, ?, ?, ?)
+            RETURNING hold_id
+        """, (event_id, user_id, reserved_at, expires_at))
+        hold_id = cur.fetchall()[0]['hold_id']
+        cur.executemany('INSERT INTO Hold_Seats (hold_id, ticket_id) VALUES (?, ?)',
+                        [(hold_id, seat['ticket_id']) for seat in claimed])
+        return hold_id, claimed
+
+    hold_id = reservations.write_seats(conn, work)
+    return get_hold(conn, hold_id, user_id)
+
+
+def get_hold(conn, hold_id, user_id):
+    hold = _hold_row(conn.cursor(), hold_id, user_id)
+    seats = conn.execute("""
+        SELECT t.ticket_id, t.row_name, t.seat_number, tp.price_cents
+        FROM Hold_Seats hs
+        JOIN Tickets t ON t.ticket_id = hs.ticket_id
+        LEFT JOIN Ticket_Prices tp ON tp.event_id = t.event_id AND tp.row_name = t.row_name
+        WHERE hs.hold_id = ?
+        ORDER BY t.row_name, t.seat_number
+    """, (hold_id,)).fetchall()
+    return {
+        'hold_id': hold['hold_id'],
+        'event_id': hold['event_id'],
+        'status': _status(hold),
+        'expires_in': max(0, int(hold['expires_at'] - time.time())) if _status(hold) == 'ACTIVE' else 0,
+        'seats': [{'ticket_id': seat['ticket_id'], 'row_name': seat['row_name'], 'seat_number': seat['seat_number'],
+                   'price_cents': seat['price_cents'] or 0} for seat in seats],
+        'total_cents': sum(seat['price_cents'] or 0 for seat in seats),
+    }
+
+
+def _held_seats_clause():
+    # Seats of the hold that still carry its reservation
+    return f"""
+        ticket_id IN (SELECT ticket_id FROM Hold_Seats WHERE hold_id = ?)
+        AND status = {RESERVED} AND user_id = ? AND reservation_time = ?
+    """
+
+
+def release_hold(conn, hold_id, user_id):
+    """Give back whatever seats the hold still has. Returns how many were released."""
+    def work(cur):
+        hold = _hold_row(cur, hold_id, user_id)
+        if hold['status'] != 'ACTIVE':
+            raise HoldExpired(f"Hold is already {hold['status'].lower().replace('_', ' ')}")
+        cur.execute(f"""
+            UPDATE Tickets
+            SET status = {AVAILABLE}, user_id = NULL, reservation_time = NULL
+            WHERE {_held_seats_clause()}
+            RETURNING {reservations.CHANGED_COLUMNS}
+        """, (hold_id, user_id, hold['reserved_at']))
+        released = cur.fetchall()
+        cur.execute("UPDATE Holds SET status = 'RELEASED' WHERE hold_id = ?", (hold_id,))
+        return len(released), released
+
+    return reservations.write_seats(conn, work)
+
+
+def _record_payment(cur, intent_id, user_id, amount_cents, hold_id=None):
+    try:
+        cur.execute('INSERT INTO Payments (payment_intent_id, user_id, amount_cents, hold_id) VALUES (?, ?, ?, ?)',
+                    (intent_id, user_id, amount_cents, hold_id))
+    except sqlite3.IntegrityError:
+        raise payments.PaymentError('This payment has already been used')
+
+
+@contextmanager
+def _central_payment(event_id, intent_id, user_id, amount_cents, hold_id=None):
+    # Payments only covers its own database. For an event in a shard the
+    # payment is also claimed in the central one first, so it can't pay for
+    # an order in another shard as well. The claim is dropped if the sale fails.
+    if shards.router.shard_for(event_id) == 0:
+        yield
+        return
+    with db.pool.connection() as central:
+        _record_payment(central.cursor(), intent_id, user_id, amount_cents, hold_id)
+        central.commit()
+    try:
+        yield
+    except BaseException:
+        with db.pool.connection() as central:
+            central.execute('DELETE FROM Payments WHERE payment_intent_id = ?', (intent_id,))
+            central.commit()
+        raise
+
+
+def checkout(conn, hold_id, user_id, payment_intent_id):
+    """Sell every seat in the hold after checking the payment. Returns the ticket_ids."""
+    hold = get_hold(conn, hold_id, user_id)
+    if hold['status'] != 'ACTIVE':
+        raise HoldExpired(f"Hold is {hold['status'].lower().replace('_', ' ')}")
+    payments.verify(payment_intent_id, hold['total_cents'], user_id)
+
+    def work(cur):
+        row = _hold_row(cur, hold_id, user_id)
+        if _status(row) != 'ACTIVE':
+            raise HoldExpired(f"Hold is {_status(row).lower().replace('_', ' ')}")
+        cur.execute(f"""
+            UPDATE Tickets
+            SET status = {SOLD}, reservation_time = NULL
+            WHERE {_held_seats_clause()}
+            RETURNING {reservations.CHANGED_COLUMNS}
+        """, (hold_id, user_id, row['reserved_at']))
+        sold = cur.fetchall()
+        if len(sold) != len(hold['seats']):
+            raise HoldExpired('Some seats in this hold have expired')
+        _record_payment(cur, payment_intent_id, user_id, hold['total_cents'], hold_id)
+        cur.execute("UPDATE Holds SET status = 'CHECKED_OUT' WHERE hold_id = ?", (hold_id,))
+        return sorted(seat['ticket_id'] for seat in sold), sold
+
+    with _central_payment(hold['event_id'], payment_intent_id, user_id, hold['total_cents'], hold_id):
+        return reservations.write_seats(conn, work)
+
+
+def sold_total(cur, event_id, sold):
+    """Price in cents of the seats sell_seats() just sold. Call inside the same transaction."""
+    rows = sorted({seat['row_name'] for seat in sold})
+    cur.execute(f"""
+        SELECT row_name, price_cents FROM Ticket_Prices
+        WHERE event_id = ? AND row_name IN ({', '.join('?' * len(rows))})
+    """, (event_id, *rows))
+    prices = {row['row_name']: row['price_cents'] for row in cur.fetchall()}
+    unpriced = [f"{seat['row_name']}-{seat['seat_number']}" for seat in sold if seat['row_name'] not in prices]
+    if unpriced:
+        raise SeatNotForSale(f"Seats not on sale yet: {', '.join(unpriced)}")
+    return sum(prices[seat['row_name']] for seat in sold)
+
+
+def purchase(conn, event_id, seats, user_id, payment_intent_id):
+    """Buy seats (available or held by user_id) in one go after checking the payment. Returns the ticket_ids."""
+    intent = payments.verify_paid(payment_intent_id, user_id)
+
+    def work(cur):
+        # Priced from what was actually sold, in the same transaction, so a
+        # reprice can't slip in between the total and the sale
+        sold = reservations.sell_seats(cur, event_id, seats, user_id)
+        total = sold_total(cur, event_id, sold)
+        payments.check_amount(intent, total)
+        _record_payment(cur, payment_intent_id, user_id, total)
+        return sorted(seat['ticket_id'] for seat in sold), sold
+
+    with _central_payment(event_id, payment_intent_id, user_id, intent['amount']):
+        return reservations.write_seats(conn, work)
@@ -0,0 +1,90 @@
+import base64
+import re
+import threading
+import time
+from collections import OrderedDict
+
+# Event listing helpers for GET /events: keyset cursors over (date, event_id),
+# an FTS5 index for the search box, and a short-lived cache of filtered totals
+# so we don't run COUNT(*) on every page view. The listing indexes and the
+# Events_fts table itself come from migrations.py.
+
+DEFAULT_COUNT_CACHE_SECONDS = 30.0
+DEFAULT_COUNT_CACHE_MAX_ENTRIES = 1024  # filter combinations kept, least recently used go first
+
+_WORD = re.compile(r'\w+', re.UNICODE)
+
+
+def index_event(cur, event_id):
+    # Call inside the same transaction that inserted the event
+    cur.execute("""
+        INSERT INTO Events_fts (rowid, name, description, location)
+        SELECT event_id, name, description, location FROM Events WHERE event_id = ?
+    """, (event_id,))
+
+
+def search_query(text):
+    # Turn free text into an FTS5 query where every word is a prefix match,
+    # so "tay swi" still finds "Taylor Swift". Quoting each word keeps user
+    # input from being parsed as FTS syntax.
+    words = _WORD.findall(text)
+    if not words:
+        return None
+    return ' '.join(f'"{word}"*' for word in words)
+
+
+def encode_cursor(date, event_id):
+    raw = f'{date}|{event_id}'.encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Returns (date, event_id). Raises ValueError on a malformed cursor."""
+    padded = cursor + '=' * (-len(cursor) % 4)
+    try:
+        date, event_id = base64.urlsafe_b64decode(padded).decode().rsplit('|', 1)
+        return date, int(event_id)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise ValueError('Invalid cursor') from e
+
+
+class CountCache:
+    """Totals per filter combination, dropped whenever the catalog changes.
+
+    Keys include the search and location text clients send, so the cache is
+    bounded by an LRU like response_cache.py.
+    """
+
+    def __init__(self, ttl=DEFAULT_COUNT_CACHE_SECONDS, max_entries=DEFAULT_COUNT_CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._counts = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            hit = self._counts.get(key)
+            if hit is not None:
+                self._counts.move_to_end(key)
+        if hit and time.monotonic() - hit[1] < self.ttl:
+            return hit[0]
+        return None
+
+    def put(self, key, total):
+        with self._lock:
+            self._counts[key] = (total, time.monotonic())
+            self._counts.move_to_end(key)
+            while len(self._counts) > self.max_entries:
+                self._counts.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._counts.clear()
+
+
+counts = CountCache()
+
+
+def init_app(app):
+    counts.ttl = app.config.get('EVENT_COUNT_CACHE_SECONDS', DEFAULT_COUNT_CACHE_SECONDS)
+    counts.max_entries = app.config.get('EVENT_COUNT_CACHE_MAX_ENTRIES', DEFAULT_COUNT_CACHE_MAX_ENTRIES)
@@ -0,0 +1,306 @@
+import os
+import sqlite3 # Library for talking to our database
+import threading
+import time
+from contextlib import contextmanager
+from urllib.request import pathname2url
+
+from flask import g, has_app_context
+
+# Where the database lives, relative to the backend folder (same path app.py always used)
+DEFAULT_DB_PATH = '../database/tessera.db'
+
+# Pool defaults. These can be overridden through app.config (see init_app below)
+DEFAULT_POOL_SIZE = 16
+DEFAULT_POOL_TIMEOUT = 10.0        # seconds to wait for a free connection before giving up
+DEFAULT_BUSY_TIMEOUT_MS = 5000     # how long SQLite waits on a locked database before raising SQLITE_BUSY
+DEFAULT_MMAP_SIZE = 256 * 1024 * 1024
+DEFAULT_HEALTH_CHECK_AFTER = 30.0  # ping connections that have been idle longer than this (seconds)
+
+
+class PoolExhausted(Exception):
+    """Raised when every pooled connection is in use and none frees up in time."""
+
+
+class PooledConnection(sqlite3.Connection):
+    # A normal sqlite3 connection that remembers which pool it belongs to.
+    # Calling close() hands it back to the pool instead of throwing it away, so
+    # the existing "conn.close()" calls in the routes keep working unchanged.
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._pool = None
+        self._request_bound = False
+        self._checked_out = False
+        self._last_used = time.monotonic()
+
+    def close(self):
+        # Connections handed out for a request are returned at teardown, so a
+        # helper closing "its" connection halfway through a route is a no-op
+        if self._request_bound or self._pool is None:
+            return
+        self._pool.release(self)
+
+    def really_close(self):
+        sqlite3.Connection.close(self)
+
+
+class ConnectionPool:
+    """A small bounded pool of SQLite connections shared by all worker threads.
+
+    Connections are opened lazily up to max_size, tuned once with the pragmas
+    below, and reused afterwards so we don't pay connect + schema parse on
+    every request.
+
+    A read_only pool opens its connections with mode=ro and query_only, so
+    they can never take the write lock. Under WAL they read the last commit
+    without waiting on whoever is writing. db_path may also be a file: URI.
+    """
+
+    def __init__(self, db_path=DEFAULT_DB_PATH, max_size=DEFAULT_POOL_SIZE,
+                 timeout=DEFAULT_POOL_TIMEOUT, busy_timeout_ms=DEFAULT_BUSY_TIMEOUT_MS,
+                 mmap_size=DEFAULT_MMAP_SIZE, health_check_after=DEFAULT_HEALTH_CHECK_AFTER,
+                 connection_factory=PooledConnection, read_only=False):
+        self.db_path = db_path
+        self.connection_factory = connection_factory
+        self.read_only = read_only
+        self.max_size = max_size
+        self.timeout = timeout
+        self.busy_timeout_ms = busy_timeout_ms
+        self.mmap_size = mmap_size
+        self.health_check_after = health_check_after
+
+        self._idle = []  # used as a stack so the warmest connection is reused first
+        self._size = 0
+        self._retired = False
+        self._lock = threading.Condition()
+        self._stats = {
+            'created': 0,
+            'reused': 0,
+            'checkouts': 0,
+            'releases': 0,
+            'waits': 0,
+            'wait_time_ms': 0.0,
+            'timeouts': 0,
+            'health_checks': 0,
+            'health_check_failures': 0,
+            'discarded': 0,
+        }
+
+    def _connect(self):
+        # check_same_thread=False because a connection may be released by one
+        # worker thread and picked up by another. The pool makes sure only one
+        # thread uses it at a time.
+        target = self.db_path
+        if self.read_only and not target.startswith('file:'):
+            target = f'file:{pathname2url(os.path.abspath(target))}?mode=ro'
+        conn = sqlite3.connect(target, factory=self.connection_factory,
+                               timeout=self.busy_timeout_ms / 1000.0,
+                               check_same_thread=False, uri=target.startswith('file:'))
+        conn.row_factory = sqlite3.Row
+        if self.read_only:
+            # The journal mode is the writers' business, WAL is what keeps us off their lock
+            conn.execute('PRAGMA query_only = ON')
+        else:
+            conn.execute('PRAGMA journal_mode = WAL')
+            conn.execute('PRAGMA synchronous = NORMAL')
+        conn.execute(f'PRAGMA busy_timeout = {int(self.busy_timeout_ms)}')
+        conn.execute(f'PRAGMA mmap_size = {int(self.mmap_size)}')
+        conn._pool = self
+        return conn
+
+    def _is_healthy(self, conn):
+        self._stats['health_checks'] += 1
+        try:
+            conn.execute('SELECT 1').fetchone()
+            return True
+        except sqlite3.Error:
+            self._stats['health_check_failures'] += 1
+            return False
+
+    def acquire(self):
+        deadline = time.monotonic() + self.timeout
+        waited_since = None
+
+        with self._lock:
+            while True:
+                if self._retired:
+                    raise PoolExhausted('This pool has been retired')
+                if self._idle:
+                    conn = self._idle.pop()
+                    idle_for = time.monotonic() - conn._last_used
+                    if idle_for > self.health_check_after and not self._is_healthy(conn):
+                        self._discard(conn)
+                        continue
+                    self._stats['reused'] += 1
+                    break
+
+                if self._size < self.max_size:
+                    # Reserve the slot before connecting so we never go over max_size
+                    self._size += 1
+                    try:
+                        conn = self._connect()
+                    except Exception:
+                        self._size -= 1
+                        self._lock.notify()
+                        raise
+                    self._stats['created'] += 1
+                    break
+
+                # Everything is checked out, wait for someone to give one back
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats['timeouts'] += 1
+                    raise PoolExhausted(f'No database connection free after {self.timeout}s')
+                if waited_since is None:
+                    waited_since = time.monotonic()
+                    self._stats['waits'] += 1
+                self._lock.wait(remaining)
+
+            if waited_since is not None:
+                self._stats['wait_time_ms'] += (time.monotonic() - waited_since) * 1000
+            self._stats['checkouts'] += 1
+
+        conn._checked_out = True
+        conn._request_bound = False
+        return conn
+
+    def release(self, conn):
+        if not conn._checked_out:
+            return  # already back in the pool
+        conn._checked_out = False
+        conn._request_bound = False
+
+        # Never hand the next user a connection with a half finished transaction
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            with self._lock:
+                self._discard(conn)
+            return
+
+        conn._last_used = time.monotonic()
+        with self._lock:
+            self._stats['releases'] += 1
+            if self._retired:
+                self._discard(conn)
+                return
+            self._idle.append(conn)
+            self._lock.notify()
+
+    def _discard(self, conn):
+        # Caller must hold self._lock
+        self._size -= 1
+        self._stats['discarded'] += 1
+        try:
+            conn.really_close()
+        except sqlite3.Error:
+            pass
+        self._lock.notify()
+
+    def dedicated(self):
+        """A tuned connection outside the pool's limit, for a long lived background writer.
+
+        Close it with really_close(). It can't be starved by request threads
+        that are themselves waiting on that writer.
+        """
+        conn = self._connect()
+        conn._pool = None
+        return conn
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection outside of a request (background jobs, scripts)."""
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close_all(self):
+        with self._lock:
+            while self._idle:
+                self._discard(self._idle.pop())
+
+    def retire(self):
+        # Close everything now and whatever is still checked out as it comes back
+        with self._lock:
+            self._retired = True
+        self.close_all()
+
+    @property
+    def retired(self):
+        return self._retired
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = self._size
+            stats['idle'] = len(self._idle)
+            stats['in_use'] = self._size - len(self._idle)
+            stats['max_size'] = self.max_size
+        stats['wait_time_ms'] = round(stats['wait_time_ms'], 3)
+        return stats
+
+
+pool = ConnectionPool()
+read_pool = ConnectionPool(read_only=True)  # for routes that only read, see get_read_connection()
+
+
+def init_app(app):
+    # Rebuild the pools from the app config and make sure every request hands
+    # its connections back when it finishes, even if the route errored out
+    global pool, read_pool
+    pool.close_all()
+    read_pool.close_all()
+    settings = dict(
+        db_path=app.config.get('DB_PATH', DEFAULT_DB_PATH),
+        timeout=app.config.get('DB_POOL_TIMEOUT', DEFAULT_POOL_TIMEOUT),
+        busy_timeout_ms=app.config.get('DB_BUSY_TIMEOUT_MS', DEFAULT_BUSY_TIMEOUT_MS),
+        mmap_size=app.config.get('DB_MMAP_SIZE', DEFAULT_MMAP_SIZE),
+        health_check_after=app.config.get('DB_HEALTH_CHECK_AFTER', DEFAULT_HEALTH_CHECK_AFTER),
+        connection_factory=pool.connection_factory,
+    )
+    pool = ConnectionPool(max_size=app.config.get('DB_POOL_SIZE', DEFAULT_POOL_SIZE), **settings)
+    read_pool = ConnectionPool(max_size=app.config.get('DB_READ_POOL_SIZE', DEFAULT_POOL_SIZE),
+                               read_only=True, **settings)
+    app.teardown_appcontext(release_request_connection)
+
+
+def get_db_connection():
+    # Inside a request every caller shares one pooled connection which is
+    # returned in release_request_connection. Outside of a request the caller
+    # owns the connection and gives it back with conn.close().
+    if not has_app_context():
+        return pool.acquire()
+
+    conn = g.get('db_conn')
+    if conn is None:
+        started = time.perf_counter()
+        conn = pool.acquire()
+        g.db_connect_seconds = time.perf_counter() - started  # picked up by metrics.py
+        conn._request_bound = True
+        g.db_conn = conn
+    return conn
+
+
+def get_read_connection():
+    # Like get_db_connection(), from the read-only pool. Reads here never wait
+    # on the write lock, but a write through this connection raises.
+    if not has_app_context():
+        return read_pool.acquire()
+
+    conn = g.get('db_read_conn')
+    if conn is None:
+        conn = read_pool.acquire()
+        conn._request_bound = True
+        g.db_read_conn = conn
+    return conn
+
+
+def release_request_connection(exception=None):
+    for key in ('db_conn', 'db_read_conn'):
+        conn = g.pop(key, None)
+        if conn is not None:
+            conn._pool.release(conn)
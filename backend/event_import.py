@@ -0,0 +1,193 @@
+import csv
+import functools
+import io
+import itertools
+import json
+import re
+import time
+from datetime import date as Date
+
+import reservations
+import shards
+
+# Bulk event import for loading a season at once.
+#
+# The upload (CSV with a header row, or NDJSON with one object per line) is
+# read as a stream and handled CHUNK_SIZE records at a time: validate the
+# chunk, insert the good records with one executemany, add them to the search
+# index with one INSERT ... SELECT and give each a shard, all in one write
+# transaction per chunk. Memory stays flat however long the file is, and a
+# big import only holds the write lock a chunk at a time.
+#
+# Records have the same fields as POST /events (name, description, location,
+# date as YYYY-MM-DD, time as HH:MM and url, plus an optional image_url). Bad
+# records are skipped and listed in the report by line number; the rest still
+# go in. Chunks already committed stay in if a later chunk fails.
+
+CHUNK_SIZE = 500
+MAX_REPORTED_ERRORS = 1000
+
+FORMATS = ('csv', 'ndjson')
+MIMETYPES = {
+    'text/csv': 'csv',
+    'application/x-ndjson': 'ndjson',
+    'application/jsonl': 'ndjson',
+}
+
+REQUIRED_FIELDS = ('name', 'description', 'location', 'date', 'time', 'url')
+OPTIONAL_FIELDS = ('image_url',)
+
+_DATE = re.compile(r'\d{4}-\d{2}-\d{2}')
+_TIME = re.compile(r'(\d{1,2}):(\d{2})')
+
+
+class ImportFormatError(ValueError):
+    """The upload as a whole can't be read (unknown format, CSV header missing fields, not UTF-8)."""
+
+
+class RecordError(ValueError):
+    """One record is invalid, it is skipped and reported."""
+
+
+# A season repeats the same few hundred dates and a handful of start times,
+# so each distinct value is only parsed once per process
+
+@functools.lru_cache(maxsize=4096)
+def parse_date(value):
+    if not _DATE.fullmatch(value):
+        raise RecordError(f'date must be YYYY-MM-DD, got {value!r}')
+    try:
+        return Date.fromisoformat(value).isoformat()
+    except ValueError:
+        raise RecordError(f'date must be YYYY-MM-DD, got {value!r}') from None
+
+
+@functools.lru_cache(maxsize=1024)
+def parse_time(value):
+    match = _TIME.fullmatch(value)
+    if not match or int(match.group(1)) > 23 or int(match.group(2)) > 59:
+        raise RecordError(f'time must be HH:MM, got {value!r}')
+    # Same text POST /events stores (time.isoformat())
+    return f'{int(match.group(1)):02d}:{match.group(2)}:00'
+
+
+def _text(record, field):
+    value = record.get(field)
+    if value is None:
+        return None
+    if isinstance(value, (dict, list, bool)):
+        raise RecordError(f'{field} must be text')
+    return str(value).strip() or None
+
+
+def parse_record(record):
+    """A record as an Events row (name, description, date, time, location, url, image_url)."""
+    if not isinstance(record, dict):
+        raise RecordError('Each record must be an object')
+    values = {field: _text(record, field) for field in REQUIRED_FIELDS + OPTIONAL_FIELDS}
+    missing = [field for field in REQUIRED_FIELDS if values[field] is None]
+    if missing:
+        raise RecordError(f'Missing {", ".join(missing)}')
+    return (values['name'], values['description'], parse_date(values['date']), parse_time(values['time']),
+            values['location'], values['url'], values['image_url'])
+
+
+def detect_format(fmt, mimetype):
+    fmt = fmt or MIMETYPES.get(mimetype)
+    if fmt not in FORMATS:
+        raise ImportFormatError(f'format must be one of {", ".join(FORMATS)} (pass ?format= or a text/csv '
+                                'or application/x-ndjson Content-Type)')
+    return fmt
+
+
+def read_records(stream, fmt):
+    """Yield (line_number, record) from a binary stream. record is a RecordError for lines that don't parse."""
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    try:
+        if fmt == 'csv':
+            yield from _csv_records(text)
+        else:
+            yield from _ndjson_records(text)
+    except UnicodeDecodeError as e:
+        raise ImportFormatError(f'Upload is not UTF-8 text: {e}') from e
+    finally:
+        text.detach()  # leave the request's stream for Werkzeug to close
+
+
+def _csv_records(text):
+    reader = csv.DictReader(text)
+    header = reader.fieldnames
+    if header is None:
+        return
+    missing = [field for field in REQUIRED_FIELDS if field not in header]
+    if missing:
+        raise ImportFormatError(f'CSV header is missing {", ".join(missing)}')
+    line = reader.line_num
+    try:
+        for record in reader:
+            yield line + 1, record
+            line = reader.line_num  # a quoted field can span lines
+    except csv.Error as e:
+        yield line + 1, RecordError(f'Malformed CSV: {e}')
+
+
+def _ndjson_records(text):
+    for line_number, line in enumerate(text, 1):
+        if not line.strip():
+            continue
+        try:
+            yield line_number, json.loads(line)
+        except ValueError as e:
+            yield line_number, RecordError(f'Invalid JSON: {e}')
+
+
+def _insert_chunk(cur, rows):
+    # Nothing else can insert events while we hold the write lock, so the new
+    # rows are exactly the ones after the current highest event_id, in order
+    last_id = cur.execute('SELECT COALESCE(MAX(event_id), 0) FROM Events').fetchone()[0]
+    cur.executemany('INSERT INTO Events (name, description, date, time, location, url, image_url) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+    event_ids = [row[0] for row in cur.execute(
+        'SELECT event_id FROM Events WHERE event_id > ? ORDER BY event_id', (last_id,))]
+    # The whole chunk goes into the search index in one statement (see catalog.index_event)
+    cur.execute("""
+        INSERT INTO Events_fts (rowid, name, description, location)
+        SELECT event_id, name, description, location FROM Events WHERE event_id > ?
+    """, (last_id,))
+    for event_id in event_ids:
+        shards.router.assign(cur, event_id)
+    return event_ids
+
+
+def import_events(conn, records, chunk_size=CHUNK_SIZE):
+    """Validate and insert (line_number, record) pairs a chunk at a time. Returns the report."""
+    started = time.perf_counter()
+    report = {'imported': 0, 'failed': 0, 'event_ids': [], 'errors': [], 'errors_truncated': False}
+
+    def fail(line_number, error):
+        report['failed'] += 1
+        if len(report['errors']) < MAX_REPORTED_ERRORS:
+            report['errors'].append({'line': line_number, 'error': str(error)})
+        else:
+            report['errors_truncated'] = True
+
+    records = iter(records)
+    while True:
+        chunk = list(itertools.islice(records, chunk_size))
+        if not chunk:
+            break
+        rows = []
+        for line_number, record in chunk:
+            try:
+                if isinstance(record, RecordError):
+                    raise record
+                rows.append(parse_record(record))
+            except RecordError as e:
+                fail(line_number, e)
+        if rows:
+            event_ids = reservations.run_write(conn, lambda cur: _insert_chunk(cur, rows))
+            report['imported'] += len(event_ids)
+            report['event_ids'].extend(event_ids)
+
+    report['elapsed_ms'] = round((time.perf_counter() - started) * 1000, 2)
+    return report
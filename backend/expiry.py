@@ -0,0 +1,216 @@
+import heapq
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+import db
+import reservations
+import shards
+import ticket_codes
+
+# Seat holds used to be expired inside get_ticket_availability on every GET.
+# Instead we keep a min-heap of hold deadlines and a background thread pops
+# everything that is due and expires it in one batched write.
+
+DEFAULT_HOLD_TTL_SECONDS = 60       # same one minute hold the old cleanup used
+DEFAULT_SWEEP_INTERVAL_SECONDS = 1.0
+DEFAULT_RESYNC_INTERVAL_SECONDS = 300.0
+
+logger = logging.getLogger(__name__)
+
+
+def parse_reservation_time(value):
+    # reservation_time is written by SQLite's CURRENT_TIMESTAMP, which is UTC
+    parsed = datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
+    return parsed.replace(tzinfo=timezone.utc).timestamp()
+
+
+class ReservationSweeper:
+
+    def __init__(self, default_ttl=DEFAULT_HOLD_TTL_SECONDS,
+                 interval=DEFAULT_SWEEP_INTERVAL_SECONDS,
+                 resync_interval=DEFAULT_RESYNC_INTERVAL_SECONDS):
+        self.default_ttl = default_ttl
+        self.interval = interval
+        self.resync_interval = resync_interval
+
+        self._heap = []    # (deadline, ticket_id, event_id, reservation_time)
+        self._holds = {}   # ticket_id -> reservation_time of the hold we are tracking
+        self._ttls = {}    # event_id -> hold TTL in seconds
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._last_resync = 0.0
+        self.stats = {'sweeps': 0, 'expired': 0, 'stale': 0}
+
+    # -- hold TTLs -------------------------------------------------------
+
+    def load_ttls(self, conn):
+        # Event_Settings comes from migrations.py
+        rows = conn.execute('SELECT event_id, hold_ttl_seconds FROM Event_Settings').fetchall()
+        with self._lock:
+            self._ttls = {row['event_id']: row['hold_ttl_seconds'] for row in rows}
+
+    def ttl_for(self, event_id):
+        return self._ttls.get(event_id, self.default_ttl)
+
+    def set_ttl(self, conn, event_id, ttl_seconds):
+        # Only affects holds taken from now on
+        conn.execute("""
+            INSERT INTO Event_Settings (event_id, hold_ttl_seconds) VALUES (?, ?)
+            ON CONFLICT(event_id) DO UPDATE SET hold_ttl_seconds = excluded.hold_ttl_seconds
+        """, (event_id, ttl_seconds))
+        conn.commit()
+        with self._lock:
+            self._ttls[event_id] = ttl_seconds
+
+    # -- expiry index ----------------------------------------------------
+
+    def track(self, ticket_id, event_id, reservation_time):
+        deadline = parse_reservation_time(reservation_time) + self.ttl_for(event_id)
+        with self._lock:
+            if self._holds.get(ticket_id) == reservation_time:
+                return
+            self._holds[ticket_id] = reservation_time
+            heapq.heappush(self._heap, (deadline, ticket_id, event_id, reservation_time))
+
+    def forget(self, ticket_id):
+        # The heap entry stays behind and is skipped when it comes due
+        with self._lock:
+            self._holds.pop(ticket_id, None)
+
+    def on_seat_change(self, seat):
+        if seat['status'] == 'RESERVED' and seat['reservation_time']:
+            self.track(seat['ticket_id'], seat['event_id'], seat['reservation_time'])
+        else:
+            self.forget(seat['ticket_id'])
+
+    def resync(self, conn):
+        # Pick up holds we didn't see being made (server restart, other
+        # workers). conn is the central database, shards are read from their own pools.
+        for shard_id in shards.router.shard_ids():
+            with self._shard_connection(conn, shard_id) as shard_conn:
+                rows = shard_conn.execute(f"""
+                    SELECT ticket_id, event_id, reservation_time
+                    FROM Tickets
+                    WHERE status = {ticket_codes.RESERVED} AND reservation_time IS NOT NULL
+                """).fetchall()
+            for row in rows:
+                self.track(row['ticket_id'], row['event_id'], row['reservation_time'])
+        self._last_resync = time.monotonic()
+
+    @contextmanager
+    def _shard_connection(self, conn, shard_id):
+        if shard_id == 0:
+            yield conn
+        else:
+            with shards.router.pool(shard_id).connection() as shard_conn:
+                yield shard_conn
+
+    def _pop_due(self, now):
+        due = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                _, ticket_id, event_id, reservation_time = heapq.heappop(self._heap)
+                if self._holds.get(ticket_id) != reservation_time:
+                    self.stats['stale'] += 1
+                    continue
+                del self._holds[ticket_id]
+                due.append((ticket_id, event_id, reservation_time))
+        return due
+
+    def sweep(self, conn, now=None):
+        """Expire every hold whose deadline has passed. Returns how many seats were freed."""
+        due = self._pop_due(time.time() if now is None else now)
+        self.stats['sweeps'] += 1
+        if not due:
+            return 0
+
+        # One write per shard, each on that shard's own lock
+        by_shard = {}
+        for hold in due:
+            by_shard.setdefault(shards.router.shard_for(hold[1]), []).append(hold)
+        expired = 0
+        failure = None
+        for shard_id, shard_due in by_shard.items():
+            try:
+                with self._shard_connection(conn, shard_id) as shard_conn:
+                    expired += self._expire(shard_conn, shard_due)
+            except Exception as e:
+                # Put the holds back so the next sweep retries them
+                for ticket_id, event_id, reservation_time in shard_due:
+                    self.track(ticket_id, event_id, reservation_time)
+                failure = failure or e
+        if failure is not None:
+            raise failure
+        return expired
+
+    def _expire(self, conn, due):
+        # Matching on reservation_time means a seat that was released and
+        # re-held since we indexed it is left alone
+        def work(cur):
+            expired = []
+            for ticket_id, _, reservation_time in due:
+                cur.execute(f"""
+                    UPDATE Tickets
+                    SET status = {ticket_codes.AVAILABLE},
+                        user_id = NULL,
+                        reservation_time = NULL
+                    WHERE ticket_id = ? AND status = {ticket_codes.RESERVED} AND reservation_time = ?
+                    RETURNING {reservations.CHANGED_COLUMNS}
+                """, (ticket_id, reservation_time))
+                expired.extend(cur.fetchall())
+            return expired
+
+        expired = reservations.run_write(conn, work)
+        self.stats['expired'] += len(expired)
+        reservations.notify(expired)
+        return len(expired)
+
+    # -- background thread -----------------------------------------------
+
+    def start(self):
+        if self._thread is not None:
+            return
+        with db.pool.connection() as conn:
+            self.load_ttls(conn)
+            self.resync(conn)
+        self._thread = threading.Thread(target=self._run, name='reservation-sweeper', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                with db.pool.connection() as conn:
+                    if time.monotonic() - self._last_resync >= self.resync_interval:
+                        self.resync(conn)
+                    self.sweep(conn)
+            except Exception:
+                logger.exception('Reservation sweep failed')
+
+
+sweeper = ReservationSweeper()
+reservations.add_listener(sweeper.on_seat_change)
+_start_lock = threading.Lock()
+
+
+def init_app(app):
+    sweeper.default_ttl = app.config.get('RESERVATION_TTL_SECONDS', DEFAULT_HOLD_TTL_SECONDS)
+    sweeper.interval = app.config.get('RESERVATION_SWEEP_INTERVAL', DEFAULT_SWEEP_INTERVAL_SECONDS)
+    sweeper.resync_interval = app.config.get('RESERVATION_RESYNC_INTERVAL', DEFAULT_RESYNC_INTERVAL_SECONDS)
+
+    # Start the thread with the first request rather than at import time, so
+    # scripts that just import the app don't spawn it
+    @app.before_request
+    def start_sweeper():
+        if sweeper._thread is None and app.config.get('RESERVATION_SWEEPER', True):
+            with _start_lock:
+                sweeper.start()
@@ -0,0 +1,144 @@
+import csv
+import io
+import json
+
+import db
+import ticket_codes
+
+# Streaming exports for big tables. Rows are read with fetchmany in batches and
+# written out as they come, so memory stays flat however large the table is.
+#
+# The generators borrow their own pooled connection because a streamed
+# response keeps running after the request's connection has been handed back.
+# They read through the read-only pools (db.read_pool and the shard read
+# pools), so a long download never ties up a connection the writes need.
+#
+# Tickets can be spread over several shards (shards.py). Shard ticket_ids
+# come in ascending ranges, so reading the shards one after the other keeps
+# ticket_id order without any merging.
+
+BATCH_SIZE = 1000
+MAX_PAGE_SIZE = 1000
+
+FORMATS = ('json', 'ndjson', 'csv')
+MIMETYPES = {
+    'json': 'application/json',
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+
+def _batches(query, params, batch_size, pools):
+    columns = None
+    for pool in pools or [db.read_pool]:
+        with pool.connection() as conn:
+            cur = conn.execute(query, params)
+            if columns is None:
+                columns = [column[0] for column in cur.description]
+                yield columns
+            while True:
+                rows = cur.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield rows
+
+
+def stream(query, params, fmt, wrap_key=None, single_column=False, batch_size=BATCH_SIZE, pools=None):
+    """Generate the body for query in one of FORMATS.
+
+    json keeps the shape the old endpoints returned: {wrap_key: [row, ...]},
+    or a bare list when wrap_key is None. single_column emits just the first
+    column's value instead of an object per row. With pools (read-only ones,
+    may be a generator) the query runs on each of them in turn.
+    """
+    batches = _batches(query, params, batch_size, pools)
+    columns = next(batches)
+
+    def encode(row):
+        if single_column:
+            return json.dumps(row[0])
+        return json.dumps(dict(zip(columns, row)), sort_keys=True)
+
+    try:
+        if fmt == 'csv':
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerow(columns[:1] if single_column else columns)
+            for rows in batches:
+                writer.writerows(row[:1] if single_column else row for row in rows)
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+            yield buffer.getvalue()
+
+        elif fmt == 'ndjson':
+            for rows in batches:
+                yield ''.join(encode(row) + '\n' for row in rows)
+
+        else:
+            yield '{"%s": [' % wrap_key if wrap_key else '['
+            first = True
+            for rows in batches:
+                chunk = ', '.join(encode(row) for row in rows)
+                yield chunk if first else ', ' + chunk
+                first = False
+            yield ']}' if wrap_key else ']'
+    finally:
+        # Hands the connection back straight away if the client goes away mid-download
+        batches.close()
+
+
+def ticket_filters(args):
+    """WHERE clause and params for the event_id / status / user_id query filters."""
+    conditions = []
+    params = []
+    for name in ('event_id', 'user_id'):
+        value = args.get(name, type=int)
+        if value is not None:
+            conditions.append(f'{name} = ?')
+            params.append(value)
+    status = args.get('status')
+    if status:
+        # Statuses are stored as codes, any spelling of the name works
+        code = ticket_codes.code(status)
+        conditions.append('status = ?')
+        params.append(-1 if code is None else code)
+    return conditions, params
+
+
+def page(conn, table, key, conditions, params, after, limit, columns='*'):
+    """One keyset page of rows ordered by key. Returns (rows, next_after)."""
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    conditions = list(conditions)
+    params = list(params)
+    if after is not None:
+        conditions.append(f'{key} > ?')
+        params.append(after)
+    where = ' WHERE ' + ' AND '.join(conditions) if conditions else ''
+    rows = conn.execute(f'SELECT {columns} FROM {table}{where} ORDER BY {key} LIMIT ?',
+                        params + [limit + 1]).fetchall()
+    next_after = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_after = rows[-1][key]
+    return [dict(row) for row in rows], next_after
+
+
+def page_many(conns, table, key, conditions, params, after, limit, columns='*'):
+    """Like page() over several databases whose keys come in ascending ranges (shards, in order).
+
+    conns may be a generator, databases after the one that fills the page are never opened.
+    """
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    rows = []
+    next_after = None
+    for conn in conns:
+        if len(rows) == limit:
+            # The page ended exactly at the end of a database, there may be more in the next ones
+            next_after = rows[-1][key]
+            break
+        more, next_after = page(conn, table, key, conditions, params, after, limit - len(rows), columns)
+        rows.extend(more)
+        if next_after is not None:
+            break
+    return rows, next_after
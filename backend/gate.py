@@ -0,0 +1,317 @@
+import base64
+import hashlib
+import math
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+import reservations
+import ticket_codes
+
+# Barcode scanning at the venue doors.
+#
+# Every event being scanned gets an in-memory index of its sold barcodes
+# (barcode -> ticket, and whether it has been checked in) plus a Bloom filter
+# over the same barcodes. A scan is a dict lookup, and the check-in itself is
+# one conditional UPDATE, so a ticket can only ever get in once no matter how
+# many gates or workers see it at the same time:
+#
+#   UPDATE Tickets SET checked_in_at = ... WHERE barcode = ? AND status = SOLD AND checked_in_at IS NULL
+#
+# The index follows sales through the seat change listeners. Sales made by
+# other workers aren't seen that way, so a barcode the index doesn't know is
+# looked up in the database before it is turned away. Check-ins never go
+# back, so "already used" can be answered from memory.
+#
+# Scanners that lose their connection work from the gate bundle: the Bloom
+# filter (no barcodes in it, roughly FALSE_POSITIVE_RATE of made up codes get
+# through) to let people in offline, and POST .../scans/sync to upload what
+# they scanned once they are back. Sync applies the scans in the order they
+# happened and reports the ones that lost to an earlier check-in.
+
+DEFAULT_MAX_EVENTS = 64
+FALSE_POSITIVE_RATE = 0.01
+MAX_HASHES = 16
+MAX_SYNC_SCANS = 5000
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'  # UTC, like reservation_time
+
+ACCEPTED = 'ACCEPTED'
+ALREADY_USED = 'ALREADY_USED'
+ALREADY_SYNCED = 'ALREADY_SYNCED'  # the same scan uploaded twice
+NOT_SOLD = 'NOT_SOLD'
+INVALID = 'INVALID'
+
+SCAN_COLUMNS = 'ticket_id, row_name, seat_number, status, checked_in_at, checked_in_gate'
+
+
+class ScanError(ValueError):
+    """A scan request we can't make sense of."""
+
+
+def parse_scanned_at(value):
+    # Scanners send epoch seconds or the UTC "YYYY-MM-DD HH:MM:SS" we store
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return datetime.fromtimestamp(value, timezone.utc).strftime(TIME_FORMAT)
+    if isinstance(value, str):
+        try:
+            return datetime.strptime(value, TIME_FORMAT).strftime(TIME_FORMAT)
+        except ValueError:
+            pass
+    raise ScanError(f'scanned_at must be epoch seconds or "YYYY-MM-DD HH:MM:SS" UTC, got {value!r}')
+
+
+def now():
+    return datetime.now(timezone.utc).strftime(TIME_FORMAT)
+
+
+class BloomFilter:
+    """Bit array Bloom filter with k indexes from one SHA-256 (double hashing).
+
+    Index i of a barcode is (h1 + i * h2) % bits, where h1 and h2 are the
+    first two big-endian 64-bit words of sha256(barcode). Scanners rebuild
+    the same lookups from to_dict().
+    """
+
+    def __init__(self, capacity, false_positive_rate=FALSE_POSITIVE_RATE):
+        capacity = max(1, capacity)
+        self.bits = max(64, math.ceil(-capacity * math.log(false_positive_rate) / math.log(2) ** 2))
+        self.hashes = max(1, min(MAX_HASHES, round(self.bits / capacity * math.log(2))))
+        self.array = bytearray((self.bits + 7) // 8)
+
+    def _indexes(self, barcode):
+        digest = hashlib.sha256(barcode.encode()).digest()
+        h1 = int.from_bytes(digest[:8], 'big')
+        h2 = int.from_bytes(digest[8:16], 'big')
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+    def add(self, barcode):
+        for index in self._indexes(barcode):
+            self.array[index >> 3] |= 1 << (index & 7)
+
+    def __contains__(self, barcode):
+        return all(self.array[index >> 3] & (1 << (index & 7)) for index in self._indexes(barcode))
+
+    def to_dict(self):
+        return {'hash': 'sha256', 'bits': self.bits, 'hashes': self.hashes,
+                'bit_order': 'lsb0', 'array': base64.b64encode(bytes(self.array)).decode()}
+
+
+class EventIndex:
+    """Sold barcodes of one event. Callers hold GateIndex's lock."""
+
+    def __init__(self, event_id, rows, capacity):
+        self.event_id = event_id
+        self.entries = {}    # barcode -> dict of SCAN_COLUMNS
+        self.by_ticket = {}  # ticket_id -> barcode
+        self.pending = set()  # ticket_ids sold since we loaded, barcodes not fetched yet
+        self.bloom = BloomFilter(capacity)  # sized for every ticket, sold or not, so later sales fit
+        self.loaded_at = time.monotonic()
+        for row in rows:
+            self.add(row['barcode'], row)
+
+    def add(self, barcode, row):
+        entry = {column: row[column] for column in SCAN_COLUMNS.split(', ')}
+        self.entries[barcode] = entry
+        self.by_ticket[entry['ticket_id']] = barcode
+        self.bloom.add(barcode)
+        return entry
+
+    def remove(self, ticket_id):
+        barcode = self.by_ticket.pop(ticket_id, None)
+        if barcode is not None:
+            del self.entries[barcode]  # the Bloom filter keeps it, the dict has the last word
+
+    def lookup(self, barcode):
+        if barcode not in self.bloom:
+            return None
+        return self.entries.get(barcode)
+
+
+class GateIndex:
+    """Per-event barcode indexes, bounded by an LRU."""
+
+    def __init__(self, max_events=DEFAULT_MAX_EVENTS):
+        self.max_events = max_events
+        self._events = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {'scans': 0, 'accepted': 0, 'rejected': 0, 'index_misses': 0,
+                      'loads': 0, 'synced': 0, 'conflicts': 0}
+
+    def _load(self, conn, event_id):
+        rows = conn.execute(f"""
+            SELECT barcode, {SCAN_COLUMNS} FROM Tickets
+            WHERE event_id = ? AND status = {ticket_codes.SOLD} AND barcode IS NOT NULL
+        """, (event_id,)).fetchall()
+        capacity = conn.execute('SELECT COUNT(*) FROM Tickets WHERE event_id = ? AND barcode IS NOT NULL',
+                                (event_id,)).fetchone()[0]
+        return EventIndex(event_id, [dict(row, status=ticket_codes.SOLD) for row in rows], capacity)
+
+    def get(self, conn, event_id):
+        with self._lock:
+            index = self._events.get(event_id)
+            if index is not None:
+                self._events.move_to_end(event_id)
+                pending, index.pending = index.pending, set()
+        if index is None:
+            index = self._load(conn, event_id)
+            self.stats['loads'] += 1
+            with self._lock:
+                # Another scan may have loaded it meanwhile, keep whichever is there
+                index = self._events.setdefault(event_id, index)
+                while len(self._events) > self.max_events:
+                    self._events.popitem(last=False)
+            return index
+        if pending:
+            self._learn(conn, index, 'ticket_id', pending)
+        return index
+
+    def _learn(self, conn, index, column, values):
+        # Add sold tickets to the index by ticket_id or barcode
+        values = list(values)
+        rows = conn.execute(f"""
+            SELECT barcode, {SCAN_COLUMNS} FROM Tickets
+            WHERE event_id = ? AND {column} IN ({', '.join('?' * len(values))})
+              AND status = {ticket_codes.SOLD} AND barcode IS NOT NULL
+        """, [index.event_id] + values).fetchall()
+        with self._lock:
+            for row in rows:
+                index.add(row['barcode'], dict(row, status=ticket_codes.SOLD))
+        return rows
+
+    def on_seat_change(self, seat):
+        with self._lock:
+            index = self._events.get(seat['event_id'])
+            if index is None:
+                return
+            if seat['status'] == ticket_codes.name(ticket_codes.SOLD):
+                index.pending.add(seat['ticket_id'])
+            else:
+                index.remove(seat['ticket_id'])
+
+    def forget(self, event_id=None):
+        with self._lock:
+            if event_id is None:
+                self._events.clear()
+            else:
+                self._events.pop(event_id, None)
+
+    # -- scanning ----------------------------------------------------------
+
+    def _entry(self, conn, index, barcode):
+        # The index entry for barcode, fetching it if the index hasn't seen the sale
+        with self._lock:
+            entry = index.lookup(barcode)
+        if entry is None:
+            self.stats['index_misses'] += 1
+            if self._learn(conn, index, 'barcode', [barcode]):
+                with self._lock:
+                    entry = index.entries.get(barcode)
+        return entry
+
+    def scan(self, conn, event_id, barcode, gate=None):
+        """Check a ticket in. Returns a dict with 'result' and, when there is one, the ticket."""
+        self.stats['scans'] += 1
+        index = self.get(conn, event_id)
+        entry = self._entry(conn, index, barcode)
+        if entry is None:
+            self.stats['rejected'] += 1
+            row = conn.execute(f'SELECT {SCAN_COLUMNS} FROM Tickets WHERE event_id = ? AND barcode = ?',
+                               (event_id, barcode)).fetchone()
+            return {'result': NOT_SOLD if row else INVALID, 'barcode': barcode}
+        if entry['checked_in_at'] is None:
+            results, _ = self._apply(conn, event_id, [(barcode, now(), gate)])
+            result = results[0]
+        else:
+            result = self._used(barcode, entry)
+        self.stats['accepted' if result['result'] == ACCEPTED else 'rejected'] += 1
+        return result
+
+    def _used(self, barcode, entry):
+        return {'result': ALREADY_USED, 'barcode': barcode, 'ticket_id': entry['ticket_id'],
+                'checked_in_at': entry['checked_in_at'], 'checked_in_gate': entry['checked_in_gate']}
+
+    def sync(self, conn, event_id, scans):
+        """Apply offline scans [(barcode, scanned_at, gate), ...].
+
+        Returns (results in the order given, conflicts): every scan that
+        lost to an earlier check-in of the same ticket is a conflict.
+        """
+        if len(scans) > MAX_SYNC_SCANS:
+            raise ScanError(f'At most {MAX_SYNC_SCANS} scans per sync')
+        index = self.get(conn, event_id)
+        for barcode, _, _ in scans:
+            self._entry(conn, index, barcode)  # make sure the index knows every sold barcode
+        order = sorted(range(len(scans)), key=lambda i: scans[i][1])
+        applied, _ = self._apply(conn, event_id, [scans[i] for i in order])
+        results = [None] * len(scans)
+        for i, result in zip(order, applied):
+            results[i] = result
+        conflicts = [dict(result, scanned_at=scans[i][1], gate=scans[i][2])
+                     for i, result in enumerate(results) if result['result'] == ALREADY_USED]
+        self.stats['synced'] += len(scans)
+        self.stats['conflicts'] += len(conflicts)
+        return results, conflicts
+
+    def _apply(self, conn, event_id, scans):
+        # One transaction for all of scans, in order. Returns (results, checked in count).
+        def work(cur):
+            results = []
+            for barcode, scanned_at, gate in scans:
+                cur.execute(f"""
+                    UPDATE Tickets SET checked_in_at = ?, checked_in_gate = ?
+                    WHERE event_id = ? AND barcode = ? AND status = {ticket_codes.SOLD} AND checked_in_at IS NULL
+                    RETURNING {SCAN_COLUMNS}
+                """, (scanned_at, gate, event_id, barcode))
+                row = cur.fetchone()
+                if row is not None:
+                    results.append(dict(_ticket(row), result=ACCEPTED, barcode=barcode))
+                    continue
+                row = cur.execute(f'SELECT {SCAN_COLUMNS} FROM Tickets WHERE event_id = ? AND barcode = ?',
+                                  (event_id, barcode)).fetchone()
+                if row is None:
+                    results.append({'result': INVALID, 'barcode': barcode})
+                elif row['status'] != ticket_codes.SOLD:
+                    results.append({'result': NOT_SOLD, 'barcode': barcode})
+                elif (row['checked_in_at'], row['checked_in_gate']) == (scanned_at, gate):
+                    results.append(dict(_ticket(row), result=ALREADY_SYNCED, barcode=barcode))
+                else:
+                    results.append(self._used(barcode, row))
+            # Check-ins don't change what the seat maps show, nothing to notify
+            return (results, sum(result['result'] == ACCEPTED for result in results)), []
+
+        results, checked_in = reservations.write_seats(conn, work)
+        with self._lock:
+            index = self._events.get(event_id)
+            if index is not None:
+                for result in results:
+                    entry = index.entries.get(result['barcode'])
+                    if entry is not None and 'checked_in_at' in result:
+                        entry['checked_in_at'] = result['checked_in_at']
+                        entry['checked_in_gate'] = result['checked_in_gate']
+        return results, checked_in
+
+    def bundle(self, conn, event_id):
+        """What a scanner needs to keep letting people in while offline."""
+        # Reload so sales made by other workers are in the filter too
+        self.forget(event_id)
+        index = self.get(conn, event_id)
+        with self._lock:
+            tickets = len(index.entries)
+            checked_in = sum(entry['checked_in_at'] is not None for entry in index.entries.values())
+            bloom = index.bloom.to_dict()
+        return {'event_id': event_id, 'generated_at': now(), 'tickets': tickets, 'checked_in': checked_in,
+                'false_positive_rate': FALSE_POSITIVE_RATE, 'bloom': bloom}
+
+
+def _ticket(row):
+    return {'ticket_id': row['ticket_id'], 'row_name': row['row_name'], 'seat_number': row['seat_number'],
+            'checked_in_at': row['checked_in_at'], 'checked_in_gate': row['checked_in_gate']}
+
+
+index = GateIndex()
+reservations.add_listener(index.on_seat_change)
+
+
+def init_app(app):
+    index.max_events = app.config.get('GATE_INDEX_MAX_EVENTS', DEFAULT_MAX_EVENTS)
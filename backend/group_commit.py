@@ -0,0 +1,228 @@
+import logging
+import queue
+import sqlite3 # Library for talking to our database
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+
+import db
+import reservations
+
+# Optional group commit for the seat write path.
+#
+# Normally every reserve / unreserve / buy is its own BEGIN IMMEDIATE ...
+# COMMIT, so the write rate is capped by how many commits SQLite can do per
+# second. With GROUP_COMMIT = True those operations are queued to one writer
+# thread instead. It collects up to GROUP_COMMIT_MAX_BATCH of them (waiting at
+# most GROUP_COMMIT_MAX_WAIT_MS after the first), runs them in a single
+# transaction with a savepoint around each one, and commits once. A seat
+# conflict only rolls back its own savepoint, so every caller still gets its
+# own result or exception.
+#
+# Seat change listeners are notified by the writer in batch order after the
+# commit, so a reserve and an unreserve of the same seat in one batch reach
+# the caches in the order they were applied.
+#
+# A batch can only commit to one file, so each event shard (see shards.py)
+# gets a writer of its own the first time it is written to, and the writer is
+# stopped when the shard is closed as idle.
+
+DEFAULT_MAX_BATCH = 64
+DEFAULT_MAX_WAIT_MS = 2.0
+DEFAULT_TIMEOUT = 10.0   # seconds a caller waits for its batch before giving up
+
+logger = logging.getLogger(__name__)
+
+
+class GroupCommitWriter:
+
+    def __init__(self, max_batch=DEFAULT_MAX_BATCH, max_wait_ms=DEFAULT_MAX_WAIT_MS, timeout=DEFAULT_TIMEOUT,
+                 pool=None):
+        self.pool = pool  # None for the central database, db.pool is swapped out by db.init_app
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.0
+        self.timeout = timeout
+        self._queue = queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = {'batches': 0, 'operations': 0, 'failed_batches': 0, 'largest_batch': 0}
+
+    def submit(self, work):
+        """Run work(cursor) -> (result, changed seats) in the next batch and return result (or raise)."""
+        if self._thread is None:
+            self.start()
+        future = Future()
+        self._queue.put((work, future))
+        try:
+            return future.result(self.timeout)
+        except FutureTimeout:
+            # Only give up if the writer hasn't picked it up yet, otherwise the
+            # caller would be told "failed" about a write that then commits
+            if future.cancel():
+                raise reservations.WriteContention(f'Write not applied within {self.timeout}s')
+            return future.result()
+
+    def start(self):
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='group-commit', daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        # Whatever is already queued still gets written
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def _collect(self):
+        batch = []
+        deadline = None
+        while len(batch) < self.max_batch:
+            if deadline is None:
+                item = self._queue.get()
+            else:
+                remaining = deadline - time.monotonic()
+                try:
+                    item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+            if item is None:
+                if batch:
+                    self._queue.put(None)  # stop after this batch
+                    break
+                return None
+            # Skip callers that already gave up waiting
+            if item[1].set_running_or_notify_cancel():
+                batch.append(item)
+                if deadline is None:
+                    deadline = time.monotonic() + self.max_wait
+        return batch
+
+    def _run(self):
+        # The writer has its own connection: taking one from the pool could
+        # deadlock with request threads that hold the rest and wait on us
+        conn = (self.pool or db.pool).dedicated()
+        try:
+            while True:
+                batch = self._collect()
+                if batch is None:
+                    return
+                self._run_batch(conn, batch)
+        finally:
+            conn.really_close()
+
+    def _run_batch(self, conn, batch):
+        try:
+            self._apply(conn, batch)
+        except Exception as e:
+            logger.exception('Group commit batch of %d failed', len(batch))
+            with self._stats_lock:
+                self._stats['failed_batches'] += 1
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+    def _apply(self, conn, batch):
+        def work(cur):
+            # Rebuilt on every attempt, run_write may retry the whole batch on SQLITE_BUSY
+            outcomes = []
+            for i, (item_work, _) in enumerate(batch):
+                cur.execute(f'SAVEPOINT op{i}')
+                try:
+                    outcomes.append((True, item_work(cur)))
+                except sqlite3.OperationalError as e:
+                    if reservations._is_busy(e):
+                        raise
+                    cur.execute(f'ROLLBACK TO op{i}')
+                    outcomes.append((False, e))
+                except Exception as e:
+                    cur.execute(f'ROLLBACK TO op{i}')
+                    outcomes.append((False, e))
+                cur.execute(f'RELEASE op{i}')
+            return outcomes
+
+        outcomes = reservations.run_write(conn, work)
+
+        with self._stats_lock:
+            self._stats['batches'] += 1
+            self._stats['operations'] += len(batch)
+            self._stats['largest_batch'] = max(self._stats['largest_batch'], len(batch))
+
+        # Each successful work returned (result, changed seats)
+        reservations.notify([seat for ok, outcome in outcomes if ok for seat in outcome[1]])
+        for (_, future), (ok, outcome) in zip(batch, outcomes):
+            if ok:
+                future.set_result(outcome[0])
+            else:
+                future.set_exception(outcome)
+
+    def stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats['queued'] = self._queue.qsize()
+        stats['average_batch'] = round(stats['operations'] / stats['batches'], 2) if stats['batches'] else 0.0
+        return stats
+
+
+writer = None       # the central database's writer
+_shard_writers = {}  # shard_id -> its writer
+_closed_stats = {}   # counters of the shard writers stopped so far
+_shard_lock = threading.Lock()
+
+
+def writer_for(conn):
+    pool = getattr(conn, '_pool', None)
+    shard_id = getattr(pool, 'shard_id', 0)
+    if pool is None or shard_id == 0:
+        return writer
+    with _shard_lock:
+        shard_writer = _shard_writers.get(shard_id)
+        if shard_writer is None:
+            # A reopened shard has a new pool, but any pool for the shard opens the same file
+            shard_writer = GroupCommitWriter(writer.max_batch, writer.max_wait * 1000.0, writer.timeout, pool=pool)
+            _shard_writers[shard_id] = shard_writer
+        return shard_writer
+
+
+def close_shard(shard_id):
+    # Called by shards.py when it closes an idle shard
+    with _shard_lock:
+        shard_writer = _shard_writers.pop(shard_id, None)
+    if shard_writer is not None:
+        shard_writer.stop()
+        with _shard_lock:
+            for name, value in shard_writer.stats().items():
+                if name in ('batches', 'operations', 'failed_batches'):
+                    _closed_stats[name] = _closed_stats.get(name, 0) + value
+                elif name == 'largest_batch':
+                    _closed_stats[name] = max(_closed_stats.get(name, 0), value)
+
+
+def stats():
+    # The central writer's stats, with the shard writers' counts added in
+    with _shard_lock:
+        writers = [writer] + list(_shard_writers.values())
+        combined = dict(_closed_stats)
+    for each in writers:
+        for name, value in each.stats().items():
+            if name == 'largest_batch':
+                combined[name] = max(combined.get(name, 0), value)
+            elif name != 'average_batch':
+                combined[name] = combined.get(name, 0) + value
+    combined['average_batch'] = round(combined['operations'] / combined['batches'], 2) if combined['batches'] else 0.0
+    combined['writers'] = len(writers)
+    return combined
+
+
+def init_app(app):
+    global writer
+    if not app.config.get('GROUP_COMMIT', False):
+        return
+    writer = GroupCommitWriter(
+        max_batch=app.config.get('GROUP_COMMIT_MAX_BATCH', DEFAULT_MAX_BATCH),
+        max_wait_ms=app.config.get('GROUP_COMMIT_MAX_WAIT_MS', DEFAULT_MAX_WAIT_MS),
+        timeout=app.config.get('GROUP_COMMIT_TIMEOUT', DEFAULT_TIMEOUT),
+    )
+    reservations.set_writer(writer_for)
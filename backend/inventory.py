@@ -0,0 +1,164 @@
+import itertools
+import os
+import time
+import uuid
+
+import pricing
+import reservations
+import ticket_codes
+
+# Bulk ticket generation. A venue layout describes sections, rows and seat
+# ranges, and we turn it into Tickets rows with executemany in fixed size
+# chunks inside a single write transaction. Seats that already exist are left
+# alone, so running the same layout twice is safe.
+#
+# Example layout:
+#
+#   {
+#     "price_tiers": {"floor": 12000, "balcony": 6500},
+#     "sections": [
+#       {"name": "Floor", "price_tier": "floor",
+#        "rows": [{"name": "A", "seats": [1, 20]}, {"name": "B", "seats": [[1, 10], [12, 20]]}]},
+#       {"name": "Balcony", "price_tier": "balcony", "rows": [{"name": "A", "seats": [1, 30]}]}
+#     ]
+#   }
+#
+# Rows are named "<section> <row>" (e.g. "Floor A"), or just the row name when
+# the section has no name. The section is also recorded on the row itself
+# (Ticket_Rows.section) for pricing.py, row labels can contain spaces so the
+# name alone can't be split back up. A row may carry its own price_tier.
+
+CHUNK_SIZE = 5000
+MAX_SEATS = 500000
+
+
+class LayoutError(ValueError):
+    """The layout JSON is malformed."""
+
+
+def _seat_ranges(spec):
+    # [1, 20] is a single range, [[1, 10], [12, 20]] is several
+    if not isinstance(spec, list) or not spec:
+        raise LayoutError('seats must be [first, last] or a list of [first, last] ranges')
+    ranges = [spec] if all(isinstance(n, int) for n in spec) else spec
+    for r in ranges:
+        if (not isinstance(r, list) or len(r) != 2 or not all(isinstance(n, int) for n in r)
+                or r[0] > r[1] or r[0] < 0 or r[1] > ticket_codes.MAX_SEAT_NUMBER):
+            raise LayoutError(f'Invalid seat range {r!r}')
+    return ranges
+
+
+def parse_layout(layout):
+    """Validate a layout and return ([(row_name, section, [(first, last), ...]), ...], {row_name: price_cents}).
+
+    section is None for rows in a section without a name.
+    """
+    if not isinstance(layout, dict) or not isinstance(layout.get('sections'), list):
+        raise LayoutError('Layout must have a list of sections')
+
+    tiers = layout.get('price_tiers') or {}
+    if not isinstance(tiers, dict):
+        raise LayoutError('price_tiers must be an object of tier name to price in cents')
+    for tier, cents in tiers.items():
+        if not isinstance(cents, int) or isinstance(cents, bool) or cents < 0:
+            raise LayoutError(f'Price tier {tier!r} needs a non-negative integer price in cents')
+
+    rows = []
+    prices = {}
+    seen = set()
+    total = 0
+
+    for section in layout['sections']:
+        if not isinstance(section, dict):
+            raise LayoutError('Every section must be an object')
+        section_name = section.get('name') or ''
+        if not isinstance(section_name, str):
+            raise LayoutError('Section names must be text')
+        section_name = section_name.strip()
+        section_rows = section.get('rows') or []
+        if not isinstance(section_rows, list):
+            raise LayoutError(f'Section {section_name!r} rows must be a list')
+        for row in section_rows:
+            if not isinstance(row, dict):
+                raise LayoutError(f'Every row in section {section_name!r} must be an object')
+            row_label = str(row.get('name') or '').strip()
+            if not row_label:
+                raise LayoutError('Every row needs a name')
+            row_name = f'{section_name} {row_label}' if section_name else row_label
+            if row_name in seen:
+                raise LayoutError(f'Row {row_name!r} appears twice')
+            seen.add(row_name)
+
+            ranges = _seat_ranges(row.get('seats'))
+            total += sum(last - first + 1 for first, last in ranges)
+            rows.append((row_name, section_name or None, ranges))
+
+            tier = row.get('price_tier') or section.get('price_tier')
+            if tier is not None:
+                if not isinstance(tier, str) or tier not in tiers:
+                    raise LayoutError(f'Unknown price tier {tier!r}')
+                prices[row_name] = tiers[tier]
+
+    if total > MAX_SEATS:
+        raise LayoutError(f'Layout has {total} seats, the limit is {MAX_SEATS}')
+    return rows, prices
+
+
+def _barcodes():
+    # One urandom call per chunk is a lot cheaper than uuid4() per seat
+    while True:
+        block = os.urandom(16 * CHUNK_SIZE)
+        for i in range(0, len(block), 16):
+            yield str(uuid.UUID(bytes=block[i:i + 16], version=4))
+
+
+def _ticket_rows(event_id, rows):
+    barcodes = _barcodes()
+    for row_name, _, ranges in rows:
+        for first, last in ranges:
+            for seat_number in range(first, last + 1):
+                yield (event_id, row_name, seat_number, ticket_codes.AVAILABLE, next(barcodes),
+                       event_id, event_id, row_name, seat_number)
+
+
+def generate(conn, event_id, layout):
+    """Create the tickets (and row prices) for a layout. Returns a summary dict."""
+    started = time.perf_counter()
+    rows, prices = parse_layout(layout)
+
+    def work(cur):
+        created = 0
+        seats = 0
+        tickets = _ticket_rows(event_id, rows)
+        while True:
+            chunk = list(itertools.islice(tickets, CHUNK_SIZE))
+            if not chunk:
+                break
+            seats += len(chunk)
+            cur.executemany(f"""
+                INSERT INTO Tickets (event_id, row_name, seat_number, status, barcode)
+                SELECT ?, ?, ?, ?, ?
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM Tickets WHERE event_id = ? AND seat_key = {ticket_codes.SEAT_KEY_SQL}
+                )
+            """, chunk)
+            created += cur.rowcount
+
+        cur.executemany('UPDATE Ticket_Rows SET section = ? WHERE event_id = ? AND row_name = ?',
+                        [(section, event_id, row_name) for row_name, section, _ in rows])
+
+        # Row prices are replaced, so re-running a layout with new tiers reprices it
+        if prices:
+            pricing.replace_prices(cur, event_id, prices)
+        return seats, created
+
+    seats, created = reservations.run_write(conn, work)
+    return {
+        'event_id': event_id,
+        'rows': len(rows),
+        'seats_in_layout': seats,
+        'tickets_created': created,
+        'tickets_already_present': seats - created,
+        'rows_priced': len(prices),
+        'elapsed_ms': round((time.perf_counter() - started) * 1000, 2),
+    }
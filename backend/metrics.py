@@ -0,0 +1,311 @@
+import json
+import logging
+import random
+import re
+import sqlite3 # Library for talking to our database
+import threading
+import time
+from bisect import bisect_left
+
+from flask import g, request
+from flask.json.provider import DefaultJSONProvider
+
+import db
+
+# Request and SQL instrumentation.
+#
+# Every request gets a trace that adds up where its time went: waiting for a
+# pooled connection, running SQL (per normalized statement), waiting for the
+# write lock (BEGIN IMMEDIATE), and serializing JSON. Totals are exported in
+# Prometheus text format at /metrics, statements slower than SLOW_QUERY_MS go
+# to the slow query log, and a sample of requests is logged as one JSON line.
+#
+# With METRICS_ENABLED = False none of this is installed: connections are
+# plain pooled connections and no request hooks are registered.
+
+DEFAULT_SLOW_QUERY_MS = 100.0
+DEFAULT_LOG_SAMPLE_RATE = 0.0
+
+# Request duration histogram buckets, in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+PHASES = ('db_connect', 'sql', 'lock_wait', 'serialize', 'other')
+
+request_logger = logging.getLogger('tessera.requests')
+slow_query_logger = logging.getLogger('tessera.slow_query')
+
+_local = threading.local()
+_lock = threading.Lock()
+
+# (route, method, status) -> count
+_requests = {}
+# route -> [bucket counts..., +Inf count, sum of seconds]
+_durations = {}
+# (route, phase) -> seconds
+_phases = {}
+# normalized sql -> [calls, seconds, rows]
+_statements = {}
+
+slow_query_ms = DEFAULT_SLOW_QUERY_MS
+log_sample_rate = DEFAULT_LOG_SAMPLE_RATE
+
+
+# -- SQL normalization -------------------------------------------------------
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r'\b\d+(?:\.\d+)?\b')
+_IN_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+_SPACE = re.compile(r'\s+')
+_normalized = {}
+
+
+def normalize_sql(sql):
+    # Statements come from a fixed set of strings in the code, so cache them
+    cached = _normalized.get(sql)
+    if cached is None:
+        text = _SPACE.sub(' ', sql).strip()
+        text = _STRING.sub('?', text)
+        text = _NUMBER.sub('?', text)
+        cached = _IN_LIST.sub('(...)', text)
+        if len(_normalized) < 10000:
+            _normalized[sql] = cached
+    return cached
+
+
+# -- per request traces ------------------------------------------------------
+
+class Trace:
+
+    __slots__ = ('started', 'phases', 'statements', 'last')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        self.statements = 0
+        self.last = None  # [normalized sql, seconds, rows] of the statement being fetched
+
+
+def _record_statement(sql, seconds, rows):
+    trace = getattr(_local, 'trace', None)
+    normalized = normalize_sql(sql)
+
+    # Waiting on BEGIN IMMEDIATE is lock wait, not query time
+    if trace is not None:
+        phase = 'lock_wait' if normalized.upper().startswith('BEGIN IMMEDIATE') else 'sql'
+        trace.phases[phase] += seconds
+        trace.statements += 1
+
+    with _lock:
+        stats = _statements.get(normalized)
+        if stats is None:
+            stats = _statements[normalized] = [0, 0.0, 0]
+        stats[0] += 1
+        stats[1] += seconds
+        stats[2] += max(rows, 0)
+
+    if seconds * 1000 >= slow_query_ms:
+        slow_query_logger.warning(json.dumps({
+            'sql': normalized,
+            'ms': round(seconds * 1000, 3),
+            'rows': rows,
+            'route': _route() if trace is not None else None,
+        }))
+    return normalized
+
+
+class TracedCursor(sqlite3.Cursor):
+
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._sql = sql
+            _record_statement(sql, time.perf_counter() - started, self.rowcount)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self._sql = sql
+            _record_statement(sql, time.perf_counter() - started, self.rowcount)
+
+    def _fetched(self, started, rows):
+        # Time spent stepping through results counts towards the statement that produced them
+        seconds = time.perf_counter() - started
+        trace = getattr(_local, 'trace', None)
+        if trace is not None:
+            trace.phases['sql'] += seconds
+        sql = getattr(self, '_sql', None)
+        if sql is not None:
+            normalized = normalize_sql(sql)
+            with _lock:
+                stats = _statements.get(normalized)
+                if stats is not None:
+                    stats[1] += seconds
+                    stats[2] += rows
+
+    def fetchone(self):
+        started = time.perf_counter()
+        row = super().fetchone()
+        self._fetched(started, 0 if row is None else 1)
+        return row
+
+    def fetchmany(self, size=None):
+        started = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self._fetched(started, len(rows))
+        return rows
+
+    def fetchall(self):
+        started = time.perf_counter()
+        rows = super().fetchall()
+        self._fetched(started, len(rows))
+        return rows
+
+
+class TracedConnection(db.PooledConnection):
+    # sqlite3.Connection.execute doesn't go through cursor(), so route the
+    # shortcuts through a TracedCursor ourselves
+
+    def cursor(self, factory=TracedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+class TimedJSONProvider(DefaultJSONProvider):
+
+    def dumps(self, obj, **kwargs):
+        started = time.perf_counter()
+        try:
+            return super().dumps(obj, **kwargs)
+        finally:
+            trace = getattr(_local, 'trace', None)
+            if trace is not None:
+                trace.phases['serialize'] += time.perf_counter() - started
+
+
+def _route():
+    rule = request.url_rule
+    return rule.rule if rule is not None else 'unmatched'
+
+
+def _start_trace():
+    _local.trace = Trace()
+
+
+def _finish_trace(response):
+    trace = getattr(_local, 'trace', None)
+    if trace is None:
+        return response
+    _local.trace = None
+
+    wall = time.perf_counter() - trace.started
+    trace.phases['db_connect'] = g.get('db_connect_seconds', 0.0)
+    trace.phases['other'] = max(0.0, wall - sum(seconds for phase, seconds in trace.phases.items() if phase != 'other'))
+    route = _route()
+
+    with _lock:
+        key = (route, request.method, response.status_code)
+        _requests[key] = _requests.get(key, 0) + 1
+
+        histogram = _durations.get(route)
+        if histogram is None:
+            histogram = _durations[route] = [0] * (len(BUCKETS) + 1) + [0.0]
+        histogram[bisect_left(BUCKETS, wall)] += 1
+        histogram[-1] += wall
+
+        for phase, seconds in trace.phases.items():
+            _phases[(route, phase)] = _phases.get((route, phase), 0.0) + seconds
+
+    if log_sample_rate and random.random() < log_sample_rate:
+        request_logger.info(json.dumps({
+            'route': route,
+            'method': request.method,
+            'status': response.status_code,
+            'ms': round(wall * 1000, 3),
+            'statements': trace.statements,
+            'phases_ms': {phase: round(seconds * 1000, 3) for phase, seconds in trace.phases.items()},
+        }))
+    return response
+
+
+# -- Prometheus exposition ---------------------------------------------------
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', ' ')
+
+
+def render(extra_gauges=None):
+    """Everything we have collected, in Prometheus text format."""
+    with _lock:
+        requests_total = dict(_requests)
+        durations = {route: list(h) for route, h in _durations.items()}
+        phases = dict(_phases)
+        statements = {sql: list(s) for sql, s in _statements.items()}
+
+    lines = ['# HELP tessera_http_requests_total Requests handled, by route, method and status.',
+             '# TYPE tessera_http_requests_total counter']
+    for (route, method, status), count in sorted(requests_total.items()):
+        lines.append(f'tessera_http_requests_total{{route="{_label(route)}",method="{method}",status="{status}"}} {count}')
+
+    lines += ['# HELP tessera_http_request_duration_seconds Request wall time.',
+              '# TYPE tessera_http_request_duration_seconds histogram']
+    for route, histogram in sorted(durations.items()):
+        cumulative = 0
+        for bound, count in zip(BUCKETS, histogram):
+            cumulative += count
+            lines.append(f'tessera_http_request_duration_seconds_bucket{{route="{_label(route)}",le="{bound}"}} {cumulative}')
+        cumulative += histogram[len(BUCKETS)]
+        lines.append(f'tessera_http_request_duration_seconds_bucket{{route="{_label(route)}",le="+Inf"}} {cumulative}')
+        lines.append(f'tessera_http_request_duration_seconds_sum{{route="{_label(route)}"}} {histogram[-1]:.6f}')
+        lines.append(f'tessera_http_request_duration_seconds_count{{route="{_label(route)}"}} {cumulative}')
+
+    lines += ['# HELP tessera_request_phase_seconds_total Request time split by phase.',
+              '# TYPE tessera_request_phase_seconds_total counter']
+    for (route, phase), seconds in sorted(phases.items()):
+        lines.append(f'tessera_request_phase_seconds_total{{route="{_label(route)}",phase="{phase}"}} {seconds:.6f}')
+
+    lines += ['# HELP tessera_sql_statements_total Executions per normalized SQL statement.',
+              '# TYPE tessera_sql_statements_total counter']
+    for sql, (calls, _, _) in sorted(statements.items()):
+        lines.append(f'tessera_sql_statements_total{{statement="{_label(sql)}"}} {calls}')
+    lines += ['# HELP tessera_sql_seconds_total Time spent executing and fetching per normalized SQL statement.',
+              '# TYPE tessera_sql_seconds_total counter']
+    for sql, (_, seconds, _) in sorted(statements.items()):
+        lines.append(f'tessera_sql_seconds_total{{statement="{_label(sql)}"}} {seconds:.6f}')
+    lines += ['# HELP tessera_sql_rows_total Rows changed or fetched per normalized SQL statement.',
+              '# TYPE tessera_sql_rows_total counter']
+    for sql, (_, _, rows) in sorted(statements.items()):
+        lines.append(f'tessera_sql_rows_total{{statement="{_label(sql)}"}} {rows}')
+
+    for name, value in sorted((extra_gauges or {}).items()):
+        lines.append(f'# TYPE {name} gauge')
+        lines.append(f'{name} {value}')
+
+    return '\n'.join(lines) + '\n'
+
+
+def init_app(app):
+    global slow_query_ms, log_sample_rate
+    if not app.config.get('METRICS_ENABLED', True):
+        return
+
+    slow_query_ms = app.config.get('SLOW_QUERY_MS', DEFAULT_SLOW_QUERY_MS)
+    log_sample_rate = app.config.get('METRICS_LOG_SAMPLE_RATE', DEFAULT_LOG_SAMPLE_RATE)
+
+    # Both central pools. Shard pools and the read snapshot copy db.pool's
+    # factory when they open. Connections opened before this (migrations runs
+    # first) are closed so the pools reopen them traced.
+    db.pool.connection_factory = TracedConnection
+    db.read_pool.connection_factory = TracedConnection
+    db.pool.close_all()
+    db.read_pool.close_all()
+    app.json = TimedJSONProvider(app)
+    app.before_request(_start_trace)
+    app.after_request(_finish_trace)
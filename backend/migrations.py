@@ -0,0 +1,575 @@
+import argparse
+import re
+import sqlite3
+import sys
+
+import db
+import sales
+import ticket_codes
+
+# Versioned schema migrations.
+#
+# The database used to be created by hand from database/tessera.sqbpro, so
+# nothing guaranteed which indexes existed and there were two price tables
+# (the old per-event TicketPrices in dollars and the per-row Ticket_Prices in
+# cents that the code actually reads). Each migration below runs once, in its
+# own transaction, and PRAGMA user_version records how far a database has
+# got. A fresh file ends up with the full schema; an existing one only gets
+# the steps it is missing. Everything uses IF NOT EXISTS so databases made
+# from the .sqbpro are adopted as version 1 without changes.
+#
+#   cd backend && python migrations.py ../database/tessera.db           # migrate
+#   cd backend && python migrations.py ../database/tessera.db --check   # fail on full scans
+
+BASE_TABLES = """
+CREATE TABLE IF NOT EXISTS Users (
+    user_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    email TEXT NOT NULL UNIQUE,
+    first_name TEXT,
+    last_name TEXT,
+    username TEXT NOT NULL UNIQUE,
+    password_hash TEXT NOT NULL,
+    role TEXT NOT NULL DEFAULT 'user',
+    avatar TEXT
+);
+
+CREATE TABLE IF NOT EXISTS Events (
+    event_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL,
+    description TEXT,
+    date TEXT NOT NULL,
+    time TEXT,
+    location TEXT,
+    url TEXT,
+    image_url TEXT
+);
+
+CREATE TABLE IF NOT EXISTS Tickets (
+    ticket_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    event_id INTEGER NOT NULL,
+    row_name TEXT,
+    seat_number INTEGER,
+    status TEXT NOT NULL,
+    barcode TEXT,
+    user_id INTEGER,
+    reservation_time TEXT,
+    price REAL
+);
+
+CREATE TABLE IF NOT EXISTS Ticket_Prices (
+    event_id INTEGER NOT NULL,
+    row_name TEXT NOT NULL,
+    price_cents INTEGER NOT NULL
+);
+"""
+
+HOT_QUERY_INDEXES = """
+-- reserve / unreserve / buy look a seat up by its position
+CREATE UNIQUE INDEX IF NOT EXISTS idx_tickets_event_seat ON Tickets (event_id, row_name, seat_number);
+-- counts and lists of one event's tickets by status
+CREATE INDEX IF NOT EXISTS idx_tickets_event_status ON Tickets (event_id, status);
+-- the expiry sweeper looks for RESERVED seats with a reservation_time
+CREATE INDEX IF NOT EXISTS idx_tickets_status_reserved ON Tickets (status, reservation_time);
+-- a user's tickets (?user_id= filter)
+CREATE INDEX IF NOT EXISTS idx_tickets_user ON Tickets (user_id);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_users_username ON Users (username);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_users_email ON Users (email);
+"""
+
+COMPACT_TABLES = """
+CREATE TABLE IF NOT EXISTS Ticket_Statuses (
+    code INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE
+);
+
+-- Per event row numbering behind Tickets.seat_key, see ticket_codes.py
+CREATE TABLE IF NOT EXISTS Ticket_Rows (
+    event_id INTEGER NOT NULL,
+    row_index INTEGER NOT NULL,
+    row_name TEXT NOT NULL,
+    PRIMARY KEY (event_id, row_index),
+    UNIQUE (event_id, row_name)
+) WITHOUT ROWID;
+"""
+
+# Number a new row and fill in seat_key for tickets however they are inserted
+# or moved. A duplicate seat fails on the unique (event_id, seat_key) index.
+SEAT_KEY_TRIGGER_BODY = f"""
+    SELECT RAISE(ABORT, 'seat_number out of range')
+    WHERE NEW.seat_number NOT BETWEEN 0 AND {ticket_codes.MAX_SEAT_NUMBER};
+    INSERT INTO Ticket_Rows (event_id, row_index, row_name)
+    SELECT NEW.event_id,
+           (SELECT COALESCE(MAX(row_index) + 1, 0) FROM Ticket_Rows WHERE event_id = NEW.event_id),
+           NEW.row_name
+    WHERE NOT EXISTS (SELECT 1 FROM Ticket_Rows WHERE event_id = NEW.event_id AND row_name = NEW.row_name);
+    UPDATE Tickets
+    SET seat_key = (SELECT row_index << {ticket_codes.SEAT_BITS} FROM Ticket_Rows
+                    WHERE event_id = NEW.event_id AND row_name = NEW.row_name) | NEW.seat_number
+    WHERE ticket_id = NEW.ticket_id;
+"""
+
+COMPACT_INDEXES = f"""
+CREATE UNIQUE INDEX IF NOT EXISTS idx_tickets_event_seat_key ON Tickets (event_id, seat_key);
+CREATE INDEX IF NOT EXISTS idx_tickets_event_status ON Tickets (event_id, status);
+-- only held seats, which is all the expiry sweeper looks at
+CREATE INDEX IF NOT EXISTS idx_tickets_reserved ON Tickets (reservation_time) WHERE status = {ticket_codes.RESERVED};
+
+CREATE TRIGGER IF NOT EXISTS tickets_seat_key_insert AFTER INSERT ON Tickets
+WHEN NEW.row_name IS NOT NULL AND NEW.seat_number IS NOT NULL
+BEGIN{SEAT_KEY_TRIGGER_BODY}END;
+
+CREATE TRIGGER IF NOT EXISTS tickets_seat_key_update AFTER UPDATE OF event_id, row_name, seat_number ON Tickets
+WHEN NEW.row_name IS NOT NULL AND NEW.seat_number IS NOT NULL
+BEGIN{SEAT_KEY_TRIGGER_BODY}END;
+"""
+
+# Holds and payments used to be created on first use by carts.py. Every
+# shard needs them too, so they are part of the schema now.
+HOLDS_AND_SHARDS = """
+CREATE TABLE IF NOT EXISTS Holds (
+    hold_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    event_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    status TEXT NOT NULL DEFAULT 'ACTIVE',
+    reserved_at TEXT NOT NULL,
+    expires_at REAL NOT NULL,
+    created_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS Hold_Seats (
+    hold_id INTEGER NOT NULL,
+    ticket_id INTEGER NOT NULL,
+    PRIMARY KEY (hold_id, ticket_id)
+);
+
+CREATE TABLE IF NOT EXISTS Payments (
+    payment_intent_id TEXT PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    amount_cents INTEGER NOT NULL,
+    hold_id INTEGER,
+    created_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Which shard holds an event's tickets, see shards.py. Only used in the central database.
+CREATE TABLE IF NOT EXISTS Event_Shards (
+    event_id INTEGER PRIMARY KEY,
+    shard_id INTEGER NOT NULL
+);
+"""
+
+# Gate check-in (see gate.py). A ticket stays SOLD when it is scanned, the
+# check-in is recorded next to it and can only happen once.
+GATE_CHECK_IN = """
+ALTER TABLE Tickets ADD COLUMN checked_in_at TEXT;
+ALTER TABLE Tickets ADD COLUMN checked_in_gate TEXT;
+CREATE INDEX IF NOT EXISTS idx_tickets_barcode ON Tickets (barcode) WHERE barcode IS NOT NULL;
+"""
+
+# Sales and occupancy aggregates (see sales.py), kept by triggers in the same
+# transaction as every ticket change so they can't drift from Tickets.
+SALES_TABLES = """
+CREATE TABLE IF NOT EXISTS Sales_Events (
+    event_id INTEGER PRIMARY KEY,
+    available INTEGER NOT NULL DEFAULT 0,
+    reserved INTEGER NOT NULL DEFAULT 0,
+    sold INTEGER NOT NULL DEFAULT 0,
+    revenue_cents INTEGER NOT NULL DEFAULT 0
+);
+
+-- row_name is '' for tickets without a seat (POST /create_ticket)
+CREATE TABLE IF NOT EXISTS Sales_Rows (
+    event_id INTEGER NOT NULL,
+    row_name TEXT NOT NULL,
+    available INTEGER NOT NULL DEFAULT 0,
+    reserved INTEGER NOT NULL DEFAULT 0,
+    sold INTEGER NOT NULL DEFAULT 0,
+    revenue_cents INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (event_id, row_name)
+) WITHOUT ROWID;
+
+-- Holds and sales per event per bucket of sales.BUCKET_SECONDS
+CREATE TABLE IF NOT EXISTS Sales_Buckets (
+    event_id INTEGER NOT NULL,
+    bucket_start INTEGER NOT NULL,
+    reserved INTEGER NOT NULL DEFAULT 0,
+    sold INTEGER NOT NULL DEFAULT 0,
+    revenue_cents INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (event_id, bucket_start)
+) WITHOUT ROWID;
+"""
+
+# Listing indexes and the search index behind GET /events (see catalog.py)
+CATALOG_SEARCH = """
+CREATE INDEX IF NOT EXISTS idx_events_date_id ON Events (date, event_id);
+CREATE INDEX IF NOT EXISTS idx_events_location_date_id ON Events (location, date, event_id);
+
+CREATE VIRTUAL TABLE IF NOT EXISTS Events_fts USING fts5(
+    name, description, location,
+    content='Events', content_rowid='event_id',
+    tokenize='unicode61 remove_diacritics 2'
+);
+"""
+
+# Per-event hold TTLs (see expiry.py), which used to be created at runtime
+EVENT_SETTINGS = """
+CREATE TABLE IF NOT EXISTS Event_Settings (
+    event_id INTEGER PRIMARY KEY,
+    hold_ttl_seconds INTEGER NOT NULL
+);
+"""
+
+# Saved venue layouts (see venues.py), which used to be created at runtime
+VENUE_TEMPLATES = """
+CREATE TABLE IF NOT EXISTS Venue_Templates (
+    template_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL UNIQUE,
+    layout TEXT NOT NULL,
+    created_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+"""
+
+# The layout section a row was generated in (see inventory.py), which pricing
+# rules are matched against. NULL for rows that aren't in a section.
+ROW_SECTIONS = """
+ALTER TABLE Ticket_Rows ADD COLUMN section TEXT;
+"""
+
+
+def _ticket_price_sql(ref):
+    # What a ticket sells for: its row price, or the old per-ticket dollar price
+    return (f'COALESCE((SELECT price_cents FROM Ticket_Prices WHERE event_id = {ref}.event_id '
+            f'AND row_name = {ref}.row_name), CAST(ROUND({ref}.price * 100) AS INTEGER), 0)')
+
+
+def _sales_delta_sql(ref, sign):
+    # Add (sign '+') or take away (sign '-') one ticket from the event and row totals
+    values = (f"{sign}({ref}.status = {ticket_codes.AVAILABLE}), {sign}({ref}.status = {ticket_codes.RESERVED}), "
+              f"{sign}({ref}.status = {ticket_codes.SOLD}), "
+              f"{sign}(CASE WHEN {ref}.status = {ticket_codes.SOLD} THEN {_ticket_price_sql(ref)} ELSE 0 END)")
+    totals = ('available = available + excluded.available, reserved = reserved + excluded.reserved, '
+              'sold = sold + excluded.sold, revenue_cents = revenue_cents + excluded.revenue_cents')
+    return f"""
+    INSERT INTO Sales_Events (event_id, available, reserved, sold, revenue_cents)
+    VALUES ({ref}.event_id, {values})
+    ON CONFLICT (event_id) DO UPDATE SET {totals};
+    INSERT INTO Sales_Rows (event_id, row_name, available, reserved, sold, revenue_cents)
+    VALUES ({ref}.event_id, COALESCE({ref}.row_name, ''), {values})
+    ON CONFLICT (event_id, row_name) DO UPDATE SET {totals};
+"""
+
+
+SALES_TRIGGERS = f"""
+CREATE TRIGGER IF NOT EXISTS tickets_sales_insert AFTER INSERT ON Tickets
+BEGIN{_sales_delta_sql('NEW', '+')}END;
+
+CREATE TRIGGER IF NOT EXISTS tickets_sales_delete AFTER DELETE ON Tickets
+BEGIN{_sales_delta_sql('OLD', '-')}END;
+
+CREATE TRIGGER IF NOT EXISTS tickets_sales_update AFTER UPDATE OF event_id, row_name, status ON Tickets
+WHEN OLD.status IS NOT NEW.status OR OLD.row_name IS NOT NEW.row_name OR OLD.event_id IS NOT NEW.event_id
+BEGIN{_sales_delta_sql('OLD', '-')}{_sales_delta_sql('NEW', '+')}
+    INSERT INTO Sales_Buckets (event_id, bucket_start, reserved, sold, revenue_cents)
+    SELECT NEW.event_id, unixepoch() / {sales.BUCKET_SECONDS} * {sales.BUCKET_SECONDS},
+           NEW.status = {ticket_codes.RESERVED}, NEW.status = {ticket_codes.SOLD},
+           CASE WHEN NEW.status = {ticket_codes.SOLD} THEN {_ticket_price_sql('NEW')} ELSE 0 END
+    WHERE NEW.status IN ({ticket_codes.RESERVED}, {ticket_codes.SOLD}) AND OLD.status IS NOT NEW.status
+    ON CONFLICT (event_id, bucket_start) DO UPDATE SET
+        reserved = reserved + excluded.reserved, sold = sold + excluded.sold,
+        revenue_cents = revenue_cents + excluded.revenue_cents;
+END;
+"""
+
+
+class MigrationError(Exception):
+    """A migration can't be applied to the data that is there."""
+
+
+def _statements(script):
+    # Split a script into statements, keeping trigger bodies (which contain ';') whole
+    statement = ''
+    for line in script.splitlines(keepends=True):
+        if not statement and (not line.strip() or line.lstrip().startswith('--')):
+            continue
+        statement += line
+        if sqlite3.complete_statement(statement):
+            yield statement.strip()
+            statement = ''
+    if statement.strip():
+        raise MigrationError(f'Incomplete statement in migration: {statement.strip()[:60]}')
+
+
+def run_script(cur, script):
+    # Like executescript, but inside the caller's transaction
+    for statement in _statements(script):
+        cur.execute(statement)
+
+
+def _table_exists(cur, name):
+    cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,))
+    return cur.fetchone() is not None
+
+
+def _check_unique(cur, table, columns):
+    cur.execute(f"""
+        SELECT COUNT(*) AS groups FROM (
+            SELECT 1 FROM {table} GROUP BY {columns} HAVING COUNT(*) > 1
+        )
+    """)
+    duplicates = cur.fetchone()[0]
+    if duplicates:
+        raise MigrationError(f'{table} has {duplicates} duplicated ({columns}) values, '
+                             f'fix them before the unique index can be created')
+
+
+def _base_tables(cur):
+    run_script(cur, BASE_TABLES)
+
+
+def _merge_ticket_prices(cur):
+    # Ticket_Prices is what every query reads. Keep the newest row of any
+    # duplicated (event, row), carry over the old per-event dollar prices
+    # for events that never got row prices, then drop the old table.
+    cur.execute("""
+        DELETE FROM Ticket_Prices WHERE rowid NOT IN (
+            SELECT MAX(rowid) FROM Ticket_Prices GROUP BY event_id, row_name
+        )
+    """)
+    if _table_exists(cur, 'TicketPrices'):
+        cur.execute("""
+            INSERT INTO Ticket_Prices (event_id, row_name, price_cents)
+            SELECT DISTINCT t.event_id, t.row_name, CAST(ROUND(tp.price * 100) AS INTEGER)
+            FROM TicketPrices tp
+            JOIN Tickets t ON t.event_id = tp.event_id
+            WHERE t.row_name IS NOT NULL
+              AND NOT EXISTS (SELECT 1 FROM Ticket_Prices p WHERE p.event_id = tp.event_id)
+        """)
+        cur.execute('DROP TABLE TicketPrices')
+    cur.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_ticket_prices_event_row ON Ticket_Prices (event_id, row_name)')
+
+
+def _hot_query_indexes(cur):
+    _check_unique(cur, 'Tickets', 'event_id, row_name, seat_number')
+    _check_unique(cur, 'Users', 'username')
+    _check_unique(cur, 'Users', 'email')
+    run_script(cur, HOT_QUERY_INDEXES)
+
+
+def _compact_tickets(cur):
+    # Integer status codes and seat keys (ticket_codes.py). The status column
+    # is swapped for an INTEGER one in place rather than rebuilding Tickets,
+    # so any extra columns an older database has are kept.
+    run_script(cur, COMPACT_TABLES)
+    cur.executemany('INSERT OR REPLACE INTO Ticket_Statuses (code, name) VALUES (?, ?)',
+                    list(ticket_codes.NAMES.items()))
+
+    names = ', '.join(f"'{status}'" for status in ticket_codes.CODES)
+    cur.execute(f'SELECT DISTINCT status FROM Tickets WHERE UPPER(status) NOT IN ({names})')
+    unknown = [row[0] for row in cur.fetchall()]
+    if unknown:
+        raise MigrationError(f'Tickets has statuses with no code: {", ".join(map(repr, unknown))}')
+    cur.execute(f"""
+        SELECT COUNT(*) FROM Tickets
+        WHERE row_name IS NOT NULL AND seat_number NOT BETWEEN 0 AND {ticket_codes.MAX_SEAT_NUMBER}
+    """)
+    if cur.fetchone()[0]:
+        raise MigrationError(f'Tickets has seat numbers outside 0-{ticket_codes.MAX_SEAT_NUMBER}')
+
+    for index in ('idx_tickets_event_seat', 'idx_tickets_event_status', 'idx_tickets_status_reserved'):
+        cur.execute(f'DROP INDEX IF EXISTS {index}')
+    cur.execute('ALTER TABLE Tickets ADD COLUMN status_code INTEGER NOT NULL DEFAULT 0')
+    cur.execute(f'UPDATE Tickets SET status_code = CASE UPPER(status) '
+                + ' '.join(f"WHEN '{status}' THEN {code}" for status, code in ticket_codes.CODES.items())
+                + ' END')
+    cur.execute('ALTER TABLE Tickets DROP COLUMN status')
+    cur.execute('ALTER TABLE Tickets RENAME COLUMN status_code TO status')
+
+    cur.execute('ALTER TABLE Tickets ADD COLUMN seat_key INTEGER')
+    cur.execute("""
+        INSERT INTO Ticket_Rows (event_id, row_index, row_name)
+        SELECT event_id, ROW_NUMBER() OVER (PARTITION BY event_id ORDER BY MIN(ticket_id)) - 1, row_name
+        FROM Tickets
+        WHERE row_name IS NOT NULL AND seat_number IS NOT NULL
+        GROUP BY event_id, row_name
+    """)
+    cur.execute(f"""
+        UPDATE Tickets
+        SET seat_key = (SELECT row_index << {ticket_codes.SEAT_BITS} FROM Ticket_Rows r
+                        WHERE r.event_id = Tickets.event_id AND r.row_name = Tickets.row_name) | seat_number
+        WHERE row_name IS NOT NULL AND seat_number IS NOT NULL
+    """)
+    run_script(cur, COMPACT_INDEXES)
+
+
+def _holds_and_shards(cur):
+    run_script(cur, HOLDS_AND_SHARDS)
+
+
+def _gate_check_in(cur):
+    run_script(cur, GATE_CHECK_IN)
+
+
+def _sales_aggregates(cur):
+    run_script(cur, SALES_TABLES)
+    # Totals for the tickets already there. There's no record of when they
+    # sold, so the velocity buckets start from now.
+    price = _ticket_price_sql('t')
+    for table, key in (('Sales_Events', 't.event_id'), ('Sales_Rows', "t.event_id, COALESCE(t.row_name, '')")):
+        cur.execute(f"""
+            INSERT INTO {table}
+            SELECT {key},
+                   SUM(t.status = {ticket_codes.AVAILABLE}), SUM(t.status = {ticket_codes.RESERVED}),
+                   SUM(t.status = {ticket_codes.SOLD}),
+                   SUM(CASE WHEN t.status = {ticket_codes.SOLD} THEN {price} ELSE 0 END)
+            FROM Tickets t
+            GROUP BY {key}
+        """)
+    run_script(cur, SALES_TRIGGERS)
+
+
+def _catalog_search(cur):
+    # catalog.py used to create these on the first request, so they may be
+    # there already. A new search index is filled from the events we have.
+    existed = _table_exists(cur, 'Events_fts')
+    run_script(cur, CATALOG_SEARCH)
+    if not existed:
+        cur.execute("INSERT INTO Events_fts (Events_fts) VALUES ('rebuild')")
+
+
+def _event_settings(cur):
+    run_script(cur, EVENT_SETTINGS)
+
+
+def _venue_templates(cur):
+    run_script(cur, VENUE_TEMPLATES)
+
+
+def _row_sections(cur):
+    # Rows made before this have no recorded section, so they take the
+    # default pricing rule until their layout is generated again
+    run_script(cur, ROW_SECTIONS)
+
+
+# (version, description, migration). Only ever append to this list.
+MIGRATIONS = [
+    (1, 'base tables', _base_tables),
+    (2, 'merge TicketPrices into Ticket_Prices', _merge_ticket_prices),
+    (3, 'indexes for the hot queries', _hot_query_indexes),
+    (4, 'integer ticket status codes and seat keys', _compact_tickets),
+    (5, 'holds, payments and the shard map', _holds_and_shards),
+    (6, 'gate check-in', _gate_check_in),
+    (7, 'sales and occupancy aggregates', _sales_aggregates),
+    (8, 'event listing and search indexes', _catalog_search),
+    (9, 'per-event settings', _event_settings),
+    (10, 'venue templates', _venue_templates),
+    (11, 'row sections', _row_sections),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def current_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def migrate(conn, target=LATEST_VERSION):
+    """Apply every migration newer than the database's version up to target.
+
+    Returns the list of versions applied. Safe to call from several processes
+    at once: each step takes the write lock and re-reads the version first.
+    """
+    applied = []
+    for version, description, migration in MIGRATIONS:
+        if version > target or version <= current_version(conn):
+            continue
+        cur = conn.cursor()
+        cur.execute('BEGIN IMMEDIATE')
+        try:
+            if version <= current_version(conn):
+                conn.rollback()  # someone else got here first
+                continue
+            migration(cur)
+            cur.execute(f'PRAGMA user_version = {int(version)}')
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            if isinstance(e, MigrationError):
+                raise
+            raise MigrationError(f'Migration {version} ({description}) failed: {e}') from e
+        applied.append(version)
+    return applied
+
+
+# The queries that run on every page view, reservation or login, with
+# sample parameters. check_query_plans() fails if any of them scans a whole table.
+HOT_QUERIES = {
+    'seat lookup': (f'SELECT ticket_id, status FROM Tickets WHERE event_id = ? AND seat_key = {ticket_codes.SEAT_KEY_SQL}',
+                    (1, 1, 'A', 1)),
+    'several seats': (f"""
+        SELECT ticket_id, status FROM Tickets
+        WHERE event_id = ? AND seat_key IN {ticket_codes.seat_keys_sql('(?, ?), (?, ?)')}
+    """, (1, 'A', 1, 'A', 2, 1)),
+    'seats by status': ('SELECT ticket_id FROM Tickets WHERE event_id = ? AND status = ?', (1, ticket_codes.AVAILABLE)),
+    'seat map': (f"""
+        SELECT t.row_name, t.seat_number, {ticket_codes.status_name_sql('t.status')} AS status, tp.price_cents
+        FROM Tickets t
+        JOIN Ticket_Prices tp ON t.event_id = tp.event_id AND t.row_name = tp.row_name
+        WHERE t.event_id = ?
+    """, (1,)),
+    'expired holds': (f"""
+        SELECT ticket_id, event_id, reservation_time FROM Tickets
+        WHERE status = {ticket_codes.RESERVED} AND reservation_time IS NOT NULL
+    """, ()),
+    'user tickets': ('SELECT ticket_id FROM Tickets WHERE user_id = ?', (1,)),
+    'barcode scan': ('SELECT ticket_id, status, checked_in_at FROM Tickets WHERE event_id = ? AND barcode = ?',
+                     (1, 'some-barcode')),
+    'sales velocity': ('SELECT bucket_start, sold FROM Sales_Buckets WHERE event_id = ? AND bucket_start >= ?',
+                       (1, 0)),
+    'login by username': ('SELECT user_id, password_hash FROM Users WHERE username = ?', ('someone',)),
+    'login by email': ('SELECT user_id, password_hash FROM Users WHERE email = ?', ('someone@example.com',)),
+}
+
+# "SCAN Tickets" (or "SCAN t" for an alias) with no index after it is a full
+# table scan. Scanning a subquery we built ourselves (a VALUES list) is fine.
+_FULL_SCAN = re.compile(r'^SCAN (\w+)$')
+_SUBQUERY = re.compile(r'^(?:MATERIALIZE|CO-ROUTINE) (\w+)$')
+
+
+def check_query_plans(conn, queries=None):
+    """EXPLAIN QUERY PLAN every hot query. Returns {name: plan detail} for the ones doing full scans."""
+    problems = {}
+    for name, (sql, params) in (queries or HOT_QUERIES).items():
+        details = [row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, params).fetchall()]
+        subqueries = {match.group(1) for match in map(_SUBQUERY.match, details) if match}
+        scans = [detail for detail in details
+                 if _FULL_SCAN.match(detail) and _FULL_SCAN.match(detail).group(1) not in subqueries]
+        if scans:
+            problems[name] = '; '.join(scans)
+    return problems
+
+
+def init_app(app):
+    # Bring the app's database up to date before the first request
+    if not app.config.get('DB_AUTO_MIGRATE', True):
+        return
+    with db.pool.connection() as conn:
+        migrate(conn)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Migrate a Tessera database to the latest schema')
+    parser.add_argument('db_path', nargs='?', default=db.DEFAULT_DB_PATH)
+    parser.add_argument('--check', action='store_true', help='exit non-zero if a hot query does a full table scan')
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.db_path)
+    before = current_version(conn)
+    applied = migrate(conn)
+    print(f'{args.db_path}: version {before} -> {current_version(conn)}'
+          + (f' (applied {", ".join(map(str, applied))})' if applied else ' (up to date)'))
+
+    if args.check:
+        problems = check_query_plans(conn)
+        for name, detail in problems.items():
+            print(f'full scan in {name}: {detail}')
+        sys.exit(1 if problems else 0)
+    sys.exit(0)
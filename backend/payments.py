@@ -0,0 +1,121 @@
+import secrets
+import threading
+
+# Payment provider used by checkout.
+#
+# The frontend talks to Stripe through /create-payment-intent and
+# /complete-purchase. Set PAYMENT_PROVIDER to the real thing; it only needs
+# create_intent, confirm and retrieve.
+#
+# Without one, payments fail closed: no intents are created and checkout is
+# refused. For development and tests, PAYMENTS_TEST_MODE (env
+# TESSERA_PAYMENTS_TEST_MODE=1) puts LocalPaymentProvider in as a stand-in:
+# intents live in memory, have the same id / client_secret / amount / status
+# fields, and succeed once confirmed through POST /payments/<id>/confirm.
+# PAYMENTS_AUTO_CONFIRM on top of that creates them already succeeded, so
+# checkout can be exercised end to end without a card form.
+
+DEFAULT_CURRENCY = 'usd'
+
+
+class PaymentError(Exception):
+    """The payment is missing, unpaid, or doesn't match the order."""
+
+
+class PaymentsUnavailable(PaymentError):
+    """No payment provider is configured."""
+
+
+class UnconfiguredPaymentProvider:
+    # Refuses everything, so nothing can be bought without paying
+
+    def create_intent(self, amount_cents, currency=DEFAULT_CURRENCY, metadata=None):
+        raise PaymentsUnavailable('Payments are not configured')
+
+    def confirm(self, intent_id):
+        raise PaymentsUnavailable('Payments are not configured')
+
+    def retrieve(self, intent_id):
+        raise PaymentsUnavailable('Payments are not configured')
+
+
+class LocalPaymentProvider:
+    """In-memory stand-in for tests and development, never for real sales."""
+
+    def __init__(self, auto_confirm=False):
+        self.auto_confirm = auto_confirm
+        self._intents = {}
+        self._lock = threading.Lock()
+
+    def create_intent(self, amount_cents, currency=DEFAULT_CURRENCY, metadata=None):
+        if not isinstance(amount_cents, int) or amount_cents <= 0:
+            raise PaymentError('amount must be a positive number of cents')
+        intent_id = 'pi_local_' + secrets.token_hex(12)
+        intent = {
+            'id': intent_id,
+            'client_secret': f'{intent_id}_secret_{secrets.token_hex(12)}',
+            'amount': amount_cents,
+            'currency': currency,
+            'status': 'succeeded' if self.auto_confirm else 'requires_confirmation',
+            'metadata': dict(metadata or {}),
+        }
+        with self._lock:
+            self._intents[intent_id] = intent
+        return dict(intent)
+
+    def confirm(self, intent_id):
+        with self._lock:
+            intent = self._intents.get(intent_id)
+            if intent is None:
+                raise PaymentError('Unknown payment')
+            intent['status'] = 'succeeded'
+            return dict(intent)
+
+    def retrieve(self, intent_id):
+        with self._lock:
+            intent = self._intents.get(intent_id)
+        if intent is None:
+            raise PaymentError('Unknown payment')
+        return dict(intent)
+
+
+def verify_owner(intent_id, user_id):
+    intent = provider.retrieve(intent_id)
+    if intent['metadata'].get('user_id') != str(user_id):
+        raise PaymentError('Payment belongs to another user')
+    return intent
+
+
+def verify_paid(intent_id, user_id):
+    """Raise PaymentError unless intent_id is a paid intent of user_id. Returns the intent."""
+    if not intent_id:
+        raise PaymentError('A payment is required')
+    intent = verify_owner(intent_id, user_id)
+    if intent['status'] != 'succeeded':
+        raise PaymentError('Payment has not gone through')
+    return intent
+
+
+def check_amount(intent, amount_cents):
+    if intent['amount'] != amount_cents:
+        raise PaymentError(f"Payment of {intent['amount']} cents doesn't match the order total of {amount_cents} cents")
+
+
+def verify(intent_id, amount_cents, user_id):
+    """Raise PaymentError unless intent_id is a paid intent of user_id for exactly amount_cents."""
+    intent = verify_paid(intent_id, user_id)
+    check_amount(intent, amount_cents)
+    return intent
+
+
+provider = UnconfiguredPaymentProvider()
+
+
+def init_app(app):
+    global provider
+    provider = app.config.get('PAYMENT_PROVIDER')
+    if provider is None:
+        if app.config.get('PAYMENTS_TEST_MODE', False):
+            provider = LocalPaymentProvider(auto_confirm=app.config.get('PAYMENTS_AUTO_CONFIRM', False))
+        else:
+            provider = UnconfiguredPaymentProvider()
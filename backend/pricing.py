@@ -0,0 +1,113 @@
+import math
+
+import reservations
+
+# Row pricing for a whole event in one go. Rules are given per section (the
+# layout section a row was generated in, Ticket_Rows.section, see
+# inventory.py) and every row in a section is priced from its position with a
+# curve. Rows without a section use the default rule:
+#
+#   {
+#     "sections": {
+#       "Floor":   {"base_cents": 15000, "curve": "linear", "step_cents": 500, "min_cents": 5000},
+#       "Balcony": {"base_cents": 8000, "curve": "percent", "step_percent": 4}
+#     },
+#     "default": {"base_cents": 5000, "curve": "flat"},
+#     "multiplier": 1.2
+#   }
+#
+# Curves: "flat" (every row the same), "linear" (base minus step per row) and
+# "percent" (each row step_percent cheaper than the one in front). The optional
+# multiplier is applied last, for demand based pricing.
+
+CURVES = ('flat', 'linear', 'percent')
+
+
+class PricingError(ValueError):
+    """The pricing rules are malformed."""
+
+
+def _check_rule(name, rule):
+    if not isinstance(rule, dict) or not isinstance(rule.get('base_cents'), int) or rule['base_cents'] < 0:
+        raise PricingError(f'Rule {name!r} needs a non-negative integer base_cents')
+    if rule.get('curve', 'flat') not in CURVES:
+        raise PricingError(f'Rule {name!r} has an unknown curve, use one of {", ".join(CURVES)}')
+
+
+def curve_prices(rule, count, multiplier=1.0):
+    """Prices in cents for `count` rows, front row first."""
+    base = rule['base_cents']
+    curve = rule.get('curve', 'flat')
+    minimum = rule.get('min_cents', 0)
+
+    if curve == 'linear':
+        step = rule.get('step_cents', 0)
+        prices = [base - i * step for i in range(count)]
+    elif curve == 'percent':
+        factor = 1 - rule.get('step_percent', 0) / 100.0
+        prices = [base * factor ** i for i in range(count)]
+    else:
+        prices = [base] * count
+
+    return [max(minimum, int(math.floor(price * multiplier + 0.5))) for price in prices]
+
+
+def compute_prices(rules, rows):
+    """Return {row_name: price_cents} for every row that has a rule.
+
+    rows is [(row_name, section), ...] front to back, section None for rows
+    outside any section.
+    """
+    if not isinstance(rules, dict):
+        raise PricingError('Pricing rules must be an object')
+    sections = rules.get('sections') or {}
+    default = rules.get('default')
+    multiplier = rules.get('multiplier', 1.0)
+    if not isinstance(multiplier, (int, float)) or multiplier <= 0:
+        raise PricingError('multiplier must be a positive number')
+    for name, rule in sections.items():
+        _check_rule(name, rule)
+    if default is not None:
+        _check_rule('default', default)
+
+    # Group the rows by section, keeping their order, then price each group at once
+    grouped = {}
+    for row_name, section in rows:
+        grouped.setdefault(section, []).append(row_name)
+
+    prices = {}
+    for section, rows in grouped.items():
+        rule = sections.get(section, default) if section is not None else default
+        if rule is None:
+            continue
+        prices.update(zip(rows, curve_prices(rule, len(rows), multiplier)))
+    return prices
+
+
+def event_rows(conn, event_id):
+    # Rows in the order they were created, which is front to back for generated inventory
+    return [(row['row_name'], row['section']) for row in conn.execute(
+        'SELECT row_name, section FROM Ticket_Rows WHERE event_id = ? ORDER BY row_index', (event_id,))]
+
+
+def replace_prices(cur, event_id, prices):
+    # Call inside a write transaction
+    cur.executemany('DELETE FROM Ticket_Prices WHERE event_id = ? AND row_name = ?',
+                    [(event_id, row_name) for row_name in prices])
+    cur.executemany('INSERT INTO Ticket_Prices (event_id, row_name, price_cents) VALUES (?, ?, ?)',
+                    [(event_id, row_name, cents) for row_name, cents in prices.items()])
+
+
+def write_prices(conn, event_id, prices):
+    """Replace the Ticket_Prices rows for these rows in one transaction."""
+    return reservations.run_write(conn, lambda cur: replace_prices(cur, event_id, prices))
+
+
+def reprice_event(conn, event_id, rules, rows=None):
+    """Price every row of an event from rules. Returns {row_name: price_cents}."""
+    if rows is None:
+        rows = event_rows(conn, event_id)
+    prices = compute_prices(rules, rows)
+    if prices:
+        write_prices(conn, event_id, prices)
+    return prices
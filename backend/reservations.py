@@ -0,0 +1,307 @@
+import logging
+import random
+import sqlite3 # Library for talking to our database
+import threading
+import time
+
+import ticket_codes
+from ticket_codes import AVAILABLE, RESERVED, SOLD
+
+# Seat claims are done with a single conditional UPDATE inside a BEGIN IMMEDIATE
+# transaction, so two buyers racing for the same seat can never both win: the
+# second UPDATE simply matches zero rows and we report a conflict.
+
+MAX_ATTEMPTS = 5           # how many times we retry a write that hit SQLITE_BUSY
+BACKOFF_BASE_SECONDS = 0.005
+BACKOFF_MAX_SECONDS = 0.2
+
+# Columns handed to listeners whenever a seat changes state, status by name
+CHANGED_COLUMNS = (f'ticket_id, event_id, row_name, seat_number, {ticket_codes.STATUS_NAME_SQL} AS status, '
+                   'user_id, reservation_time')
+
+# Seats are looked up by their integer key, see ticket_codes.py
+SEAT_WHERE = f'event_id = ? AND seat_key = {ticket_codes.SEAT_KEY_SQL}'
+
+logger = logging.getLogger(__name__)
+_listeners = []
+_writer_for = None  # set by group_commit.py when GROUP_COMMIT is on
+
+# Write path counters, reported by /db/stats and the benchmarks
+_stats_lock = threading.Lock()
+_stats = {'writes': 0, 'busy_retries': 0, 'busy_failures': 0, 'lock_wait_ms': 0.0}
+
+
+def stats():
+    with _stats_lock:
+        snapshot = dict(_stats)
+    snapshot['lock_wait_ms'] = round(snapshot['lock_wait_ms'], 3)
+    return snapshot
+
+
+def _count(name, amount=1):
+    with _stats_lock:
+        _stats[name] += amount
+
+
+class SeatNotFound(Exception):
+    """The seat (or event) doesn't exist."""
+
+
+class SeatConflict(Exception):
+    """Someone else got there first, or the seat is not in the expected state."""
+
+
+class WriteContention(Exception):
+    """The database stayed locked for every retry attempt."""
+
+
+def add_listener(callback):
+    """Register callback(seat) to be called after a seat change is committed.
+
+    seat is a sqlite3.Row with the CHANGED_COLUMNS of the ticket.
+    """
+    _listeners.append(callback)
+
+
+def notify(seats):
+    # A broken listener must never turn a successful sale into an error
+    for seat in seats:
+        for callback in _listeners:
+            try:
+                callback(seat)
+            except Exception:
+                logger.exception('Seat change listener %r failed', callback)
+
+
+def set_writer(writer_for):
+    """Send seat writes through writer_for(conn).submit(work) instead of one transaction each."""
+    global _writer_for
+    _writer_for = writer_for
+
+
+def _is_busy(error):
+    message = str(error).lower()
+    return 'locked' in message or 'busy' in message
+
+
+def run_write(conn, work, max_attempts=MAX_ATTEMPTS):
+    # Runs work(cursor) inside BEGIN IMMEDIATE so we take the write lock up front
+    # instead of upgrading halfway through. If SQLite reports the database as busy
+    # we roll back and try again with a short randomized backoff.
+    for attempt in range(1, max_attempts + 1):
+        cur = conn.cursor()
+        try:
+            # Time spent here is time spent waiting for the write lock
+            waiting_since = time.perf_counter()
+            cur.execute('BEGIN IMMEDIATE')
+            _count('lock_wait_ms', (time.perf_counter() - waiting_since) * 1000)
+            result = work(cur)
+            conn.commit()
+            _count('writes')
+            return result
+        except sqlite3.OperationalError as e:
+            if conn.in_transaction:
+                conn.rollback()
+            if not _is_busy(e) or attempt == max_attempts:
+                if _is_busy(e):
+                    _count('busy_failures')
+                    raise WriteContention(f'Database busy after {max_attempts} attempts') from e
+                raise
+            _count('busy_retries')
+            delay = min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * (2 ** attempt))
+            time.sleep(random.uniform(0, delay))
+        except Exception:
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+
+
+def write_seats(conn, work):
+    """Run work(cursor) -> (result, changed seats) as one transaction and return result.
+
+    The changed seats are announced to the listeners once the transaction has
+    committed. With group commit on, the work joins the writer's next batch.
+    """
+    if _writer_for is not None:
+        return _writer_for(conn).submit(work)  # the writer notifies after its batch commits
+    result, seats = run_write(conn, work)
+    notify(seats)
+    return result
+
+
+def _check_seat_number(seat_number):
+    if not ticket_codes.valid_seat_number(seat_number):
+        raise SeatNotFound('Seat not found')
+
+
+def _check_seat_numbers(seats):
+    bad = [f'{row_name}-{seat_number}' for row_name, seat_number in seats
+           if not ticket_codes.valid_seat_number(seat_number)]
+    if bad:
+        raise SeatNotFound(f"Seats not found: {', '.join(bad)}")
+
+
+def _seat_exists(cur, event_id, row_name, seat_number):
+    cur.execute(f'SELECT 1 FROM Tickets WHERE {SEAT_WHERE}', (event_id, event_id, row_name, seat_number))
+    return cur.fetchone() is not None
+
+
+def reserve_seat(conn, event_id, row_name, seat_number, user_id):
+    """Hold an available seat for user_id. Returns the ticket_id."""
+    _check_seat_number(seat_number)
+
+    def work(cur):
+        cur.execute(f"""
+            UPDATE Tickets
+            SET status = {RESERVED},
+                user_id = ?,
+                reservation_time = CURRENT_TIMESTAMP
+            WHERE {SEAT_WHERE}
+            AND status = {AVAILABLE}
+            RETURNING {CHANGED_COLUMNS}
+        """, (user_id, event_id, event_id, row_name, seat_number))
+        claimed = cur.fetchall()
+        if claimed:
+            return claimed[0]['ticket_id'], claimed
+        if not _seat_exists(cur, event_id, row_name, seat_number):
+            raise SeatNotFound('Seat not found')
+        raise SeatConflict('Seat is no longer available')
+
+    return write_seats(conn, work)
+
+
+def release_seat(conn, event_id, row_name, seat_number, user_id):
+    """Give back a seat that user_id is holding. Returns the ticket_id."""
+    _check_seat_number(seat_number)
+
+    def work(cur):
+        cur.execute(f"""
+            UPDATE Tickets
+            SET status = {AVAILABLE},
+                user_id = NULL,
+                reservation_time = NULL
+            WHERE {SEAT_WHERE}
+            AND status = {RESERVED} AND user_id = ?
+            RETURNING {CHANGED_COLUMNS}
+        """, (event_id, event_id, row_name, seat_number, user_id))
+        released = cur.fetchall()
+        if released:
+            return released[0]['ticket_id'], released
+        if not _seat_exists(cur, event_id, row_name, seat_number):
+            raise SeatNotFound('Seat not found')
+        raise SeatConflict('Seat is not reserved by this user')
+
+    return write_seats(conn, work)
+
+
+def buy_seat(conn, event_id, user_id, row_name=None, seat_number=None):
+    """Sell a seat to user_id. Returns the ticket_id.
+
+    With a row and seat number the seat must be available or already held by
+    this user. Without them any available ticket for the event is sold.
+    """
+    if row_name is not None and seat_number is not None:
+        _check_seat_number(seat_number)
+
+    def work(cur):
+        if row_name is not None and seat_number is not None:
+            cur.execute(f"""
+                UPDATE Tickets
+                SET status = {SOLD},
+                    user_id = ?,
+                    reservation_time = NULL
+                WHERE {SEAT_WHERE}
+                AND (status = {AVAILABLE} OR (status = {RESERVED} AND user_id = ?))
+                RETURNING {CHANGED_COLUMNS}
+            """, (user_id, event_id, event_id, row_name, seat_number, user_id))
+            sold = cur.fetchall()
+            if sold:
+                return sold[0]['ticket_id'], sold
+            if not _seat_exists(cur, event_id, row_name, seat_number):
+                raise SeatNotFound('Seat not found')
+            raise SeatConflict('Seat is no longer available')
+
+        # Pick and claim a free ticket in one statement. The status check is
+        # repeated on the outer UPDATE so the claim stays conditional.
+        cur.execute(f"""
+            UPDATE Tickets
+            SET status = {SOLD},
+                user_id = ?,
+                reservation_time = NULL
+            WHERE ticket_id = (
+                SELECT ticket_id FROM Tickets
+                WHERE event_id = ? AND status = {AVAILABLE}
+                LIMIT 1
+            )
+            AND status = {AVAILABLE}
+            RETURNING {CHANGED_COLUMNS}
+        """, (user_id, event_id))
+        sold = cur.fetchall()
+        if sold:
+            return sold[0]['ticket_id'], sold
+        raise SeatNotFound('No available tickets for this event')
+
+    return write_seats(conn, work)
+
+
+# -- several seats at once -------------------------------------------------
+# These run inside someone else's work function (see carts.py) so the seats
+# change together with whatever else that transaction writes. If any seat
+# can't be had they raise, and the whole transaction rolls back.
+
+def _seat_values(seats):
+    # seats is a list of (row_name, seat_number)
+    return ', '.join('(?, ?)' for _ in seats), [value for seat in seats for value in seat]
+
+
+def _explain_missing(cur, event_id, seats, changed):
+    done = {(seat['row_name'], seat['seat_number']) for seat in changed}
+    values, params = _seat_values(seats)
+    cur.execute(f"""
+        SELECT row_name, seat_number FROM Tickets
+        WHERE event_id = ? AND seat_key IN {ticket_codes.seat_keys_sql(values)}
+    """, (event_id, *params, event_id))
+    existing = {(row['row_name'], row['seat_number']) for row in cur.fetchall()}
+    missing = [f'{row_name}-{seat_number}' for row_name, seat_number in seats if (row_name, seat_number) not in existing]
+    if missing:
+        raise SeatNotFound(f"Seats not found: {', '.join(missing)}")
+    taken = [f'{row_name}-{seat_number}' for row_name, seat_number in seats if (row_name, seat_number) not in done]
+    raise SeatConflict(f"Seats no longer available: {', '.join(taken)}")
+
+
+def claim_seats(cur, event_id, seats, user_id):
+    """Hold every seat in seats for user_id, or none of them. Returns the changed rows."""
+    _check_seat_numbers(seats)
+    values, params = _seat_values(seats)
+    cur.execute(f"""
+        UPDATE Tickets
+        SET status = {RESERVED},
+            user_id = ?,
+            reservation_time = CURRENT_TIMESTAMP
+        WHERE event_id = ? AND seat_key IN {ticket_codes.seat_keys_sql(values)}
+        AND status = {AVAILABLE}
+        RETURNING {CHANGED_COLUMNS}
+    """, (user_id, event_id, *params, event_id))
+    claimed = cur.fetchall()
+    if len(claimed) != len(seats):
+        _explain_missing(cur, event_id, seats, claimed)
+    return claimed
+
+
+def sell_seats(cur, event_id, seats, user_id):
+    """Sell every seat in seats to user_id, or none of them. Each must be available or held by user_id."""
+    _check_seat_numbers(seats)
+    values, params = _seat_values(seats)
+    cur.execute(f"""
+        UPDATE Tickets
+        SET status = {SOLD},
+            user_id = ?,
+            reservation_time = NULL
+        WHERE event_id = ? AND seat_key IN {ticket_codes.seat_keys_sql(values)}
+        AND (status = {AVAILABLE} OR (status = {RESERVED} AND user_id = ?))
+        RETURNING {CHANGED_COLUMNS}
+    """, (user_id, event_id, *params, event_id, user_id))
+    sold = cur.fetchall()
+    if len(sold) != len(seats):
+        _explain_missing(cur, event_id, seats, sold)
+    return sold
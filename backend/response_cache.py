@@ -0,0 +1,167 @@
+import functools
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app, make_response, request
+from werkzeug.http import http_date, parse_date, parse_etags
+
+# In-memory cache of whole GET responses for the catalog endpoints.
+#
+# Entries are keyed by path + sorted query args, bounded by an LRU and a TTL,
+# and tagged with what they depend on ("events" for listings, "event:<id>"
+# for a single event). Anything that changes events calls invalidate() with
+# the matching tags, so nothing waits out the TTL within this process; the TTL
+# only bounds how long writes made by other processes can go unseen.
+#
+# Responses carry an ETag (hash of the body), Last-Modified (when the tags
+# last changed) and Cache-Control, and conditional requests get a 304.
+
+DEFAULT_MAX_ENTRIES = 1024
+DEFAULT_TTL_SECONDS = 60.0
+DEFAULT_CLIENT_MAX_AGE = 10   # seconds browsers may reuse a response without asking
+
+
+def cache_key(path, args):
+    # args is a list of (name, value) pairs, order doesn't matter
+    return path + '?' + '&'.join(f'{name}={value}' for name, value in sorted(args))
+
+
+class Entry:
+
+    __slots__ = ('body', 'mimetype', 'etag', 'last_modified', 'stored_at', 'tags')
+
+    def __init__(self, body, mimetype, last_modified, tags):
+        self.body = body
+        self.mimetype = mimetype
+        self.etag = hashlib.sha1(body).hexdigest()[:20]
+        self.last_modified = last_modified
+        self.stored_at = time.monotonic()
+        self.tags = tags
+
+
+class ResponseCache:
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, ttl=DEFAULT_TTL_SECONDS, client_max_age=DEFAULT_CLIENT_MAX_AGE):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.client_max_age = client_max_age
+        self._entries = OrderedDict()
+        self._by_tag = {}     # tag -> set of keys
+        self._modified = {}   # tag -> wall clock time of the last invalidation
+        self._started = time.time()
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'not_modified': 0, 'invalidations': 0, 'evictions': 0}
+
+    def lookup(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.monotonic() - entry.stored_at >= self.ttl:
+                if entry is not None:
+                    self._remove(key)
+                self.stats['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return entry
+
+    def last_modified(self, tags):
+        with self._lock:
+            return max([self._started] + [self._modified.get(tag, 0.0) for tag in tags])
+
+    def store(self, key, body, mimetype, tags, last_modified):
+        entry = Entry(body, mimetype, last_modified, tags)
+        with self._lock:
+            # A write that invalidated these tags while we were building the
+            # response makes it stale already
+            if self._started > last_modified or any(self._modified.get(tag, 0.0) > last_modified for tag in tags):
+                return entry
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = entry
+            for tag in tags:
+                self._by_tag.setdefault(tag, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self.stats['evictions'] += 1
+        return entry
+
+    def _remove(self, key):
+        # Caller must hold self._lock
+        entry = self._entries.pop(key)
+        for tag in entry.tags:
+            keys = self._by_tag.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._by_tag[tag]
+
+    def invalidate(self, *tags):
+        """Drop every entry tagged with any of tags (everything if no tags are given)."""
+        now = time.time()
+        with self._lock:
+            self.stats['invalidations'] += 1
+            if not tags:
+                self._entries.clear()
+                self._by_tag.clear()
+                self._started = now
+                return
+            for tag in tags:
+                self._modified[tag] = now
+                for key in list(self._by_tag.get(tag, ())):
+                    self._remove(key)
+
+    def is_fresh(self, entry, if_none_match, if_modified_since):
+        # True when the client's copy is still good and a 304 will do
+        if if_none_match:
+            return parse_etags(if_none_match).contains(entry.etag)
+        if if_modified_since:
+            since = parse_date(if_modified_since)
+            return since is not None and int(entry.last_modified) <= since.timestamp()
+        return False
+
+    def headers(self, entry):
+        return {
+            'ETag': f'"{entry.etag}"',
+            'Last-Modified': http_date(entry.last_modified),
+            'Cache-Control': f'public, max-age={self.client_max_age}',
+        }
+
+
+cache = ResponseCache()
+
+
+def cached(*tag_templates):
+    """Cache a GET view's 200 responses under tags, e.g. @cached('event:{event_id}').
+
+    The templates are filled in from the view's URL arguments.
+    """
+    def decorate(view):
+        @functools.wraps(view)
+        def wrapper(**kwargs):
+            key = cache_key(request.path, request.args.items(multi=True))
+            entry = cache.lookup(key)
+            if entry is None:
+                tags = tuple(template.format(**kwargs) for template in tag_templates)
+                last_modified = cache.last_modified(tags)
+                response = make_response(view(**kwargs))
+                if response.status_code != 200 or response.is_streamed:
+                    return response
+                entry = cache.store(key, response.get_data(), response.mimetype, tags, last_modified)
+
+            if cache.is_fresh(entry, request.headers.get('If-None-Match'), request.headers.get('If-Modified-Since')):
+                cache.stats['not_modified'] += 1
+                response = current_app.response_class(status=304)
+            else:
+                response = current_app.response_class(entry.body, status=200, mimetype=entry.mimetype)
+            response.headers.update(cache.headers(entry))
+            return response
+        return wrapper
+    return decorate
+
+
+def init_app(app):
+    cache.max_entries = app.config.get('RESPONSE_CACHE_MAX_ENTRIES', DEFAULT_MAX_ENTRIES)
+    cache.ttl = app.config.get('RESPONSE_CACHE_TTL', DEFAULT_TTL_SECONDS)
+    cache.client_max_age = app.config.get('RESPONSE_CACHE_CLIENT_MAX_AGE', DEFAULT_CLIENT_MAX_AGE)
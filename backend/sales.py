@@ -0,0 +1,92 @@
+import time
+
+# Sales and occupancy numbers for the admin dashboards.
+#
+# Counting Tickets by status on every dashboard refresh is a scan of the whole
+# event, and during an on-sale that's the same table every reservation is
+# writing to. Instead the totals live in three small tables that triggers on
+# Tickets (see migrations.py) keep up to date in the same transaction as each
+# change, whatever made it: reserve/unreserve/buy, holds, checkout, the expiry
+# sweep or a ticket being created or deleted.
+#
+#   Sales_Events   available/reserved/sold and revenue per event
+#   Sales_Rows     the same per row ('' for tickets without a seat)
+#   Sales_Buckets  holds and sales per event per BUCKET_SECONDS, for the velocity chart
+#
+# Revenue is the row price (or the ticket's own dollar price) at the moment a
+# ticket sells. Tickets sold before the aggregates existed are in the totals
+# but not in the velocity buckets, since nothing recorded when they sold.
+#
+# Every table is per database, so with sharding on an event's numbers are in
+# its shard next to its tickets.
+
+BUCKET_SECONDS = 60
+MAX_BUCKETS = 1440  # a day of one minute buckets
+
+
+def _totals(row):
+    totals = {key: row[key] for key in ('available', 'reserved', 'sold', 'revenue_cents')}
+    totals['capacity'] = totals['available'] + totals['reserved'] + totals['sold']
+    totals['occupancy'] = round(totals['sold'] / totals['capacity'], 4) if totals['capacity'] else 0.0
+    return totals
+
+
+def event_summary(conn, event_id):
+    """Totals for an event and each of its rows, None if the event has no tickets."""
+    row = conn.execute('SELECT * FROM Sales_Events WHERE event_id = ?', (event_id,)).fetchone()
+    if row is None:
+        return None
+    summary = _totals(row)
+    summary['event_id'] = event_id
+    summary['rows'] = [dict(_totals(r), row_name=r['row_name'] or None) for r in conn.execute(
+        'SELECT * FROM Sales_Rows WHERE event_id = ? ORDER BY row_name', (event_id,))]
+    return summary
+
+
+def empty_summary(event_id):
+    # What event_summary() would say about an event without tickets
+    summary = _totals({'available': 0, 'reserved': 0, 'sold': 0, 'revenue_cents': 0})
+    return dict(summary, event_id=event_id, rows=[])
+
+
+def all_events(conns):
+    # Totals of every event, from the central database and each shard
+    events = []
+    for conn in conns:
+        events.extend(dict(_totals(row), event_id=row['event_id'])
+                      for row in conn.execute('SELECT * FROM Sales_Events ORDER BY event_id'))
+    events.sort(key=lambda event: event['event_id'])
+    return events
+
+
+def velocity(conn, event_id, bucket_seconds=BUCKET_SECONDS, buckets=60, now=None):
+    """Holds, sales and revenue per bucket_seconds for the last `buckets` buckets, oldest first.
+
+    bucket_seconds is rounded up to a multiple of BUCKET_SECONDS. Buckets with
+    nothing in them are included, so the series has no gaps.
+    """
+    width = max(1, -(-int(bucket_seconds) // BUCKET_SECONDS)) * BUCKET_SECONDS
+    buckets = min(max(1, int(buckets)), MAX_BUCKETS)
+    now = int(time.time() if now is None else now)
+    end = now - now % width + width
+    start = end - buckets * width
+
+    rows = conn.execute("""
+        SELECT ? + (bucket_start - ?) / ? * ? AS bucket_start,
+               SUM(reserved) AS reserved, SUM(sold) AS sold, SUM(revenue_cents) AS revenue_cents
+        FROM Sales_Buckets
+        WHERE event_id = ? AND bucket_start >= ? AND bucket_start < ?
+        GROUP BY 1
+    """, (start, start, width, width, event_id, start, end)).fetchall()
+    found = {row['bucket_start']: row for row in rows}
+
+    series = []
+    for bucket_start in range(start, end, width):
+        row = found.get(bucket_start)
+        series.append({
+            'bucket_start': bucket_start,
+            'reserved': row['reserved'] if row else 0,
+            'sold': row['sold'] if row else 0,
+            'revenue_cents': row['revenue_cents'] if row else 0,
+        })
+    return {'event_id': event_id, 'bucket_seconds': width, 'buckets': series}
@@ -0,0 +1,223 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+import reservations
+import ticket_codes
+
+# The EventDetail page polls get_ticket_availability, and each call used to
+# join Tickets with Ticket_Prices and rebuild the whole row -> seat dict.
+# Here we keep one compact seat map per event (a bytearray of status codes per
+# row plus the row price) that reservations.py updates in place. The ETag is a
+# hash of the serialized map, so unchanged maps can be answered with a 304 and
+# two workers (or a restarted one) agree on it whenever they agree on the seats.
+
+DEFAULT_MAX_EVENTS = 256
+DEFAULT_MAX_AGE_SECONDS = 5.0  # reload anyway after this long, to pick up other workers' writes
+
+# Every seat status we have seen gets a small integer code
+_status_codes = {}
+_status_names = []
+_status_free = []  # per code, whether the seat can still be had
+_status_lock = threading.Lock()
+
+
+def status_code(status):
+    code = _status_codes.get(status)
+    if code is None:
+        with _status_lock:
+            code = _status_codes.get(status)
+            if code is None:
+                code = len(_status_names)
+                _status_names.append(status)
+                _status_free.append(str(status).upper() == 'AVAILABLE')
+                _status_codes[status] = code
+    return code
+
+
+class SeatMap:
+
+    def __init__(self, event_id, seats):
+        self.event_id = event_id
+        self.version = 0
+        self.loaded_at = time.monotonic()
+
+        self.rows = []          # row names in the order we first saw them
+        self.seat_numbers = []  # per row, the seat numbers
+        self.statuses = []      # per row, a bytearray of status codes parallel to seat_numbers
+        self.prices = []        # per row, price in cents
+        self._index = {}        # (row_name, seat_number) -> (row position, seat position)
+        self._body = None       # serialized response for the current version
+        self._etag = None       # hash of _body
+
+        row_positions = {}
+        for seat in seats:
+            row = seat['row_name']
+            if row not in row_positions:
+                row_positions[row] = len(self.rows)
+                self.rows.append(row)
+                self.seat_numbers.append([])
+                self.statuses.append(bytearray())
+                self.prices.append(seat['price_cents'])
+            r = row_positions[row]
+            self.prices[r] = seat['price_cents']
+            key = (row, seat['seat_number'])
+            if key in self._index:
+                self.statuses[r][self._index[key][1]] = status_code(seat['status'])
+                continue
+            self._index[key] = (r, len(self.seat_numbers[r]))
+            self.seat_numbers[r].append(seat['seat_number'])
+            self.statuses[r].append(status_code(seat['status']))
+
+        # Runs of free, consecutively numbered seats per row for seat_finder.py.
+        # free_runs[r] is a list of (first seat number, length), max_run[r] the longest.
+        self._order = [sorted(range(len(numbers)), key=numbers.__getitem__) for numbers in self.seat_numbers]
+        self.free_runs = [[] for _ in self.rows]
+        self.max_run = [0] * len(self.rows)
+        for r in range(len(self.rows)):
+            self._rebuild_runs(r)
+
+    def _rebuild_runs(self, r):
+        numbers = self.seat_numbers[r]
+        statuses = self.statuses[r]
+        runs = []
+        previous = None
+        for s in self._order[r]:
+            number = numbers[s]
+            if not _status_free[statuses[s]]:
+                previous = None
+                continue
+            if previous is not None and number == previous + 1:
+                runs[-1][1] += 1
+            else:
+                runs.append([number, 1])
+            previous = number
+        self.free_runs[r] = [tuple(run) for run in runs]
+        self.max_run[r] = max((length for _, length in runs), default=0)
+
+    def apply(self, row_name, seat_number, status):
+        position = self._index.get((row_name, seat_number))
+        if position is None:
+            return False  # seat has no price row, so it isn't part of the map
+        r, s = position
+        code = status_code(status)
+        if self.statuses[r][s] != code:
+            was_free = _status_free[self.statuses[r][s]]
+            self.statuses[r][s] = code
+            self.version += 1
+            self._body = None
+            if was_free != _status_free[code]:
+                self._rebuild_runs(r)
+        return True
+
+    def to_dict(self):
+        # Same shape get_ticket_availability has always returned
+        availability = {}
+        for r, row in enumerate(self.rows):
+            price = self.prices[r] / 100.0
+            availability[row] = {
+                seat_number: {'status': _status_names[code], 'price': price}
+                for seat_number, code in zip(self.seat_numbers[r], self.statuses[r])
+            }
+        return availability
+
+
+class SeatMapCache:
+    """Per-event seat maps, kept current by seat change notifications and bounded by an LRU."""
+
+    def __init__(self, max_events=DEFAULT_MAX_EVENTS, max_age=DEFAULT_MAX_AGE_SECONDS):
+        self.max_events = max_events
+        self.max_age = max_age
+        self._maps = OrderedDict()
+        self._loading = {}  # event_id -> [loads in progress, changes seen since the first one started]
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'updates': 0}
+
+    def peek(self, event_id):
+        """The cached seat map if it is still fresh, otherwise None. Never touches the database."""
+        with self._lock:
+            seat_map = self._maps.get(event_id)
+            if seat_map is None or time.monotonic() - seat_map.loaded_at >= self.max_age:
+                return None
+            self._maps.move_to_end(event_id)
+            self.stats['hits'] += 1
+            return seat_map
+
+    def get(self, conn, event_id):
+        """Return the seat map for event_id, loading it from the database on a miss."""
+        with self._lock:
+            seat_map = self._maps.get(event_id)
+            if seat_map is not None and time.monotonic() - seat_map.loaded_at < self.max_age:
+                self._maps.move_to_end(event_id)
+                self.stats['hits'] += 1
+                return seat_map
+            self.stats['misses'] += 1
+            loading = self._loading.setdefault(event_id, [0, []])
+            loading[0] += 1
+
+        seats = conn.execute(f"""
+            SELECT t.row_name, t.seat_number, {ticket_codes.status_name_sql('t.status')} AS status, tp.price_cents
+            FROM Tickets t
+            JOIN Ticket_Prices tp ON t.event_id = tp.event_id AND t.row_name = tp.row_name
+            WHERE t.event_id = ?
+        """, (event_id,)).fetchall()
+        seat_map = SeatMap(event_id, seats)
+
+        with self._lock:
+            # Replay anything that committed while we were reading. Replaying a
+            # change the query already saw is harmless.
+            loading[0] -= 1
+            for row_name, seat_number, status in loading[1]:
+                seat_map.apply(row_name, seat_number, status)
+            if loading[0] == 0:
+                del self._loading[event_id]
+            self._maps[event_id] = seat_map
+            self._maps.move_to_end(event_id)
+            while len(self._maps) > self.max_events:
+                self._maps.popitem(last=False)
+                self.stats['evictions'] += 1
+        return seat_map
+
+    def render(self, seat_map, serialize):
+        # Returns (etag, body). The body is serialized once per version and
+        # every poll in between reuses the same bytes.
+        with self._lock:
+            if seat_map._body is None:
+                body = serialize(seat_map.to_dict())
+                data = body.encode() if isinstance(body, str) else body
+                seat_map._body = body
+                seat_map._etag = f'{seat_map.event_id}-{hashlib.sha1(data).hexdigest()[:20]}'
+            return seat_map._etag, seat_map._body
+
+    def query(self, seat_map, fn, *args):
+        # Read a seat map without racing the seat change updates
+        with self._lock:
+            return fn(seat_map, *args)
+
+    def on_seat_change(self, seat):
+        change = (seat['row_name'], seat['seat_number'], seat['status'])
+        with self._lock:
+            loading = self._loading.get(seat['event_id'])
+            if loading is not None:
+                loading[1].append(change)
+            seat_map = self._maps.get(seat['event_id'])
+            if seat_map is not None and seat_map.apply(*change):
+                self.stats['updates'] += 1
+
+    def invalidate(self, event_id=None):
+        # For writes that don't go through reservations.py (new tickets, prices)
+        with self._lock:
+            if event_id is None:
+                self._maps.clear()
+            else:
+                self._maps.pop(event_id, None)
+
+
+cache = SeatMapCache()
+reservations.add_listener(cache.on_seat_change)
+
+
+def init_app(app):
+    cache.max_events = app.config.get('SEAT_CACHE_MAX_EVENTS', DEFAULT_MAX_EVENTS)
+    cache.max_age = app.config.get('SEAT_CACHE_MAX_AGE', DEFAULT_MAX_AGE_SECONDS)
@@ -0,0 +1,58 @@
+# "Best available" seats: find `quantity` adjacent free seats without the
+# client downloading and scanning the whole map.
+#
+# Works on the cached seat maps from seat_cache.py, which keep a list of free
+# runs (consecutively numbered free seats) and the longest run per row up to
+# date as seats change. A query only looks at each row's longest run to skip
+# rows that can't fit the group, then picks the block closest to the middle
+# of the row in the rows that can.
+
+PREFERENCES = ('price', 'proximity')
+MAX_QUANTITY = 20
+MAX_BLOCKS = 10
+
+
+def _row_order(seat_map, prefer):
+    rows = range(len(seat_map.rows))
+    if prefer == 'price':
+        # Cheapest first, front rows first within a price
+        return sorted(rows, key=lambda r: (seat_map.prices[r], r))
+    # proximity: rows in layout order, which runs from the front of each section
+    return rows
+
+
+def _best_block(runs, quantity, middle):
+    # First seat number of the block in these runs whose centre is nearest the row's middle
+    best = None
+    for first, length in runs:
+        if length < quantity:
+            continue
+        # Slide the block as close to the middle as the run allows
+        start = round(middle - (quantity - 1) / 2)
+        start = min(max(start, first), first + length - quantity)
+        distance = abs(start + (quantity - 1) / 2 - middle)
+        if best is None or distance < best[0]:
+            best = (distance, start)
+    return best[1] if best else None
+
+
+def find_blocks(seat_map, quantity, prefer='price', limit=1, max_price_cents=None):
+    """Up to `limit` blocks of `quantity` adjacent free seats, best first, one per row."""
+    blocks = []
+    for r in _row_order(seat_map, prefer):
+        if seat_map.max_run[r] < quantity:
+            continue
+        price = seat_map.prices[r]
+        if max_price_cents is not None and price > max_price_cents:
+            continue
+        numbers = seat_map.seat_numbers[r]
+        start = _best_block(seat_map.free_runs[r], quantity, (min(numbers) + max(numbers)) / 2)
+        blocks.append({
+            'row_name': seat_map.rows[r],
+            'seat_numbers': list(range(start, start + quantity)),
+            'price_cents': price,
+            'total_cents': price * quantity,
+        })
+        if len(blocks) == limit:
+            break
+    return blocks
@@ -0,0 +1,203 @@
+import asyncio
+import itertools
+import json
+import threading
+from collections import deque
+
+import reservations
+
+# Pushes seat status deltas to browsers over Server-Sent Events so they don't
+# have to re-download the whole seat map. Every change is serialized into an
+# SSE frame exactly once and kept in a small per-event backlog; subscribers
+# just walk the backlog from the last version they saw.
+#
+# subscribe() blocks a thread per client, which is fine under the threaded dev
+# server. subscribe_async() is the same stream for the ASGI server, where an
+# idle client is just a future parked on the event loop.
+
+DEFAULT_BACKLOG_SIZE = 1024
+DEFAULT_KEEPALIVE_SECONDS = 15.0
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class EventChannel:
+
+    def __init__(self, backlog_size):
+        self.version = 0
+        self.frames = deque(maxlen=backlog_size)  # (version, frame bytes)
+        self.changed = threading.Condition()
+        self.subscribers = 0
+        self.closed = False  # dropped from the hub, see SeatStreamHub.leave()
+        self._wakeups = {}  # event loop -> future resolved on the next publish
+
+    def publish(self, delta):
+        # Returns False if the channel was dropped and nothing was published
+        with self.changed:
+            if self.closed:
+                return False
+            self.version += 1
+            delta['version'] = self.version
+            frame = f'id: {self.version}\nevent: seat\ndata: {json.dumps(delta)}\n\n'.encode()
+            self.frames.append((self.version, frame))
+            self.changed.notify_all()
+            wakeups, self._wakeups = self._wakeups, {}
+
+        # One callback per event loop however many async subscribers it has
+        for loop, future in wakeups.items():
+            try:
+                loop.call_soon_threadsafe(_resolve, future)
+            except RuntimeError:
+                pass  # loop already closed
+        return True
+
+    def wakeup(self, loop):
+        # Must be called on `loop`, before checking self.version
+        with self.changed:
+            future = self._wakeups.get(loop)
+            if future is None:
+                future = self._wakeups[loop] = loop.create_future()
+            return future
+
+    def join(self, since):
+        # Returns (hello frame, version to continue from)
+        with self.changed:
+            self.subscribers += 1
+            # A version from the future means the server restarted since the
+            # client last connected, so its copy of the map can't be trusted
+            stale = since is not None and since > self.version
+            last_seen = self.version if since is None or stale else since
+        hello = 'reset' if stale else 'hello'
+        return f'event: {hello}\ndata: {json.dumps({"version": last_seen})}\n\n'.encode(), last_seen
+
+    def leave(self):
+        # Returns True when nobody is listening and nothing was ever published,
+        # so the channel holds nothing worth keeping
+        with self.changed:
+            self.subscribers -= 1
+            if self.subscribers == 0 and not self.frames:
+                self.closed = True
+            return self.closed
+
+    def next_chunk(self, last_seen):
+        # Returns (bytes to send, new last_seen)
+        with self.changed:
+            frames = self.frames_after(last_seen)
+            current = self.version
+        if frames is None:
+            # Fell off the backlog, the client should refetch the full map
+            return f'id: {current}\nevent: reset\ndata: {json.dumps({"version": current})}\n\n'.encode(), current
+        if frames:
+            return b''.join(frames), current
+        return b': keepalive\n\n', current
+
+    def frames_after(self, version):
+        # Caller must hold self.changed. Returns None when the client is too far
+        # behind for the backlog and has to reload the full map.
+        if version >= self.version:
+            return []
+        oldest = self.frames[0][0] if self.frames else self.version + 1
+        if version + 1 < oldest:
+            return None
+        start = version + 1 - oldest
+        return [frame for _, frame in itertools.islice(self.frames, start, None)]
+
+
+class SeatStreamHub:
+
+    def __init__(self, backlog_size=DEFAULT_BACKLOG_SIZE, keepalive=DEFAULT_KEEPALIVE_SECONDS):
+        self.backlog_size = backlog_size
+        self.keepalive = keepalive
+        self._channels = {}
+        self._lock = threading.Lock()
+
+    # Channels are made by the first publish or subscriber and dropped again
+    # when the last subscriber of a channel that never saw a change leaves, so
+    # polling or streaming made-up event ids doesn't leave anything behind.
+
+    def channel(self, event_id):
+        channel = self._channels.get(event_id)
+        if channel is None:
+            with self._lock:
+                channel = self._channels.setdefault(event_id, EventChannel(self.backlog_size))
+        return channel
+
+    def version(self, event_id):
+        channel = self._channels.get(event_id)
+        return channel.version if channel is not None else 0
+
+    def on_seat_change(self, seat):
+        delta = {
+            'row': seat['row_name'],
+            'seat': seat['seat_number'],
+            'status': seat['status'],
+        }
+        # A channel dropped between the lookup and the publish refuses it, try the new one
+        while not self.channel(seat['event_id']).publish(delta):
+            pass
+
+    def join(self, event_id, since):
+        # Under the hub lock so leave() can't drop the channel in between
+        with self._lock:
+            channel = self._channels.setdefault(event_id, EventChannel(self.backlog_size))
+            hello, last_seen = channel.join(since)
+        return channel, hello, last_seen
+
+    def leave(self, event_id, channel):
+        with self._lock:
+            if channel.leave() and self._channels.get(event_id) is channel:
+                del self._channels[event_id]
+
+    def subscribe(self, event_id, since=None):
+        """Generator of SSE frames for event_id, starting after version `since`."""
+        # Tell the client where it is starting from
+        channel, hello, last_seen = self.join(event_id, since)
+        try:
+            yield hello
+            while True:
+                with channel.changed:
+                    if channel.version <= last_seen:
+                        channel.changed.wait(self.keepalive)
+                chunk, last_seen = channel.next_chunk(last_seen)
+                yield chunk
+        finally:
+            self.leave(event_id, channel)
+
+    async def subscribe_async(self, event_id, since=None):
+        """Async generator with the same frames as subscribe()."""
+        loop = asyncio.get_running_loop()
+        channel, hello, last_seen = self.join(event_id, since)
+        try:
+            yield hello
+            while True:
+                wakeup = channel.wakeup(loop)
+                if channel.version <= last_seen:
+                    try:
+                        # shield() because the future is shared with every other subscriber on this loop
+                        await asyncio.wait_for(asyncio.shield(wakeup), self.keepalive)
+                    except asyncio.TimeoutError:
+                        pass
+                chunk, last_seen = channel.next_chunk(last_seen)
+                yield chunk
+        finally:
+            self.leave(event_id, channel)
+
+    def stats(self):
+        with self._lock:
+            channels = dict(self._channels)
+        return {
+            event_id: {'version': channel.version, 'subscribers': channel.subscribers}
+            for event_id, channel in channels.items()
+        }
+
+
+hub = SeatStreamHub()
+reservations.add_listener(hub.on_seat_change)
+
+
+def init_app(app):
+    hub.backlog_size = app.config.get('SEAT_STREAM_BACKLOG', DEFAULT_BACKLOG_SIZE)
+    hub.keepalive = app.config.get('SEAT_STREAM_KEEPALIVE', DEFAULT_KEEPALIVE_SECONDS)
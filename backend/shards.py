@@ -0,0 +1,293 @@
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from flask import g, has_app_context
+
+import db
+import group_commit
+import migrations
+import reservations
+
+# Per-event database shards.
+#
+# SQLite has one writer per file, so with every event in tessera.db a big
+# on-sale holds up writes for every other event. With SHARDING on, each new
+# event (or group of SHARD_GROUP_SIZE consecutive events) gets its own file in
+# SHARD_DIR for everything seat related: Tickets, Ticket_Prices, Ticket_Rows,
+# Holds, Hold_Seats and Payments. Events, Users and the other catalog tables
+# stay in the central database, together with the shard map (Event_Shards).
+#
+# Events without a shard map entry, which is everything created before
+# sharding was switched on, live in shard 0: the central database itself. So
+# turning SHARDING on or off only changes where new events go.
+#
+# Each open shard also gets a read-only pool (see db.get_read_connection) for
+# the availability reads.
+#
+# ticket_id and hold_id stay unique across shards: shard n starts its
+# AUTOINCREMENT counters at n * ID_SPACE, so shard_of(id) says where a hold
+# lives, and reading the shards in order lists tickets in ticket_id order.
+
+ID_SPACE = 10 ** 9           # ids per shard, keeps ids well inside what JavaScript can represent
+DEFAULT_GROUP_SIZE = 1       # events per shard
+DEFAULT_POOL_SIZE = 4        # connections per shard
+DEFAULT_MAX_OPEN = 64        # shard pools kept open before idle ones are closed
+
+
+def shard_path(shard_dir, shard_id):
+    return os.path.join(shard_dir, f'shard-{shard_id}.db')
+
+
+def shard_of(record_id):
+    """The shard a ticket_id or hold_id was created in."""
+    return int(record_id) // ID_SPACE
+
+
+def prepare(conn, shard_id):
+    # Bring a shard's schema up to date and start its ids in its own range
+    migrations.migrate(conn)
+
+    def work(cur):
+        cur.executemany("""
+            INSERT INTO sqlite_sequence (name, seq)
+            SELECT ?, ? WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = ?)
+        """, [(table, shard_id * ID_SPACE, table) for table in ('Tickets', 'Holds')])
+
+    reservations.run_write(conn, work)
+
+
+@contextmanager
+def _central():
+    # The request's central connection if there is one, otherwise a borrowed one
+    if has_app_context():
+        yield db.get_db_connection()
+    else:
+        with db.pool.connection() as conn:
+            yield conn
+
+
+class ShardRouter:
+    """Maps event_ids to shards and keeps a small connection pool per open shard."""
+
+    def __init__(self, shard_dir=None, enabled=False, group_size=DEFAULT_GROUP_SIZE,
+                 pool_size=DEFAULT_POOL_SIZE, max_open=DEFAULT_MAX_OPEN):
+        self.shard_dir = shard_dir
+        self.enabled = enabled
+        self.group_size = group_size
+        self.pool_size = pool_size
+        self.max_open = max_open
+        self._shards = {}            # event_id -> shard_id, for events known to exist
+        self._pools = OrderedDict()  # shard_id -> ConnectionPool, least recently used first
+        self._read_pools = {}        # shard_id -> read-only ConnectionPool
+        self._opening = {}           # shard_id -> lock held while that shard is opened and migrated
+        self._lock = threading.Lock()
+        self.stats_counters = {'lookups': 0, 'opened': 0, 'closed': 0}
+
+    # -- routing -----------------------------------------------------------
+
+    def shard_for(self, event_id):
+        event_id = int(event_id)
+        shard_id = self._shards.get(event_id)
+        if shard_id is not None:
+            return shard_id
+        self.stats_counters['lookups'] += 1
+        with _central() as conn:
+            row = conn.execute("""
+                SELECT s.shard_id FROM Events e
+                LEFT JOIN Event_Shards s ON s.event_id = e.event_id
+                WHERE e.event_id = ?
+            """, (event_id,)).fetchone()
+        if row is None:
+            return 0  # no such event (yet), don't remember it
+        shard_id = row['shard_id'] or 0
+        self._shards[event_id] = shard_id
+        return shard_id
+
+    def assign(self, cur, event_id):
+        """Pick a shard for a new event. Call in the transaction that inserts the event."""
+        if not self.enabled:
+            return 0
+        shard_id = (event_id - 1) // self.group_size + 1
+        cur.execute('INSERT INTO Event_Shards (event_id, shard_id) VALUES (?, ?)', (event_id, shard_id))
+        self._shards[event_id] = shard_id
+        return shard_id
+
+    def shard_ids(self):
+        # Every shard that may hold tickets, in ticket_id order
+        with _central() as conn:
+            rows = conn.execute('SELECT DISTINCT shard_id FROM Event_Shards ORDER BY shard_id').fetchall()
+        return [0] + [row['shard_id'] for row in rows if row['shard_id'] != 0]
+
+    # -- pools -------------------------------------------------------------
+
+    def pool(self, shard_id):
+        if shard_id == 0:
+            return db.pool
+        with self._lock:
+            pool = self._open_pool(shard_id)
+            if pool is not None:
+                return pool
+            opening = self._opening.setdefault(shard_id, threading.Lock())
+
+        # Migrating a shard can take a while, so only threads that want this
+        # shard wait for it, not every other shard lookup
+        with opening:
+            with self._lock:
+                pool = self._open_pool(shard_id)
+            if pool is not None:
+                return pool
+            if self.shard_dir is None:
+                raise RuntimeError(f'Shard {shard_id} is in the shard map but SHARD_DIR is not set')
+            os.makedirs(self.shard_dir, exist_ok=True)
+            pool = self._new_pool(shard_id)
+            with pool.connection() as conn:
+                prepare(conn, shard_id)
+            with self._lock:
+                self._pools[shard_id] = pool
+                self._read_pools[shard_id] = self._new_pool(shard_id, read_only=True)
+                self.stats_counters['opened'] += 1
+                closed = self._close_idle()
+        for closed_id in closed:
+            group_commit.close_shard(closed_id)
+        return pool
+
+    def _open_pool(self, shard_id):
+        # Caller holds self._lock
+        pool = self._pools.get(shard_id)
+        if pool is not None:
+            self._pools.move_to_end(shard_id)
+        return pool
+
+    def _new_pool(self, shard_id, read_only=False):
+        pool = db.ConnectionPool(
+            db_path=shard_path(self.shard_dir, shard_id),
+            max_size=self.pool_size,
+            timeout=db.pool.timeout,
+            busy_timeout_ms=db.pool.busy_timeout_ms,
+            mmap_size=db.pool.mmap_size,
+            health_check_after=db.pool.health_check_after,
+            connection_factory=db.pool.connection_factory,
+            read_only=read_only,
+        )
+        pool.shard_id = shard_id  # lets group_commit.writer_for() tell the shards apart
+        return pool
+
+    def read_pool(self, shard_id):
+        if shard_id == 0:
+            return db.read_pool
+        while True:
+            self.pool(shard_id)  # opens the shard (and its read pool) if needed
+            with self._lock:
+                read_pool = self._read_pools.get(shard_id)
+            if read_pool is not None:
+                return read_pool
+
+    def _close_idle(self):
+        # Caller holds self._lock. Only pools nobody is using are closed, and
+        # they reopen on their next use. Closed pools are retired, so anyone
+        # still holding one can't open new connections through it (see
+        # _acquire). Returns the shard_ids closed.
+        closed = []
+        for shard_id in list(self._pools):
+            if len(self._pools) <= self.max_open:
+                break
+            pool = self._pools[shard_id]
+            read_pool = self._read_pools[shard_id]
+            if pool.stats()['in_use'] == 0 and read_pool.stats()['in_use'] == 0:
+                pool.retire()
+                read_pool.retire()
+                del self._pools[shard_id]
+                del self._read_pools[shard_id]
+                self.stats_counters['closed'] += 1
+                closed.append(shard_id)
+        return closed
+
+    def pool_for(self, event_id):
+        return self.pool(self.shard_for(event_id))
+
+    def read_pool_for(self, event_id):
+        return self.read_pool(self.shard_for(event_id))
+
+    def pools(self):
+        return [self.pool(shard_id) for shard_id in self.shard_ids()]
+
+    def close_all(self):
+        with self._lock:
+            for pool in list(self._pools.values()) + list(self._read_pools.values()):
+                pool.retire()
+            closed = list(self._pools)
+            self._pools.clear()
+            self._read_pools.clear()
+        for shard_id in closed:
+            group_commit.close_shard(shard_id)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.stats_counters)
+            stats['open'] = len(self._pools)
+            stats['in_use'] = sum(pool.stats()['in_use'] for pool in self._pools.values())
+            stats['read_in_use'] = sum(pool.stats()['in_use'] for pool in self._read_pools.values())
+        stats['enabled'] = self.enabled
+        stats['events_mapped'] = len(self._shards)
+        return stats
+
+
+router = ShardRouter()
+
+
+def get_shard_connection(shard_id, read_only=False):
+    # Like db.get_db_connection(): inside a request the connection is shared
+    # for the rest of the request and handed back at teardown
+    if shard_id == 0:
+        return db.get_read_connection() if read_only else db.get_db_connection()
+    if not has_app_context():
+        return _acquire(shard_id, read_only)
+    conns = g.setdefault('shard_conns', {})
+    conn = conns.get((shard_id, read_only))
+    if conn is None:
+        conn = _acquire(shard_id, read_only)
+        conn._request_bound = True
+        conns[shard_id, read_only] = conn
+    return conn
+
+
+def _acquire(shard_id, read_only):
+    while True:
+        pool = router.read_pool(shard_id) if read_only else router.pool(shard_id)
+        try:
+            return pool.acquire()
+        except db.PoolExhausted:
+            # Closed as idle between looking it up and getting here, look again
+            if not pool.retired:
+                raise
+
+
+def get_connection(event_id):
+    """A connection to the database holding event_id's tickets."""
+    return get_shard_connection(router.shard_for(event_id))
+
+
+def get_read_connection(event_id):
+    """A read-only connection to the database holding event_id's tickets."""
+    return get_shard_connection(router.shard_for(event_id), read_only=True)
+
+
+def release_request_connections(exception=None):
+    for conn in g.pop('shard_conns', {}).values():
+        conn._pool.release(conn)
+
+
+def init_app(app):
+    global router
+    router.close_all()
+    db_dir = os.path.dirname(os.path.abspath(app.config.get('DB_PATH', db.DEFAULT_DB_PATH)))
+    router = ShardRouter(
+        shard_dir=app.config.get('SHARD_DIR') or os.path.join(db_dir, 'shards'),
+        enabled=app.config.get('SHARDING', False),
+        group_size=app.config.get('SHARD_GROUP_SIZE', DEFAULT_GROUP_SIZE),
+        pool_size=app.config.get('SHARD_POOL_SIZE', DEFAULT_POOL_SIZE),
+        max_open=app.config.get('SHARD_MAX_OPEN', DEFAULT_MAX_OPEN),
+    )
+    app.teardown_appcontext(release_request_connections)
@@ -0,0 +1,200 @@
+import itertools
+import logging
+import sqlite3
+import threading
+import time
+
+from flask import g, has_app_context
+
+import db
+
+# In-memory copy of the central database for the catalog reads.
+#
+# GET /events and GET /events/<id> only need Events (and its search index),
+# and with READ_SNAPSHOT on they read them from a copy in memory instead of
+# the database file. A background thread takes a fresh copy with the sqlite3
+# backup API every READ_SNAPSHOT_INTERVAL seconds, skipping the copy when
+# PRAGMA data_version says nothing was committed since the last one.
+#
+# Each copy is a new shared-cache in-memory database with its own pool of
+# read-only connections. Swapping in a new copy retires the old pool, and the
+# old copy is freed once the last reader hands its connection back.
+#
+# Staleness is bounded two ways. A copy older than READ_SNAPSHOT_MAX_STALENESS
+# (say the refresh thread is stuck) is not used, and a copy taken before this
+# process last changed the catalog (note_write()) is not used either, so an
+# admin sees their new event straight away. In both cases the reads go to
+# db.get_read_connection() instead, which is always current.
+#
+# Seat maps never come from here: seat_cache.py applies changes on top of what
+# it loaded, and a stale base would stay wrong.
+
+DEFAULT_INTERVAL_SECONDS = 1.0
+DEFAULT_MAX_STALENESS_SECONDS = 5.0
+
+logger = logging.getLogger(__name__)
+
+
+class Snapshot:
+
+    def __init__(self, enabled=False, interval=DEFAULT_INTERVAL_SECONDS,
+                 max_staleness=DEFAULT_MAX_STALENESS_SECONDS, pool_size=db.DEFAULT_POOL_SIZE):
+        self.enabled = enabled
+        self.interval = interval
+        self.max_staleness = max_staleness
+        self.pool_size = pool_size
+
+        self._pool = None         # read-only pool on the current copy
+        self._keeper = None       # connection the copy was written through, keeps it alive
+        self._taken_at = 0.0      # monotonic time the current copy's data is from
+        self._written_at = 0.0    # last time this process changed the catalog
+        self._data_version = None
+        self._source = None       # refresh thread's own read-only connection to the database
+        self._names = itertools.count(1)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.stats = {'refreshes': 0, 'unchanged': 0, 'failures': 0, 'hits': 0, 'fallbacks': 0,
+                      'last_refresh_ms': 0.0}
+
+    def refresh(self):
+        """Take a new copy if the database changed since the last one. Returns True if it did."""
+        if self._source is None:
+            self._source = db.read_pool.dedicated()
+        started = time.monotonic()
+        data_version = self._source.execute('PRAGMA data_version').fetchone()[0]
+        if data_version == self._data_version and self._pool is not None:
+            # Nothing committed since, the copy we have is as good as a new one
+            with self._lock:
+                self._taken_at = started
+            self.stats['unchanged'] += 1
+            return False
+
+        uri = f'file:tessera-snapshot-{id(self)}-{next(self._names)}?mode=memory&cache=shared'
+        keeper = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        try:
+            self._source.backup(keeper)  # one step, so the copy is a consistent read
+        except Exception:
+            keeper.close()
+            raise
+        pool = db.ConnectionPool(db_path=uri, max_size=self.pool_size, read_only=True,
+                                 timeout=db.pool.timeout, health_check_after=db.pool.health_check_after,
+                                 connection_factory=db.pool.connection_factory)
+
+        with self._lock:
+            old_pool, old_keeper = self._pool, self._keeper
+            self._pool, self._keeper = pool, keeper
+            self._taken_at = started
+            self._data_version = data_version
+        if old_pool is not None:
+            old_pool.retire()
+            old_keeper.close()
+        self.stats['refreshes'] += 1
+        self.stats['last_refresh_ms'] = round((time.monotonic() - started) * 1000, 3)
+        return True
+
+    def note_write(self):
+        # Call after committing a catalog change, copies taken before now are no longer used
+        with self._lock:
+            self._written_at = time.monotonic()
+
+    def _current_pool(self):
+        with self._lock:
+            if (self._pool is None or self._taken_at <= self._written_at
+                    or time.monotonic() - self._taken_at > self.max_staleness):
+                return None
+            return self._pool
+
+    def get_connection(self):
+        """A connection to the copy if it is fresh enough, otherwise a read-only one to the database."""
+        pool = self._current_pool() if self.enabled else None
+        if pool is None:
+            if self.enabled:
+                self.stats['fallbacks'] += 1
+            return db.get_read_connection()
+        if not has_app_context():
+            return self._acquire(pool)
+        conn = g.get('snapshot_conn')
+        if conn is None:
+            conn = self._acquire(pool)
+            if conn._pool is db.read_pool:
+                return conn
+            conn._request_bound = True
+            g.snapshot_conn = conn
+        return conn
+
+    def _acquire(self, pool):
+        try:
+            conn = pool.acquire()
+        except db.PoolExhausted:
+            # Swapped out for a newer copy between picking the pool and getting here
+            self.stats['fallbacks'] += 1
+            return db.get_read_connection()
+        self.stats['hits'] += 1
+        return conn
+
+    def age(self):
+        with self._lock:
+            return None if self._pool is None else time.monotonic() - self._taken_at
+
+    # -- background thread -----------------------------------------------
+
+    def start(self):
+        if self._thread is not None or not self.enabled:
+            return
+        self._stop.clear()
+        self.refresh()
+        self._thread = threading.Thread(target=self._run, name='read-snapshot', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        with self._lock:
+            pool, keeper, self._pool, self._keeper = self._pool, self._keeper, None, None
+        if pool is not None:
+            pool.retire()
+            keeper.close()
+        if self._source is not None:
+            self._source.really_close()
+            self._source = None
+        self._data_version = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.refresh()
+            except Exception:
+                self.stats['failures'] += 1
+                logger.exception('Read snapshot refresh failed')
+
+
+snapshot = Snapshot()
+_start_lock = threading.Lock()
+
+
+def release_request_connection(exception=None):
+    conn = g.pop('snapshot_conn', None)
+    if conn is not None:
+        conn._pool.release(conn)
+
+
+def init_app(app):
+    global snapshot
+    snapshot.stop()
+    snapshot = Snapshot(
+        enabled=app.config.get('READ_SNAPSHOT', False),
+        interval=app.config.get('READ_SNAPSHOT_INTERVAL', DEFAULT_INTERVAL_SECONDS),
+        max_staleness=app.config.get('READ_SNAPSHOT_MAX_STALENESS', DEFAULT_MAX_STALENESS_SECONDS),
+        pool_size=app.config.get('READ_SNAPSHOT_POOL_SIZE', db.DEFAULT_POOL_SIZE),
+    )
+    app.teardown_appcontext(release_request_connection)
+
+    # Like the hold sweeper, the refresh thread starts with the first request
+    @app.before_request
+    def start_refresher():
+        if snapshot._thread is None and snapshot.enabled:
+            with _start_lock:
+                snapshot.start()
@@ -0,0 +1,71 @@
+# Compact encodings for the Tickets table.
+#
+# status is stored as a small integer (see Ticket_Statuses for the names)
+# instead of 'AVAILABLE' / 'available' / ... strings, so every row and index
+# entry carries a one byte value and a status filter can't miss rows written
+# in another spelling.
+#
+# Each seat also gets seat_key, one integer per event made of the row's index
+# (Ticket_Rows, numbered per event in the order rows were created) and the
+# seat number: row_index << 16 | seat_number. The unique seat index is on
+# (event_id, seat_key) instead of (event_id, row_name, seat_number). Triggers
+# (see migrations.py) fill it in on insert, so nothing that creates tickets
+# has to know about it.
+#
+# The API still speaks names: reads decode with STATUS_NAME_SQL or name(),
+# and seat lookups turn (row_name, seat_number) into the key in SQL.
+
+AVAILABLE = 0
+RESERVED = 1
+SOLD = 2
+
+NAMES = {
+    AVAILABLE: 'AVAILABLE',
+    RESERVED: 'RESERVED',
+    SOLD: 'SOLD',
+}
+CODES = {status: code for code, status in NAMES.items()}
+
+SEAT_BITS = 16
+MAX_SEAT_NUMBER = (1 << SEAT_BITS) - 1
+
+
+def code(status):
+    """Status name in any case -> code, or None for a status we don't know."""
+    return CODES.get(str(status).upper())
+
+
+def name(status_code):
+    return NAMES.get(status_code)
+
+
+def valid_seat_number(seat_number):
+    # A seat number outside 0-MAX_SEAT_NUMBER would spill into the next row's keys
+    try:
+        return 0 <= int(seat_number) <= MAX_SEAT_NUMBER
+    except (TypeError, ValueError):
+        return False
+
+
+def status_name_sql(column='status'):
+    # CASE expression turning the stored code back into its name, for SELECT and RETURNING lists
+    branches = ' '.join(f"WHEN {status_code} THEN '{status}'" for status_code, status in NAMES.items())
+    return f'CASE {column} {branches} END'
+
+
+STATUS_NAME_SQL = status_name_sql()
+
+# The columns SELECT * used to return, with status decoded
+TICKET_COLUMNS = (f'ticket_id, event_id, row_name, seat_number, {STATUS_NAME_SQL} AS status, '
+                  'barcode, user_id, reservation_time, price')
+
+# seat_key of (row_name, seat_number) at an event, NULL if the event has no such row.
+# Parameters: event_id, row_name, seat_number
+SEAT_KEY_SQL = f'((SELECT row_index << {SEAT_BITS} FROM Ticket_Rows WHERE event_id = ? AND row_name = ?) | ?)'
+
+
+def seat_keys_sql(values):
+    # Subquery of the seat_keys of a VALUES list of (row_name, seat_number) pairs.
+    # Parameters: the pairs, then event_id
+    return (f'(SELECT (r.row_index << {SEAT_BITS}) | v.column2 FROM (VALUES {values}) v '
+            'JOIN Ticket_Rows r ON r.row_name = v.column1 WHERE r.event_id = ?)')
@@ -0,0 +1,34 @@
+import json
+
+import inventory
+
+# Reusable venue layouts. An admin saves a layout once under a name and then
+# generates inventory for any number of events from it. The table is created
+# by migrations.py.
+
+
+class TemplateNotFound(Exception):
+    """No template with that name."""
+
+
+def save_template(conn, name, layout):
+    """Create or replace a template. The layout is validated first. Returns the seat count."""
+    rows, _ = inventory.parse_layout(layout)
+    conn.execute("""
+        INSERT INTO Venue_Templates (name, layout) VALUES (?, ?)
+        ON CONFLICT(name) DO UPDATE SET layout = excluded.layout
+    """, (name, json.dumps(layout)))
+    conn.commit()
+    return sum(last - first + 1 for _, _, ranges in rows for first, last in ranges)
+
+
+def get_template(conn, name):
+    row = conn.execute('SELECT layout FROM Venue_Templates WHERE name = ?', (name,)).fetchone()
+    if row is None:
+        raise TemplateNotFound(f'No venue template named {name!r}')
+    return json.loads(row['layout'])
+
+
+def list_templates(conn):
+    rows = conn.execute('SELECT template_id, name, created_at FROM Venue_Templates ORDER BY name').fetchall()
+    return [dict(row) for row in rows]
@@ -0,0 +1,240 @@
+import math
+import secrets
+import threading
+import time
+from bisect import bisect_left
+
+from itsdangerous import BadSignature, URLSafeSerializer
+
+# Virtual waiting room in front of /reserve_seat and /buy_ticket.
+#
+# When an admin turns the queue on for an event, clients first join it and get
+# a signed queue token carrying their place in line. A token bucket per event
+# lets people in at `rate` per second (with bursts up to `burst`), which should
+# be set to what the write path can actually sustain. Only tokens that have
+# been admitted, and whose admission hasn't run out, may reserve or buy.
+# Events without a queue behave exactly as before.
+#
+# Admission is worked out lazily whenever anyone joins or checks their status,
+# so there is no background thread. All state lives in a store object; the
+# in-process MemoryQueueStore is the default, and a shared store (e.g. Redis)
+# only needs the same five methods to run several app processes.
+
+DEFAULT_RATE = 50.0              # admissions per second
+DEFAULT_BURST = 50
+DEFAULT_ADMISSION_TTL = 600.0    # seconds an admitted user has to reserve and buy
+
+TOKEN_HEADER = 'X-Queue-Token'
+
+
+class QueueError(Exception):
+    """The request can't go through the waiting room."""
+
+
+class NotAdmitted(QueueError):
+    """Still waiting in line."""
+
+    def __init__(self, position, eta_seconds):
+        super().__init__('Still in the waiting room, try again later')
+        self.position = position
+        self.eta_seconds = eta_seconds
+
+
+class MemoryQueueStore:
+    """Queue state for one process.
+
+    Every joiner gets the next sequence number. `head` is the highest sequence
+    number let in so far, and each admission batch is remembered as
+    (head after the batch, time) so we know when any given number got in.
+    Batches past the admission window are dropped; `forgotten` is the head of
+    the last one dropped.
+    """
+
+    def __init__(self):
+        self._events = {}
+        self._lock = threading.Lock()
+
+    def settings(self, event_id):
+        state = self._events.get(event_id)
+        return state['settings'] if state else None
+
+    def configure(self, event_id, settings, now):
+        # settings=None turns the queue off and forgets everyone in it
+        with self._lock:
+            if settings is None:
+                self._events.pop(event_id, None)
+                return
+            state = self._events.get(event_id)
+            if state is None:
+                self._events[event_id] = {
+                    'settings': settings, 'next_seq': 1, 'head': 0,
+                    'tokens': float(settings['burst']), 'refilled': now,
+                    'batches': [], 'forgotten': 0, 'users': {},
+                }
+            else:
+                state['settings'] = settings
+                state['tokens'] = min(state['tokens'], float(settings['burst']))
+
+    def join(self, event_id, user_id, now):
+        """Sequence number for user_id, reusing their place unless their admission ran out."""
+        with self._lock:
+            state = self._events[event_id]
+            seq = state['users'].get(user_id)
+            if seq is not None and not (seq <= state['head'] and self._expired(state, seq, now)):
+                return seq
+            seq = state['users'][user_id] = state['next_seq']
+            state['next_seq'] += 1
+            return seq
+
+    def advance(self, event_id, now):
+        """Refill the bucket, let people in, and return (head, tokens left)."""
+        with self._lock:
+            state = self._events[event_id]
+            settings = state['settings']
+            elapsed = max(0.0, now - state['refilled'])
+            state['tokens'] = min(float(settings['burst']), state['tokens'] + elapsed * settings['rate'])
+            state['refilled'] = now
+
+            waiting = state['next_seq'] - 1 - state['head']
+            admit = min(int(state['tokens']), waiting)
+            if admit > 0:
+                state['head'] += admit
+                state['tokens'] -= admit
+                state['batches'].append((state['head'], now))
+
+            # Batches older than the admission window can't admit anyone any more
+            batches = state['batches']
+            cutoff = now - settings['admission_ttl']
+            drop = 0
+            while drop < len(batches) - 1 and batches[drop][1] < cutoff:
+                drop += 1
+            if drop:
+                state['forgotten'] = batches[drop - 1][0]
+                del batches[:drop]
+            return state['head'], state['tokens']
+
+    def admitted_at(self, event_id, seq):
+        # None if seq hasn't been let in, or got in so long ago it has been forgotten
+        with self._lock:
+            state = self._events.get(event_id)
+            if state is None or seq > state['head']:
+                return None
+            return self._admitted_at(state, seq)
+
+    def _admitted_at(self, state, seq):
+        if seq <= state['forgotten']:
+            return None
+        batches = state['batches']
+        return batches[bisect_left(batches, (seq, float('-inf')))][1]
+
+    def _expired(self, state, seq, now):
+        admitted_at = self._admitted_at(state, seq)
+        return admitted_at is None or now - admitted_at > state['settings']['admission_ttl']
+
+
+class WaitingRoom:
+
+    def __init__(self, store=None, secret='waiting-room', rate=DEFAULT_RATE, burst=DEFAULT_BURST,
+                 admission_ttl=DEFAULT_ADMISSION_TTL):
+        self.store = store if store is not None else MemoryQueueStore()
+        self.rate = rate
+        self.burst = burst
+        self.admission_ttl = admission_ttl
+        self._signer = URLSafeSerializer(secret, salt='waiting-room')
+
+    def configure(self, event_id, enabled=True, rate=None, burst=None, admission_ttl=None, now=None):
+        now = time.time() if now is None else now
+        if not enabled:
+            self.store.configure(event_id, None, now)
+            return None
+        settings = {
+            'rate': float(rate if rate is not None else self.rate),
+            'burst': int(burst if burst is not None else self.burst),
+            'admission_ttl': float(admission_ttl if admission_ttl is not None else self.admission_ttl),
+        }
+        if settings['rate'] <= 0 or settings['burst'] < 1 or settings['admission_ttl'] <= 0:
+            raise QueueError('rate, burst and admission_ttl must be positive')
+        # Tokens from an earlier queue for the same event must not carry over
+        current = self.store.settings(event_id)
+        settings['queue_id'] = current['queue_id'] if current else secrets.token_hex(4)
+        self.store.configure(event_id, settings, now)
+        return settings
+
+    def enabled(self, event_id):
+        return self.store.settings(event_id) is not None
+
+    def join(self, event_id, user_id, now=None):
+        now = time.time() if now is None else now
+        if not self.enabled(event_id):
+            raise QueueError('This event has no waiting room')
+        seq = self.store.join(event_id, str(user_id), now)
+        token = self._signer.dumps({'e': event_id, 'u': str(user_id), 'q': self.store.settings(event_id)['queue_id'], 'n': seq})
+        status = self._status(event_id, seq, now)
+        status['token'] = token
+        return status
+
+    def status(self, token, event_id, user_id, now=None):
+        now = time.time() if now is None else now
+        return self._status(event_id, self._seq(token, event_id, user_id), now)
+
+    def check(self, token, event_id, user_id, now=None):
+        """Raise unless the caller may use the reservation endpoints for event_id right now."""
+        try:
+            event_id = int(event_id)
+        except (TypeError, ValueError):
+            return  # not a real event, the route will say so
+        if not self.enabled(event_id):
+            return
+        now = time.time() if now is None else now
+        status = self._status(event_id, self._seq(token, event_id, user_id), now)
+        if status['status'] == 'waiting':
+            raise NotAdmitted(status['position'], status['eta_seconds'])
+        if status['status'] == 'expired':
+            raise QueueError('Your admission has expired, join the queue again')
+
+    def _seq(self, token, event_id, user_id):
+        if not token:
+            raise QueueError('A queue token is required for this event')
+        try:
+            payload = self._signer.loads(token)
+        except BadSignature:
+            raise QueueError('Invalid queue token')
+        if payload.get('e') != event_id or payload.get('u') != str(user_id):
+            raise QueueError('Queue token belongs to another event or user')
+        settings = self.store.settings(event_id)
+        if settings is None:
+            raise QueueError('This event has no waiting room')
+        if payload.get('q') != settings['queue_id']:
+            raise QueueError('Queue token is from an old queue, join again')
+        return payload['n']
+
+    def _status(self, event_id, seq, now):
+        settings = self.store.settings(event_id)
+        if settings is None:
+            raise QueueError('This event has no waiting room')
+        head, tokens = self.store.advance(event_id, now)
+
+        if seq > head:
+            position = seq - head
+            eta = max(0.0, (position - tokens) / settings['rate'])
+            return {'status': 'waiting', 'position': position, 'eta_seconds': math.ceil(eta)}
+
+        admitted_at = self.store.admitted_at(event_id, seq)
+        remaining = None if admitted_at is None else settings['admission_ttl'] - (now - admitted_at)
+        if remaining is None or remaining <= 0:
+            return {'status': 'expired', 'position': 0, 'eta_seconds': 0}
+        return {'status': 'admitted', 'position': 0, 'eta_seconds': 0, 'expires_in': int(remaining)}
+
+
+room = WaitingRoom()
+
+
+def init_app(app):
+    global room
+    room = WaitingRoom(
+        store=app.config.get('WAITING_ROOM_STORE'),
+        secret=app.config.get('WAITING_ROOM_SECRET') or app.config['JWT_SECRET_KEY'],
+        rate=app.config.get('WAITING_ROOM_RATE', DEFAULT_RATE),
+        burst=app.config.get('WAITING_ROOM_BURST', DEFAULT_BURST),
+        admission_ttl=app.config.get('WAITING_ROOM_ADMISSION_TTL', DEFAULT_ADMISSION_TTL),
+    )
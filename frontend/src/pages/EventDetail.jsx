@@ -1,4 +1,4 @@
-import React, { useState, useEffect } from 'react';
+import React, { useState, useEffect, useCallback } from 'react';
 import { useParams } from 'react-router-dom';
 import {
   Box,
@@ -82,14 +82,17 @@ function CheckoutForm({ selectedSeats, seatAvailability, eventId, onSuccess }) {
         throw new Error('Failed to create payment intent');
       }
 
-      const { clientSecret } = await paymentIntentResponse.json();
+      const { clientSecret, paymentIntentId, status } = await paymentIntentResponse.json();
 
-      // Confirm payment with Stripe
-      const { error, paymentIntent } = await stripe.confirmCardPayment(clientSecret, {
-        payment_method: {
-          card: elements.getElement(CardElement),
-        }
-      });
+      // Only a backend in payments test mode with auto confirm hands back intents
+      // that are already paid, otherwise confirm the payment with Stripe
+      const { error, paymentIntent } = status === 'succeeded'
+        ? { paymentIntent: { id: paymentIntentId, status } }
+        : await stripe.confirmCardPayment(clientSecret, {
+            payment_method: {
+              card: elements.getElement(CardElement),
+            }
+          });
 
       if (error) {
         throw new Error(error.message);
@@ -199,6 +202,7 @@ function EventDetail() {
   const [error, setError] = useState(null);
   const [timeLeft, setTimeLeft] = useState('');
   const [seatAvailability, setSeatAvailability] = useState({});
+  const [streamVersion, setStreamVersion] = useState(null);  // X-Seat-Stream-Version of the loaded map
   const [selectedSeats, setSelectedSeats] = useState([]);
   const [seatLoading, setSeatLoading] = useState(false);
   const toast = useToast();
@@ -247,44 +251,77 @@ function EventDetail() {
     fetchEvent();
   }, [id]);
 
-  useEffect(() => {
-    const fetchSeats = async () => {
-      try {
-        const token = getToken();
-        
-        if (!token) {
-          throw new Error('No authentication token found. Please log in.');
-        }
-        
-        const response = await fetch(`http://localhost:5000/get_ticket_availability/${id}`, {
-          headers: {
-            'Authorization': `Bearer ${token}`,
-            'Content-Type': 'application/json'
-          }
-        });
-        
-        if (!response.ok) {
-          throw new Error(`Failed to fetch seat availability`);
+  const fetchSeats = useCallback(async () => {
+    try {
+      const token = getToken();
+      
+      if (!token) {
+        throw new Error('No authentication token found. Please log in.');
+      }
+      
+      const response = await fetch(`http://localhost:5000/get_ticket_availability/${id}`, {
+        headers: {
+          'Authorization': `Bearer ${token}`,
+          'Content-Type': 'application/json'
         }
-        
-        const data = await response.json();
-        setSeatAvailability(data);
-      } catch (err) {
-        console.error('Error fetching seats:', err);
-        toast({
-          title: 'Error',
-          description: err.message || 'Failed to load seat availability',
-          status: 'error',
-          duration: 5000,
-          isClosable: true,
-        });
+      });
+      
+      if (!response.ok) {
+        throw new Error(`Failed to fetch seat availability`);
       }
-    };
+      
+      const data = await response.json();
+      setSeatAvailability(data);
+      // The live updates pick up from the version this map was read at
+      setStreamVersion(Number(response.headers.get('X-Seat-Stream-Version') ?? 0));
+    } catch (err) {
+      console.error('Error fetching seats:', err);
+      toast({
+        title: 'Error',
+        description: err.message || 'Failed to load seat availability',
+        status: 'error',
+        duration: 5000,
+        isClosable: true,
+      });
+    }
+  }, [id, toast]);
 
+  useEffect(() => {
     if (id) {
       fetchSeats();
     }
-  }, [id, toast]);
+  }, [id, fetchSeats]);
+
+  // Live seat updates. The server only sends the seats that changed, so we
+  // patch them into the map instead of downloading the whole thing again.
+  useEffect(() => {
+    const token = getToken();
+    if (!id || !token || streamVersion === null) return;
+
+    // since= replays anything that changed between loading the map and connecting
+    const source = new EventSource(
+      `http://localhost:5000/events/${id}/seat_stream?jwt=${token}&since=${streamVersion}`
+    );
+
+    source.addEventListener('seat', (e) => {
+      const { row, seat, status } = JSON.parse(e.data);
+      setSeatAvailability(prev => {
+        if (!prev[row]?.[seat]) return prev;
+        return {
+          ...prev,
+          [row]: {
+            ...prev[row],
+            [seat]: { ...prev[row][seat], status }
+          }
+        };
+      });
+    });
+
+    // We missed too many updates (or the server restarted), start over from a full map
+    source.addEventListener('reset', () => fetchSeats());
+
+    return () => source.close();
+  }, [id, fetchSeats, streamVersion]);
 
   useEffect(() => {
     if (!event?.date || !event?.time) return;
@@ -398,30 +435,8 @@ const handleSeatClick = async (rowName, seatNumber, status, price) => {
 };
 
   const handlePaymentSuccess = () => {
-    // Clear selected seats and refresh availability
+    // Clear selected seats. The seat stream delivers the new SOLD statuses.
     setSelectedSeats([]);
-    
-    // Refresh seat availability
-    const fetchSeats = async () => {
-      try {
-        const token = getToken();
-        const response = await fetch(`http://localhost:5000/get_ticket_availability/${id}`, {
-          headers: {
-            'Authorization': `Bearer ${token}`,
-            'Content-Type': 'application/json'
-          }
-        });
-        
-        if (response.ok) {
-          const data = await response.json();
-          setSeatAvailability(data);
-        }
-      } catch (err) {
-        console.error('Error refreshing seats:', err);
-      }
-    };
-    
-    fetchSeats();
   };
 
   const Seat = ({ rowName, seatNumber, seatData }) => {